@@ -1,12 +1,14 @@
 #!/usr/bin/env python
 # vim: ai ts=4 sts=4 et sw=4
 
+from __future__ import with_statement
 import rapidsms
 
-import cgi, urlparse, traceback
-from threading import Thread
-from SocketServer import ThreadingMixIn
-from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+import cgi, time, urlparse, traceback
+from threading import Thread, Lock
+from BaseHTTPServer import BaseHTTPRequestHandler
+
+from rapidsms.httpserver import PooledHTTPServer, POOL_SIZE, BACKLOG, IDLE_TIMEOUT
 
 from django.utils.simplejson import JSONEncoder
 from django.db.models.query import QuerySet
@@ -39,11 +41,18 @@ class App(rapidsms.app.App):
        won't work! This is handled by the WebUI bundled with this app, that proxies
        all requests to /ajax/(.+) to the right place, on the server side. I cannot
        conceive of a situation where this would be a problem - but keep it in mind,
-       and don't forget to prepend "/ajax/" to your AJAX URLs."""
+       and don't forget to prepend "/ajax/" to your AJAX URLs.
+       
+       Requests are handled by a fixed pool of threads (see rapidsms.httpserver),
+       and routed via a table of every app's ajax_* methods, built when RapidSMS
+       starts. The time taken by each method is counted, and can be fetched
+       from /ajax/stats (this app's own ajax_GET_stats, so that's
+       /ajax/ajax/stats via the WebUI)."""
     
     
-    class Server(ThreadingMixIn, HTTPServer):
-        pass
+    # the number of bytes of JSON to buffer before
+    # writing them out, when streaming a QuerySet
+    CHUNK_SIZE = 8192
     
     
     class MyJsonEncoder(JSONEncoder):
@@ -62,38 +71,87 @@ class App(rapidsms.app.App):
 
     
     class RequestHandler(BaseHTTPRequestHandler):
-        def __find_app(self, name):
-            
-            # inspect the name of each active app,
-            # returning as soon as we find a match
-            for app in self.server.app.router.apps:
-                if app.slug == name:
-                    return app
-            
-            # no app by that
-            # name was found
-            return None
+        
+        # keep connections open between requests, until
+        # the client has been quiet for a few seconds
+        protocol_version = "HTTP/1.1"
+        timeout = IDLE_TIMEOUT
         
         # handle both GET and POST with
         # the same method
         def do_GET(self):  return self.process()
         def do_POST(self): return self.process()
         
+        def __start_response(self, code, mime_type, length=None):
+            self.response_started = True
+            self.send_response(code)
+            self.send_header("content-type", mime_type)
+            if length is not None:
+                self.send_header("content-length", str(length))
+            
+            # without a length, the response must be chunked (or,
+            # for HTTP/1.0 clients, ended by closing the connection)
+            elif self.request_version >= "HTTP/1.1":
+                self.send_header("transfer-encoding", "chunked")
+            else:
+                self.close_connection = 1
+            if self.close_connection:
+                self.send_header("connection", "close")
+            self.end_headers()
+        
+        def __stream(self, queryset):
+            """Writes _queryset_ as a JSON list, encoding each object
+               as it's fetched, rather than all of them at once"""
+            self.__start_response(200, "application/json")
+            chunked = (self.request_version >= "HTTP/1.1")
+            encoder = App.MyJsonEncoder()
+            buffer = ["["]
+            size = 1
+            
+            # (the objects aren't cached by the queryset)
+            for n, obj in enumerate(queryset.iterator()):
+                if n > 0:
+                    buffer.append(",")
+                for part in encoder.iterencode(obj):
+                    buffer.append(part)
+                    size += len(part)
+                if size >= App.CHUNK_SIZE:
+                    self.__write("".join(buffer), chunked)
+                    buffer = []
+                    size = 0
+            
+            buffer.append("]")
+            self.__write("".join(buffer), chunked)
+            if chunked:
+                self.wfile.write("0\r\n\r\n")
+        
+        def __write(self, data, chunked):
+            if chunked:
+                self.wfile.write("%x\r\n%s\r\n" % (len(data), data))
+            else:
+                self.wfile.write(data)
+        
         def process(self):
             def response(code, output, json=True):
-                self.send_response(code)
-                mime_type = "application/json" if json else "text/plain"
-                self.send_header("content-type", mime_type)
-                self.end_headers()
                 
-                if json:
+                # querysets can be large, so they're
+                # sent as they're read from the database
+                if json and type(output) == QuerySet:
+                    self.__stream(output)
+                
+                elif json:
                     json = App.MyJsonEncoder().encode(output)
+                    self.__start_response(code, "application/json", len(json))
                     self.wfile.write(json)
                 
                 # otherwise, write the raw response.
                 # it doesn't make much sense to have
                 # error messages encoded as JSON...
-                else: self.wfile.write(output)
+                else:
+                    if isinstance(output, unicode):
+                        output = output.encode("utf-8")
+                    self.__start_response(code, "text/plain", len(output))
+                    self.wfile.write(output)
                 
                 # HTTP2xx represents success
                 return (code>=200 and code <=299)
@@ -107,76 +165,113 @@ class App(rapidsms.app.App):
             #
             # any other path format will return an http404
             # error, for the time being. params are optional.
+            self.response_started = False
             url = urlparse.urlparse(self.path)
             path_parts = url.path.split("/")
             
             # abort if the url didn't look right
             # TODO: better error message here
             if len(path_parts) != 3:
+                self.__discard_body()
                 return response(404, "FAIL.")
             
-            # resolve the first part of the url into an app
-            # (via the router), and abort if it wasn't valid
+            # resolve the first part of the url into an app, and
+            # the second (with the request method, e.g. GET, POST)
+            # into one of its methods, via the routing table
             app_name = path_parts[1]
-            app = self.__find_app(app_name)
-            if (app is None):
+            meth_name = "ajax_%s_%s" % (self.command, path_parts[2])
+            methods = self.server.app.routes.get(app_name)
+            if methods is None:
+                self.__discard_body()
                 return response(404,
                     "Invalid app: %s" % app_name)
             
-            # same for the request name within the app
-            # (FYI, self.command returns GET, POST, etc)
-            meth_name = "ajax_%s_%s" % (self.command, path_parts[2])
-            if not hasattr(app, meth_name):
+            method = methods.get(meth_name)
+            if method is None:
+                self.__discard_body()
                 return response(404,
                     "Invalid method: %s" % meth_name)
            
             # everything appears to be well, so call the
             # target method, and return the response (as
             # a string, for now)
+            started = time.time()
             try:
-                method = getattr(app, meth_name)
-                params = urlparse.urlparse(url.query)
-                args   = [params]
-                
-                # for post requests, we'll also need to parse
-                # the form data, and hand it to the method
-                if self.command == "POST":
-                    form = {}
-                
-                    # parse the form data via the CGI lib. this is
-                    # a horrible mess, but supports all kinds of
-                    # encodings (multipart, in particular)
-                    storage = cgi.FieldStorage(
-                        fp = self.rfile, 
-                        headers = self.headers,
-                        environ = {
-                            "REQUEST_METHOD": "POST",
-                            "CONTENT_TYPE": self.headers["content-type"] })
+                try:
+                    params = urlparse.urlparse(url.query)
+                    args   = [params]
                     
-                    # convert the fieldstorage object into a dict,
-                    # to keep it simple for the handler methods.
-                    # TODO: maybe make this a util if it's useful
-                    # elsewhere. it isn't, for the time being.
-                    for key in storage.keys():
-                        v = storage.getlist(key)
-                        
-                        # where possible, just store the values as singular,
-                        # to avoid CGIs usual post["id"][0] verbosity
-                        if len(v) > 1: form[key] = v
-                        else:          form[key] = v[0]
+                    # for post requests, we'll also need to parse
+                    # the form data, and hand it to the method
+                    if self.command == "POST":
+                        args.append(self.__parse_form())
                     
-                    args.append(form)
+                    # call the method, and send back whatever data
+                    # structure was returned, serialized with JSON
+                    output = method(*args)
+                    ok = True
+                    return response(200, output)
+     
+                # something raised during the request, so
+                # return a useless http error to the requester
+                except Exception, err:
+                    ok = False
+                    self.server.app.warning(traceback.format_exc())
+                    
+                    # (the request may not have been read to the end)
+                    self.close_connection = 1
+                    
+                    # if the response had already begun, there's
+                    # no way to tell the client, but to hang up
+                    if self.response_started:
+                        self.close_connection = 1
+                        return False
+                    return response(500, unicode(err), False)
+            finally:
+                self.server.app.count(app_name, meth_name, time.time() - started, ok)
+        
+        def __parse_form(self):
+            form = {}
+            content_type = self.headers["content-type"]
+            
+            # url-encoded forms (which is what the webui's proxy
+            # sends) are simple enough to parse without the CGI lib
+            if content_type.startswith("application/x-www-form-urlencoded"):
+                length = int(self.headers.get("content-length", 0))
+                fields = cgi.parse_qs(self.rfile.read(length))
+                keys = fields.keys()
+                getlist = fields.get
+            
+            # otherwise, parse the form data via the CGI lib. this
+            # is a horrible mess, but supports all kinds of
+            # encodings (multipart, in particular)
+            else:
+                storage = cgi.FieldStorage(
+                    fp = self.rfile, 
+                    headers = self.headers,
+                    environ = {
+                        "REQUEST_METHOD": "POST",
+                        "CONTENT_TYPE": content_type })
+                keys = storage.keys()
+                getlist = storage.getlist
+            
+            # convert the form into a dict,
+            # to keep it simple for the handler methods.
+            for key in keys:
+                v = getlist(key)
                 
-                # call the method, and send back whatever data
-                # structure was returned, serialized with JSON
-                output = method(*args)
-                return response(200, output)
- 
-            # something raised during the request, so
-            # return a useless http error to the requester
-            except Exception, err:
-                self.server.app.warning(traceback.format_exc())
-                return response(500, unicode(err), False)
+                # where possible, just store the values as singular,
+                # to avoid CGIs usual post["id"][0] verbosity
+                if len(v) > 1: form[key] = v
+                else:          form[key] = v[0]
+            return form
+        
+        def __discard_body(self):
+            # the body of a request which won't be handled must
+            # still be read, to reach the next one on this connection
+            length = int(self.headers.get("content-length", 0) or 0)
+            if length > 0:
+                self.rfile.read(length)
         
         # this does nothing, except prevent HTTP
         # requests being echoed to the screen
@@ -184,15 +279,34 @@ class App(rapidsms.app.App):
             pass
     
     
-    def configure(self, host=None, port=None):
+    def configure(self, host=None, port=None, threads=POOL_SIZE, backlog=BACKLOG):
         self.host = host
         self.port = port
+        self.threads = int(threads)
+        self.backlog = int(backlog)
+        
+        # (app, method) -> [calls, errors, total secs, max secs]
+        self.latency = {}
+        self.latency_lock = Lock()
     
     
     def start(self):
+        # route requests straight to the apps' ajax methods, rather
+        # than searching for the app by name for every request
+        self.routes = {}
+        for app in self.router.apps:
+            methods = {}
+            for name in dir(app):
+                if name.startswith("ajax_"):
+                    method = getattr(app, name)
+                    if callable(method):
+                        methods[name] = method
+            self.routes[app.slug] = methods
+        
         # create the webserver, through which the
         # AJAX requests from the WebUI will arrive
-        self.server = self.Server((self.host, self.port), self.RequestHandler)
+        self.server = PooledHTTPServer((self.host, self.port), self.RequestHandler,
+                                       self.threads, self.backlog)
         self.server.app = self
         
         # start the server in a separate thread, and daemonize it
@@ -200,3 +314,38 @@ class App(rapidsms.app.App):
         self.thread = Thread(target=self.server.serve_forever)
         self.thread.daemon = True
         self.thread.start()
+    
+    
+    def count(self, app_name, meth_name, elapsed, ok=True):
+        """Adds a call to _meth_name_ of _app_name_, which took
+           _elapsed_ seconds, to the latency counters"""
+        key = (app_name, meth_name)
+        with self.latency_lock:
+            counter = self.latency.get(key)
+            if counter is None:
+                counter = self.latency[key] = [0, 0, 0.0, 0.0]
+            counter[0] += 1
+            if not ok:
+                counter[1] += 1
+            counter[2] += elapsed
+            counter[3] = max(counter[3], elapsed)
+    
+    
+    def stats(self):
+        """Returns the number of calls, errors, and the mean and maximum
+           time taken (in milliseconds), for each ajax method called"""
+        with self.latency_lock:
+            endpoints = [{
+                "endpoint": "%s/%s" % key,
+                "calls":    calls,
+                "errors":   errors,
+                "mean_ms":  (total / calls) * 1000,
+                "max_ms":   longest * 1000 }
+                for key, (calls, errors, total, longest) in sorted(self.latency.items())]
+        return {
+            "server":    self.server.stats(),
+            "endpoints": endpoints }
+    
+    
+    def ajax_GET_stats(self, params):
+        return self.stats()
@@ -1,24 +1,47 @@
 #!/usr/bin/env python
 # vim: ai ts=4 sts=4 et sw=4
 
+import os
 import rapidsms
-import re
+from matcher import WordMatcher
+
+# how often (in seconds) to check if the list has been edited
+RELOAD_INTERVAL = 30
 
 class App(rapidsms.app.App):
 
-    def configure(self, incoming='yes', outgoing='yes'):
-        self._incoming = self.config_bool(incoming) 
+    def configure(self, incoming='yes', outgoing='yes', word_list='apps/censor/censor.list'):
+        self._incoming = self.config_bool(incoming)
         self._outgoing = self.config_bool(outgoing)
+        self._list = word_list
 
     def start(self):
-        self.words = {}
-        for line in open('apps/censor/censor.list', 'r').readlines():
-            word = line.strip()
-            self.words[word] = re.compile(r'%s' % word, re.I)
+        # the words are compiled into a single matcher, which is
+        # rebuilt whenever the list file changes
+        self._mtime = None
+        self.matcher = WordMatcher()
+        self.reload()
+        self.router.call_at(RELOAD_INTERVAL, self.reload_if_changed)
+
+    def reload(self):
+        mtime = os.stat(self._list).st_mtime
+        self.matcher = WordMatcher.load(self._list)
+        self._mtime = mtime
+        self.info("loaded %d censored words from %s", len(self.matcher), self._list)
+
+    def reload_if_changed(self):
+        try:
+            if os.stat(self._list).st_mtime != self._mtime:
+                self.reload()
+        except Exception:
+            # keep using the words we've got
+            self.log_last_exception("Couldn't reload %s" % self._list)
+
+        # returning the interval reschedules this call
+        return RELOAD_INTERVAL
 
     def handle(self, msg):
         if self._incoming:
-            self.debug("called handle!")
             if self.__find(msg.text):
                 self.info("censored word found in incoming message... reprimanding caller!")
                 msg.respond("Watch your mouth!")
@@ -26,15 +49,13 @@ class App(rapidsms.app.App):
 
     def outgoing(self, msg):
         if self._outgoing:
-            self.debug("called outgoing!")
             if self.__find(msg.text):
                 self.info("censored word found in outgoing message... cancelling send!")
                 return False
 
     def __find(self, text):
-        for word in self.words:
-            self.debug("checking word '%s' in '%s'", word, text)
-            if self.words[word].search(text):
-                self.info("word '%s' found in message", word)
-                return True
+        word = self.matcher.search(text)
+        if word is not None:
+            self.info("word '%s' found in message", word)
+            return True
         return False
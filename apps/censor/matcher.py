@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4 encoding=utf-8
+
+"""
+A multi-word matcher for the censor app. Searching for each word with
+its own regex costs one pass over the message per word in the list;
+the WordMatcher builds an Aho-Corasick automaton from all of the words
+once, then finds any of them in a single pass over the message.
+
+Words are matched anywhere in the text (as the regexes did), ignoring
+case and accents, so "éCOLE" matches "ecole", and vice versa.
+
+"""
+
+import unicodedata
+
+
+def normalize(text):
+    """Returns _text_ lower-cased, and with its accents removed"""
+    if not isinstance(text, unicode):
+        text = unicode(text, "utf-8", "replace")
+    text = unicodedata.normalize("NFKD", text.lower())
+    return u"".join([c for c in text if not unicodedata.combining(c)])
+
+
+class _Node(object):
+    __slots__ = ("goto", "fail", "word")
+
+    def __init__(self):
+        self.goto = {}
+        self.fail = None
+        # the word which ends here (or at the end of a suffix
+        # of this node, via the fail links), if any
+        self.word = None
+
+
+class WordMatcher(object):
+    def __init__(self, words=()):
+        self.root = _Node()
+        self.words = []
+        for word in words:
+            self.add(word)
+        self.build()
+
+    def __len__(self):
+        return len(self.words)
+
+    def add(self, word):
+        """Adds _word_ to the automaton. build() must be called
+           before searching again."""
+        key = normalize(word.strip())
+        if not key:
+            return
+        node = self.root
+        for c in key:
+            child = node.goto.get(c)
+            if child is None:
+                child = node.goto[c] = _Node()
+            node = child
+        if node.word is None:
+            node.word = word.strip()
+            self.words.append(node.word)
+
+    def build(self):
+        """Links each node to the node of its longest proper suffix
+           (breadth first, so those are always linked already)"""
+        root = self.root
+        root.fail = root
+        queue = []
+        for child in root.goto.itervalues():
+            child.fail = root
+            queue.append(child)
+        i = 0
+        while i < len(queue):
+            node = queue[i]
+            i += 1
+            for c, child in node.goto.iteritems():
+                fail = node.fail
+                while c not in fail.goto and fail is not root:
+                    fail = fail.fail
+                child.fail = fail.goto.get(c, root)
+                if child.fail is child:
+                    child.fail = root
+                # a word ending at the suffix also ends here
+                if child.word is None:
+                    child.word = child.fail.word
+                queue.append(child)
+
+    def search(self, text):
+        """Returns the first word found in _text_, or None"""
+        if not text:
+            return None
+        root = self.root
+        node = root
+        for c in normalize(text):
+            while c not in node.goto and node is not root:
+                node = node.fail
+            node = node.goto.get(c, root)
+            if node.word is not None:
+                return node.word
+        return None
+
+    @classmethod
+    def load(klass, path):
+        """Returns a WordMatcher of the words in _path_ (a utf-8 text
+           file, with one word per line)"""
+        f = open(path, "r")
+        try:
+            return klass([unicode(line, "utf-8", "replace") for line in f])
+        finally:
+            f.close()
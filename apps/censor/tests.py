@@ -0,0 +1,27 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4 encoding=utf-8
+
+import unittest
+from matcher import WordMatcher
+
+class TestWordMatcher(unittest.TestCase):
+    def testSearch(self):
+        matcher = WordMatcher(["CIA", "he", "she", "hers", u"école", ""])
+        self.assertEquals(len(matcher), 5)
+        self.assertEquals(matcher.search("a cia spy"), "CIA")
+        self.assertEquals(matcher.search("usher"), "she")
+        self.assertEquals(matcher.search("ahhers"), "he")
+        self.assertEquals(matcher.search(u"ECOLE"), u"école")
+        self.assertEquals(matcher.search(u"l'École"), u"école")
+        self.assertEquals(matcher.search("nothing to see"), None)
+        self.assertEquals(matcher.search(""), None)
+        self.assertEquals(matcher.search(None), None)
+
+    def testSuffixes(self):
+        # "bcd" is only found by following the fail link from "abc"
+        matcher = WordMatcher(["abce", "bcd"])
+        self.assertEquals(matcher.search("xabcd"), "bcd")
+        self.assertEquals(matcher.search("abcf"), None)
+
+if __name__ == "__main__":
+    unittest.main()
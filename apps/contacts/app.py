@@ -2,7 +2,8 @@
 # vim: ai ts=4 sts=4 et sw=4
 
 import rapidsms
-from apps.contacts.models import contact_from_message
+from apps.contacts.models import contact_from_message, quotas
+from apps.contacts.quotas import CHECKPOINT_INTERVAL
 
 #
 # NEARLY a pure data-model 'project'
@@ -12,6 +13,23 @@ from apps.contacts.models import contact_from_message
 #
 
 class App(rapidsms.app.App):
+    def start(self):
+        # quotas are counted in memory, and written
+        # to the db every CHECKPOINT_INTERVAL secs
+        self.router.call_at(CHECKPOINT_INTERVAL, self.checkpoint_quotas)
+
+    def stop(self):
+        quotas.checkpoint()
+
+    def checkpoint_quotas(self):
+        try:
+            quotas.checkpoint()
+        except Exception:
+            self.log_last_exception("Couldn't write the quota counters")
+
+        # returning the interval reschedules this call
+        return CHECKPOINT_INTERVAL
+
     def parse(self, msg):
         msg.sender = contact_from_message(msg,save=True)
         txt = 'Added Contact to msg: %r,%s with connections: %s'
@@ -15,10 +15,14 @@ regular RapidSMS reporter groups)
 from datetime import datetime,timedelta
 
 from django.db import models
+from django.db.models.signals import post_save, post_delete
 from rapidsms.message import Message
 from rapidsms.connection import Connection
 from nodegraph.models import Node
 from reporters.models import Reporter, PersistantBackend, PersistantConnection, reporter_from_message, connection_from_message
+# (via apps., like the reporters app, so they share one cache)
+from apps.reporters.identities import identities
+from quotas import QuotaService
 import math
 from rapidsms import utils
 import traceback
@@ -262,19 +266,20 @@ class Contact(Node):
         if connection is not None:
             connections.append(connection)
         else:
-            connections=self.reporter.connections.all()
+            connections=list(self.reporter.connections.all())
+
+        # count them all up front. the quotas are held in
+        # memory (see quotas.py), so there's no need to save
+        if not quotas.reserve(self, quota_type.RECEIVE, len(connections)):
+            raise QuotaException('User over Receive quota',quota_type.SEND)
 
         # TODO: raise exception if no connections?
-        try:
-            for conn in connections:
-                self._quota_receive_seen+=1
-                try:
-                    Message(conn.connection, text).send()
-                except Exception, e:
-                    # TODO: fix the finding a backend mess..
-                    pass
-        finally:
-            self.save()
+        for conn in connections:
+            try:
+                Message(conn.connection, text).send()
+            except Exception, e:
+                # TODO: fix the finding a backend mess..
+                pass
 
     def sent_message_accepted(self,msg):
         """
@@ -291,12 +296,9 @@ class Contact(Node):
                                         ignore=self.perm_ignore
                                       )
         
-        if not self.under_quota_send:
+        if not quotas.reserve(self, quota_type.SEND):
             raise QuotaException('User over Send quota',quota_type.SEND)
 
-        self._quota_send_seen+=1
-        self.save()
-
     ##############
     # Properties #
     ##############
@@ -416,18 +418,11 @@ class Contact(Node):
                  (including the case where there is no quota set)
         
         """
-        remain=self.__get_quota_period_remain(type)
-        
-        if remain is not None and \
-                abs(remain) != remain:
-            # we have a quota, and are beyond time period, and should
-            # reset the period
-            setattr(self,'_quota_%s_period_begin' % type, datetime.utcnow())
-            setattr(self, '_quota_%s_seen' % type, 0)
-            self.save()
-            return True
-        else:
-            return False
+        # the period is restarted in memory, and
+        # saved by the next checkpoint (see quotas.py)
+        begin=getattr(self,'_quota_%s_period_begin' % type)
+        quotas.counter(self, type)
+        return getattr(self,'_quota_%s_period_begin' % type) != begin
 
     def set_quota(self, type=quota_type.SEND, max=15, \
                       period=15):
@@ -496,16 +491,8 @@ class Contact(Node):
         if not getattr(self,'has_quota_%s' % type):
             return None
 
-        # check and reset time period if needed before doing anything
-        self.__check_quota_period(type)
-
-        seen=getattr(self,'_quota_%s_seen' % type)
-        max=getattr(self,'_quota_%s_max' % type)
-        room=max-seen
-        if room>0:
-            return room
-        else:
-            return 0
+        # resets the time period if needed before counting
+        return quotas.headroom(self, type)
 
     def __get_quota_period_remain(self,type=quota_type.SEND):
         """
@@ -514,8 +501,6 @@ class Contact(Node):
         Returns remaining time in minutes (rounded down) 
         in current period or None if infinite (no quota)
 
-        Private version is also called by __check_quota_period
-
         """
         if not getattr(self,'has_quota_%s' % type):
             return None
@@ -655,19 +640,45 @@ class Contact(Node):
                 return self.reporter.connection.identity
         return None
 
+# counts the Contacts' messages against their quotas (see quotas.py)
+quotas = QuotaService(Contact)
+
 def contact_from_message(msg,save=True):
+    # regular senders are resolved from the identity
+    # cache, rather than queried for every message
+    identity = identities.get(msg)
+    if identity is not None and identity.reporter is not None \
+            and identity.profile is not None:
+        contact = identity.profile
+        contact.connection_created_from = identity.connection
+        return contact
+
     reporter = reporter_from_message(msg, save)
     try:
         contact = reporter.get_profile()
     except Exception, e:
-        pass
-    else:
-        # store in memory
-        contact.connection_created_from = reporter.connection_created_from
-        return contact
-    contact = Contact(reporter=reporter)
+        contact = Contact(reporter=reporter)
+        if save:
+            contact.save()
     # store in memory
     contact.connection_created_from = reporter.connection_created_from
-    if save:
-        contact.save()
+    if contact.pk is not None:
+        identities.put(msg, reporter.connection_created_from, reporter, contact)
     return contact
+
+
+#
+# Evict contacts from the identity cache when they're changed
+# elsewhere (see reporters.identities), and drop the quota
+# counters of those which are deleted
+#
+
+def _contact_saved(sender, instance, **kwargs):
+    identities.evict("profile", instance)
+
+def _contact_deleted(sender, instance, **kwargs):
+    identities.evict("profile", instance, deleted=True)
+    quotas.forget(instance.pk)
+
+post_save.connect(_contact_saved, sender=Contact)
+post_delete.connect(_contact_deleted, sender=Contact)
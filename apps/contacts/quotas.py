@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4 encoding=utf8
+
+"""
+In-memory accounting of the Contacts' send and receive quotas.
+
+A quota is a number of messages per period (see Contact.set_quota),
+which is stored as four fields on the Contact: _max_, _period_ (in
+minutes), _period_begin_ and _seen_. Counting every message by saving
+the whole Contact made two writes per message, on the router thread.
+
+Instead, the QuotaService keeps a Counter for each quota in memory,
+and counts against that. Changed counters are written back to the
+database (seen and period_begin only) by checkpoint(), which the
+contacts app calls every CHECKPOINT_INTERVAL seconds, and as the
+router stops. So the counts which other processes (e.g. the webui)
+see can be up to that old.
+
+The Contact objects passed in are kept in sync with their counters,
+so their fields can still be read as before. If a Contact's quota is
+changed (set_quota, or edited elsewhere, and saved), its newer period
+is adopted when it's next counted.
+
+"""
+
+from __future__ import with_statement
+import threading
+from datetime import datetime, timedelta
+from django.db import transaction
+
+CHECKPOINT_INTERVAL = 60 # seconds
+
+
+class Counter(object):
+    """The state of one contact's send or receive quota"""
+
+    def __init__(self, max, period, begin, seen):
+        self.max = max
+        self.period = period # minutes
+        self.begin = begin
+        self.seen = seen
+
+    @property
+    def limited(self):
+        # a period of 0 means there is no quota
+        return self.period != 0
+
+    def expired(self, now):
+        return self.begin is None or \
+            now - self.begin >= timedelta(minutes=self.period)
+
+    @property
+    def headroom(self):
+        return max(self.max - self.seen, 0)
+
+
+class QuotaService(object):
+    def __init__(self, model):
+        self.model = model
+        self.lock = threading.RLock()
+        # (pk, type) -> Counter, and the keys of those
+        # which have changed since the last checkpoint
+        self.counters = {}
+        self.dirty = set()
+
+    def __fields(self, type):
+        return ["_quota_%s_%s" % (type, f) for f in ("max", "period", "period_begin", "seen")]
+
+    def counter(self, contact, type):
+        """Returns the Counter for _contact_'s quota of _type_, after
+           restarting its period if that's over. _contact_'s fields
+           are updated to match the counter (or vice versa, if it has
+           a newer period than the counter)."""
+        f_max, f_period, f_begin, f_seen = self.__fields(type)
+        now = datetime.utcnow()
+        key = (contact.pk, type)
+
+        with self.lock:
+            counter = self.counters.get(key)
+            begin = getattr(contact, f_begin)
+            if counter is None or (begin is not None and \
+                    (counter.begin is None or begin > counter.begin)):
+                counter = Counter(getattr(contact, f_max), getattr(contact, f_period),
+                                  begin, getattr(contact, f_seen))
+                # (an unsaved contact can't be checkpointed, so
+                # it's counted on the object, as it used to be)
+                if contact.pk is not None:
+                    self.counters[key] = counter
+            else:
+                # the limits may have been edited, without
+                # restarting the period
+                counter.max = getattr(contact, f_max)
+                counter.period = getattr(contact, f_period)
+
+            if counter.limited and counter.expired(now):
+                counter.begin = now
+                counter.seen = 0
+                self.__changed(key)
+
+            setattr(contact, f_begin, counter.begin)
+            setattr(contact, f_seen, counter.seen)
+            return counter
+
+    def headroom(self, contact, type):
+        """Returns how many more messages _contact_ can send or receive
+           (for _type_) in the current period, or None if unlimited"""
+        counter = self.counter(contact, type)
+        if not counter.limited:
+            return None
+        return counter.headroom
+
+    def reserve(self, contact, type, n=1):
+        """Counts _n_ messages against _contact_'s quota of _type_,
+           returning True, if they're under quota (i.e., it has any
+           headroom at all, as Contact.send_to has always checked).
+           Otherwise, nothing is counted, and False is returned."""
+        with self.lock:
+            counter = self.counter(contact, type)
+            if counter.limited and counter.headroom == 0:
+                return False
+            # like the period, messages are counted even when there's
+            # no quota, so the count is right if one is set later
+            counter.seen += n
+            setattr(contact, "_quota_%s_seen" % type, counter.seen)
+            self.__changed((contact.pk, type))
+            return True
+
+    def reserve_many(self, reservations, type):
+        """Reserves messages for many contacts at once. _reservations_
+           is a list of (contact, n) pairs, and a list of the contacts
+           which were refused (being over quota) is returned."""
+        refused = []
+        with self.lock:
+            for contact, n in reservations:
+                if not self.reserve(contact, type, n):
+                    refused.append(contact)
+        return refused
+
+    def forget(self, pk):
+        """Drops the counters of a contact, e.g. when it's deleted"""
+        with self.lock:
+            for type in ("send", "receive"):
+                self.counters.pop((pk, type), None)
+                self.dirty.discard((pk, type))
+
+    def __changed(self, key):
+        if key[0] is not None:
+            self.dirty.add(key)
+
+    def checkpoint(self):
+        """Writes the counters which have changed since the last
+           checkpoint to the database, in one transaction, and
+           returns the number written."""
+        with self.lock:
+            dirty, self.dirty = self.dirty, set()
+            updates = []
+            for pk, type in dirty:
+                counter = self.counters.get((pk, type))
+                if counter is not None:
+                    updates.append((pk, type, counter.begin, counter.seen))
+        if updates:
+            try:
+                self.__write(updates)
+            except Exception:
+                # keep them for the next checkpoint
+                with self.lock:
+                    self.dirty.update([(pk, type) for pk, type, b, s in updates])
+                raise
+        return len(updates)
+
+    @transaction.commit_on_success
+    def __write(self, updates):
+        for pk, type, begin, seen in updates:
+            f_max, f_period, f_begin, f_seen = self.__fields(type)
+            # an update, rather than a save, so only these fields
+            # are written (and no signals are sent)
+            self.model.objects.filter(pk=pk).update(**{f_begin: begin, f_seen: seen})
+
+    def stats(self):
+        return {
+            "counters": len(self.counters),
+            "dirty":    len(self.dirty) }
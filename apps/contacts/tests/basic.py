@@ -481,3 +481,29 @@ class TestApp (TestScript):
         self.assertTrue(user.under_quota_send)
         user.sent_message_accepted(Message(connection='foo'))
         user.send_quota=None
+
+    def testQuotaCheckpoint(self):
+        user = self.w_nodes[2]
+        user.quota_receive=(3,15)
+        user.save()
+
+        # counting doesn't save the contact...
+        self.assertTrue(quotas.reserve(user, quota_type.RECEIVE, 2))
+        self.assertTrue(Contact.objects.get(pk=user.id)._quota_receive_seen==0)
+
+        # ...until the next checkpoint
+        quotas.checkpoint()
+        self.assertTrue(Contact.objects.get(pk=user.id)._quota_receive_seen==2)
+
+        # a stale copy of the contact is still counted in memory
+        stale = Contact.objects.get(pk=user.id)
+        self.assertTrue(quotas.reserve(stale, quota_type.RECEIVE))
+        self.assertTrue(user._get_quota_headroom(type=quota_type.RECEIVE)==0)
+
+        # over quota, so the contact is refused (and not counted)
+        other = self.w_nodes[3]
+        refused = quotas.reserve_many([(user,1), (other,1)], quota_type.RECEIVE)
+        self.assertTrue(refused==[user])
+        self.assertTrue(user._quota_receive_seen==3)
+        user.quota_receive=None
+        user.save()
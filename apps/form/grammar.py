@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4
+
+"""
+The forms, compiled. Submitting a form used to cost a regex match
+against every domain and form code (recompiled each time), a query for
+the Domain, the Form (whose validator and alerter run two more), each
+Token, and two for the Form's apps, then an INSERT per token.
+
+A FormGrammar loads every domain, form and token once, and keeps:
+
+  * a dispatch table, from the (upper-cased) abbreviation of each
+    domain and form code to its compiled form, so most reports are
+    found with two dict lookups. codes which are only matched by their
+    regex (like a plural) are tried in order, and the result is cached
+    for next time. either way, a code finds the first form (in order)
+    whose regex matches it, as it always has: an abbreviation which
+    an earlier code's regex also matches is left out of the table.
+  * the Domain, Form (with its validators) and Tokens of each form,
+    and the names of the apps which handle it
+
+and writes the TokenEntries of each submission with a single INSERT.
+
+The grammar is reloaded, the next time it's used, whenever a Domain,
+Form, Token (or anything they're made of) is saved or deleted in this
+process. The patterns which the forms app registers with its
+dispatcher are still only built when the app is started, so adding a
+form needs a restart.
+
+"""
+
+from __future__ import with_statement
+import re
+import threading
+from django.db import connection, transaction
+from django.db.models import signals
+from apps.patterns.models import Pattern
+from rapidsms.cache import LRUCache
+from models import *
+
+# codes (as typed) whose regex matches are remembered
+MATCH_CACHE_SIZE = 1000
+
+# cached for codes which don't match anything
+_NO_MATCH = object()
+
+LEADING_PATTERN = "[\"'\s]*"
+SEPARATOR = "[,\.\s]+"
+TOKEN_SEPARATOR = "[,\.\s]*"
+TRAILING_PATTERN = "[\.,\"'\s]*"
+
+
+def normalize(code):
+    return (code or "").strip().upper()
+
+
+class CompiledToken(object):
+    """A Token, with its regex joined from its patterns (once)"""
+
+    def __init__(self, token):
+        self.token = token
+        self.pk = token.pk
+        self.abbreviation = token.abbreviation
+        self.regex = token.regex
+        self.matcher = re.compile(self.regex, re.IGNORECASE)
+
+    def matches(self, code):
+        return self.matcher.match(code) is not None
+
+
+class CompiledForm(object):
+    """A Form of a Domain, with everything needed to accept a report"""
+
+    def __init__(self, domain, form, code, tokens, apps):
+        self.domain = domain
+        self.form = form
+        self.code = code
+        self.tokens = tokens
+        self.apps = apps
+
+    def pattern(self, domain_code):
+        """Returns the pattern which matches a whole report of this
+           form, capturing each token (as the dispatcher expects)"""
+        return LEADING_PATTERN + domain_code.regex + SEPARATOR + \
+            self.code.regex + SEPARATOR + \
+            "".join(["(?:%s%s)?" % (TOKEN_SEPARATOR, t.regex) for t in self.tokens]) + \
+            TRAILING_PATTERN
+
+
+class CodeTable(object):
+    """Finds the first item (in order) whose code's regex matches a
+       code, as the forms app always has. An abbreviation is looked up
+       in a dict, but only if no earlier code's regex matches it, too
+       (so it finds the same item as the regexes would)"""
+
+    def __init__(self):
+        self.exact = {}
+        self.ordered = []
+
+    def add(self, code, item):
+        self.ordered.append((code, item))
+        # an abbreviation its own regex doesn't match
+        # was never accepted, so it isn't now
+        key = normalize(code.abbreviation)
+        if key not in self.exact and self.__scan(key) is item:
+            self.exact[key] = item
+
+    def find(self, text):
+        item = self.exact.get(text)
+        if item is not None:
+            return item
+        return self.__scan(text)
+
+    def __scan(self, text):
+        for code, item in self.ordered:
+            if code.matches(text):
+                return item
+        return None
+
+    def __iter__(self):
+        return iter([item for code, item in self.ordered])
+
+
+class CompiledDomain(object):
+    def __init__(self, domain, code):
+        self.domain = domain
+        self.code = code
+        self.forms = CodeTable()
+
+
+class FormGrammar(object):
+    def __init__(self, logger=None):
+        self.lock = threading.RLock()
+        self.logger = logger
+        # CodeTable of CompiledDomains, or None until they're loaded
+        self.domains = None
+        # (domain code, form code) -> CompiledForm (or _NO_MATCH)
+        self.matches = LRUCache(MATCH_CACHE_SIZE)
+        self.loads = 0
+        self.submitted = 0
+
+        for model in (Domain, DomainForm, Form, FormToken, Token, App, Pattern):
+            signals.post_save.connect(self.changed, sender=model)
+            signals.post_delete.connect(self.changed, sender=model)
+
+    def load(self):
+        """Returns the CodeTable of CompiledDomains, loading them (and
+           all of their forms and tokens) if they aren't already"""
+        with self.lock:
+            if self.domains is None:
+                self.domains = self.__load()
+                self.loads += 1
+            return self.domains
+
+    def __load(self):
+        tokens = {}
+        def compiled(token):
+            if token.pk not in tokens:
+                tokens[token.pk] = CompiledToken(token)
+            return tokens[token.pk]
+
+        domains = CodeTable()
+        for domain in Domain.objects.select_related("code"):
+            compiled_domain = CompiledDomain(domain, compiled(domain.code))
+            for df in domain.domain_forms.select_related("form", "form__code").order_by("sequence"):
+                form = df.form
+                fields = [compiled(ft.token) for ft in
+                    form.form_tokens.select_related("token").order_by("sequence")]
+                apps = [app.name for app in form.apps.all()]
+                compiled_domain.forms.add(compiled(form.code),
+                    CompiledForm(domain, form, compiled(form.code), fields, apps))
+            domains.add(compiled_domain.code, compiled_domain)
+        return domains
+
+    def changed(self, sender, **kwargs):
+        # forms are rarely edited, so forget them all
+        with self.lock:
+            self.domains = None
+            self.matches.clear()
+
+    def patterns(self):
+        """Returns the pattern of every form, in order"""
+        return [form.pattern(domain.code)
+            for domain in self.load() for form in domain.forms]
+
+    def match(self, domain_code, form_code):
+        """Returns the CompiledForm called _form_code_ in the domain
+           called _domain_code_, or None"""
+        key = (normalize(domain_code), normalize(form_code))
+        with self.lock:
+            domains = self.load()
+            form = self.matches.get(key)
+            if form is None:
+                form = _NO_MATCH
+                domain = domains.find(key[0])
+                if domain is not None:
+                    form = domain.forms.find(key[1]) or _NO_MATCH
+                self.matches.put(key, form)
+        if form is _NO_MATCH:
+            return None
+        return form
+
+    def helper_message(self):
+        return "Available forms are %s" % " or ".join([
+            "%s: %s" % (d.code.abbreviation.upper(),
+                ", ".join([f.code.abbreviation.upper() for f in d.forms]))
+            for d in self.load()])
+
+    def submit(self, form, data, date, reporter=None):
+        """Saves a report of _form_ (a CompiledForm), with the _data_
+           captured for each of its tokens, and returns the FormEntry"""
+        form_entry = FormEntry.objects.create(domain=form.domain,
+            form=form.form, date=date, reporter=reporter)
+        rows = [(form_entry.pk, token.pk, d or "")
+            for token, d in zip(form.tokens, data)]
+        if rows:
+            _insert_token_entries(rows)
+        with self.lock:
+            self.submitted += 1
+        return form_entry
+
+    def stats(self):
+        with self.lock:
+            return {
+                "loads":     self.loads,
+                "domains":   self.domains is not None and len(self.domains.ordered) or 0,
+                "matches":   self.matches.stats(),
+                "submitted": self.submitted }
+
+
+def _insert_token_entries(rows):
+    """Inserts TokenEntries, given as (form_entry_id, token_id, data)
+       rows, with one statement"""
+    meta = TokenEntry._meta
+    qn = connection.ops.quote_name
+    columns = [qn(meta.get_field(name).column) for name in ("form_entry", "token", "data")]
+    row_sql = "(%s)" % ", ".join(["%s"] * len(columns))
+    sql = "INSERT INTO %s (%s) VALUES %s" % (
+        qn(meta.db_table), ", ".join(columns), ", ".join([row_sql] * len(rows)))
+    params = []
+    for row in rows:
+        params.extend(row)
+    connection.cursor().execute(sql, params)
+    transaction.commit_unless_managed()
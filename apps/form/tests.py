@@ -1,20 +1,58 @@
 from rapidsms.tests.scripted import TestScript
+from apps.patterns.models import Pattern
 from app import App
+from models import *
+from grammar import CodeTable, CompiledToken, FormGrammar
+
+class Code (object):
+    """Stands in for a Token, as far as CompiledToken is concerned"""
+    def __init__(self, abbreviation, regex):
+        self.pk = None
+        self.abbreviation = abbreviation
+        self.regex = regex
 
 class TestApp (TestScript):
     apps = (App,)
 
-    # define your test scripts here.
-    # e.g.:
-    #
-    # testRegister = """
-    #   8005551212 > register as someuser
-    #   8005551212 < Registered new user 'someuser' for 8005551212!
-    #   8005551212 > tell anotheruser what's up??
-    #   8005550000 < someuser said "what's up??"
-    # """
-    #
-    # You can also do normal unittest.TestCase methods:
-    #
-    # def testMyModel (self):
-    #   self.assertEquals(...)
+    def testCodeTable(self):
+        table = CodeTable()
+        table.add(CompiledToken(Code("net", "nets?|bed")), "nets")
+        table.add(CompiledToken(Code("bed", "beds?")), "beds")
+        table.add(CompiledToken(Code("xx", "yy")), "yy")
+
+        self.assertEquals(table.find("NET"), "nets")
+        self.assertEquals(table.find("NETS"), "nets", "matched by its regex")
+        # an earlier code's regex matches this abbreviation,
+        # so it still finds the earlier item, as it always did
+        self.assertEquals(table.find("BED"), "nets")
+        self.assertEquals(table.find("BEDS"), "nets")
+        # an abbreviation that its own regex doesn't match
+        self.assertEquals(table.find("XX"), None)
+        self.assertEquals(table.find("YY"), "yy")
+        self.assertEquals(list(table), ["nets", "beds", "yy"])
+
+    def _token(self, abbreviation, regex):
+        token = Token.objects.create(name=abbreviation, abbreviation=abbreviation)
+        token.patterns.add(Pattern.objects.create(name=abbreviation, regex=regex))
+        return token
+
+    def testGrammar(self):
+        grammar = FormGrammar()
+        domain = Domain.objects.create(name="Bednets", code=self._token("bn", "(bn)"))
+        form = Form.objects.create(name="Distribution", code=self._token("dst", "(dst|dist)"))
+        form.form_tokens.add(FormToken.objects.create(token=self._token("qty", "(\d+)"), sequence=1))
+        domain.domain_forms.add(DomainForm.objects.create(form=form, sequence=1))
+
+        compiled = grammar.match(" bn", "Dist ")
+        self.assertEquals(compiled.form, form)
+        self.assertEquals([t.abbreviation for t in compiled.tokens], ["qty"])
+        self.assertEquals(grammar.match("bn", "dst"), compiled)
+        self.assertEquals(grammar.match("bn", "nonesuch"), None)
+        self.assertEquals(grammar.match("xx", "dst"), None)
+
+        # saving any part of a form reloads the grammar
+        loads = grammar.loads
+        other = Form.objects.create(name="Other", code=self._token("oth", "(oth)"))
+        domain.domain_forms.add(DomainForm.objects.create(form=other, sequence=2))
+        self.assertEquals(grammar.match("bn", "oth").form, other)
+        self.assertEquals(grammar.loads, loads + 1)
@@ -5,8 +5,44 @@ import rapidsms
 
 import models
 from models import OutgoingMessage, IncomingMessage, MAX_LATIN_SMS_LEN
+from writer import WriteBehindLog, FLUSH_SIZE, FLUSH_INTERVAL
 
 class App(rapidsms.app.App):
+    writer = None
+
+    def configure(self, write_behind="false", flush_size=FLUSH_SIZE,
+                  flush_interval=FLUSH_INTERVAL):
+        """If _write_behind_ is set, messages are buffered and saved in
+           batches by a background thread (see logger.writer), rather
+           than one at a time as they pass through the router."""
+        if self.config_bool(write_behind) is True:
+            self.writer = WriteBehindLog(
+                int(flush_size), float(flush_interval), logger=self)
+        else:
+            self.writer = None
+
+    def start(self):
+        if self.writer is not None:
+            self.writer.start()
+
+    def stop(self):
+        # write everything still waiting in the buffer
+        if self.writer is not None:
+            self.writer.stop()
+
+    def __create(self, model, **kwargs):
+        if self.writer is not None:
+            return self.writer.create(model, **kwargs)
+        return model.objects.create(**kwargs)
+
+    def after_save(self, record, callback, *args):
+        """Calls _callback_(_record_, *_args_) once _record_ (one of the
+           messages logged by this app) is in the database. With
+           write_behind, that might not be until the next flush."""
+        if self.writer is not None:
+            return self.writer.after_save(record, callback, *args)
+        callback(record, *args)
+
     # save messages on 'parse' so that 
     # annotations can be added to persistent message object by other apps
     def parse(self, msg):
@@ -15,7 +51,7 @@ class App(rapidsms.app.App):
         text_to_save = msg.text
         if len(msg.text) > MAX_LATIN_SMS_LEN:
             text_to_save = msg.text[0:160]
-        message = IncomingMessage.objects.create(identity=msg.connection.identity, text=text_to_save,
+        message = self.__create(IncomingMessage, identity=msg.connection.identity, text=text_to_save,
             backend=msg.connection.backend.slug)
         msg.persistent_msg = message
         self.debug(message)
@@ -23,9 +59,9 @@ class App(rapidsms.app.App):
     def outgoing(self, message):
         # make and save messages on their way out and 
         # cast connection as string so pysqlite doesnt complain
-        msg = OutgoingMessage.objects.create(identity=message.connection.identity, text=message.text, 
+        msg = self.__create(OutgoingMessage, identity=message.connection.identity, text=message.text, 
                                              backend=message.connection.backend.slug)
         self.debug(msg.text)
         # inject this id into the message object.
+        # (with write_behind, it's assigned before the row is written)
         message.logger_id = msg.id;
-
@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4
+
+"""
+Write-behind persistence for the message log. Rather than INSERTing each
+IncomingMessage and OutgoingMessage as it passes through the router (on
+the router's thread, in the middle of a blast), records are buffered in
+memory, and written by a background thread with multi-row INSERTs, once
+_flush_size_ are waiting or every _flush_interval_ seconds.
+
+Each record is given its primary key as soon as it's buffered, so other
+apps can link to it (msg.persistent_msg, msg.logger_id) before it has
+been written. Work which needs the row to exist (like adding to its
+many-to-many fields) should be passed to after_save.
+
+The keys are allocated here, counting up from the highest in the table
+when the writer starts, so the router must be the only process logging
+messages while the write-behind mode is enabled.
+
+If a batch can't be written (say, the database is briefly unavailable),
+its records are kept, with their keys and callbacks, and retried by the
+next flush. A record which has failed MAX_ATTEMPTS times is tried once
+more on its own, and only dropped if that fails too, so one bad row
+can't hold up the rest.
+
+"""
+
+from __future__ import with_statement
+import time
+import threading
+from django.db import connection, transaction
+
+FLUSH_SIZE = 200
+FLUSH_INTERVAL = 2.0 # seconds
+ROWS_PER_INSERT = 100 # (sqlite allows 999 parameters per statement)
+MAX_ATTEMPTS = 5 # flushes which may fail before a record is given up on
+
+
+class WriteBehindLog(object):
+    def __init__(self, flush_size=FLUSH_SIZE, flush_interval=FLUSH_INTERVAL, logger=None):
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.logger = logger
+
+        self.lock = threading.Condition()
+        self.flushing = threading.Lock()
+        self.thread = None
+        self.running = False
+
+        # model -> next primary key to hand out
+        self.next_pk = {}
+        # the records waiting for the next flush, and the (model, pk)
+        # of every record which hasn't been written yet (including
+        # those being written right now), to hold their callbacks
+        self.pending = []
+        self.unsaved = {}
+        # (model, pk) -> the number of failed attempts to write it
+        self.failures = {}
+        self.written = 0
+        self.dropped = 0
+
+    def create(self, model, **kwargs):
+        """Returns a new (unsaved) instance of _model_, with its primary
+           key already assigned, and buffers it to be written later."""
+        record = model(**kwargs)
+        with self.lock:
+            pk = self.next_pk.get(model)
+            if pk is None:
+                pk = self.__max_pk(model) + 1
+            self.next_pk[model] = pk + 1
+            record.pk = pk
+            self.pending.append(record)
+            self.unsaved[(model, pk)] = []
+            if len(self.pending) >= self.flush_size:
+                self.lock.notify()
+        return record
+
+    def after_save(self, record, callback, *args):
+        """Calls _callback_(_record_, *_args_) once _record_ has been
+           written, or right now if it already has been."""
+        with self.lock:
+            callbacks = self.unsaved.get((type(record), record.pk))
+            if callbacks is not None:
+                callbacks.append((callback, args))
+                return
+        callback(record, *args)
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def stop(self):
+        """Stops the background thread, and writes everything
+           which is still buffered, before returning."""
+        with self.lock:
+            self.running = False
+            self.lock.notify()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.flush()
+
+    def run(self):
+        while True:
+            with self.lock:
+                if self.running and len(self.pending) < self.flush_size:
+                    self.lock.wait(self.flush_interval)
+                if not self.running:
+                    break
+            try:
+                self.flush()
+            except Exception:
+                self.__log_last_exception("Couldn't write the message log")
+                # give the database a moment before trying again,
+                # however full the buffer gets in the meantime
+                deadline = time.time() + self.flush_interval
+                with self.lock:
+                    while self.running and time.time() < deadline:
+                        self.lock.wait(deadline - time.time())
+
+    def flush(self):
+        """Writes all of the buffered records, and returns how many. If
+           they can't be written, they're put back to be retried by the
+           next flush, and the error is raised."""
+        with self.flushing:
+            with self.lock:
+                records, self.pending = self.pending, []
+            if not records:
+                return 0
+
+            try:
+                self.__write(records)
+            except Exception:
+                written = self.__failed(records)
+                self.__saved(written)
+                raise
+            self.__saved(records)
+            return len(records)
+
+    def __failed(self, records):
+        # put the records back, ahead of any buffered since, except
+        # those which have failed too often. they're written one at a
+        # time, and any which still fail are dropped. returns the
+        # records which were written
+        retry = []
+        written = []
+        for record in records:
+            key = (type(record), record.pk)
+            attempts = self.failures.get(key, 0) + 1
+            if attempts < MAX_ATTEMPTS:
+                self.failures[key] = attempts
+                retry.append(record)
+                continue
+            try:
+                self.__write([record])
+                written.append(record)
+            except Exception:
+                self.__log_last_exception("Dropped %r after %d attempts to write it" % (
+                    record, attempts))
+                with self.lock:
+                    self.unsaved.pop(key, None)
+                self.dropped += 1
+            self.failures.pop(key, None)
+        with self.lock:
+            self.pending[0:0] = retry
+        return written
+
+    def __saved(self, records):
+        # runs the callbacks which were waiting for _records_
+        with self.lock:
+            callbacks = [(r, self.unsaved.pop((type(r), r.pk), [])) for r in records]
+            for record in records:
+                self.failures.pop((type(record), record.pk), None)
+        self.written += len(records)
+
+        for record, funcs in callbacks:
+            for callback, args in funcs:
+                try:
+                    callback(record, *args)
+                except Exception:
+                    self.__log_last_exception("Callback for %r failed" % record)
+
+    @transaction.commit_on_success
+    def __write(self, records):
+        # group the records by model, keeping their order
+        batches = {}
+        for record in records:
+            batches.setdefault(type(record), []).append(record)
+
+        cursor = connection.cursor()
+        for model, records in batches.iteritems():
+            fields = model._meta.local_fields
+            sql_prefix = "INSERT INTO %s (%s) VALUES " % (
+                connection.ops.quote_name(model._meta.db_table),
+                ", ".join([connection.ops.quote_name(f.column) for f in fields]))
+            row_sql = "(%s)" % ", ".join(["%s"] * len(fields))
+
+            for n in range(0, len(records), ROWS_PER_INSERT):
+                chunk = records[n:n + ROWS_PER_INSERT]
+                params = []
+                for record in chunk:
+                    for f in fields:
+                        # pre_save fills in auto_now_add
+                        # dates, as saving the record would
+                        params.append(f.get_db_prep_save(f.pre_save(record, True)))
+                cursor.execute(sql_prefix + ", ".join([row_sql] * len(chunk)), params)
+        transaction.set_dirty()
+
+    def __max_pk(self, model):
+        pks = model.objects.order_by("-id").values_list("id", flat=True)[:1]
+        return pks and pks[0] or 0
+
+    def __log_last_exception(self, msg):
+        if self.logger is not None:
+            self.logger.log_last_exception(msg)
+
+    def stats(self):
+        return {
+            "pending": len(self.pending),
+            "retrying": len(self.failures),
+            "written": self.written,
+            "dropped": self.dropped }
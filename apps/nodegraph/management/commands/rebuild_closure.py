@@ -0,0 +1,18 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4
+
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+from apps.nodegraph.models import NodeSet, NodeClosure, rebuild_closure
+
+class Command(NoArgsCommand):
+    help = "Rebuilds the nodegraph closure table (used to flatten NodeSets) from scratch."
+
+    @transaction.commit_on_success
+    def handle_noargs(self, **options):
+        verbose = int(options.get("verbosity", 1))>0
+        if verbose:
+            print "Rebuilding the closure of %d NodeSets..." % NodeSet.objects.count()
+        rebuild_closure()
+        if verbose:
+            print "Done: %d rows" % NodeClosure.objects.count()
@@ -2,7 +2,7 @@
 # vim: ai ts=4 sts=4 et sw=4 encoding=utf-8
 
 
-from django.db import models
+from django.db import models, connection
 from datetime import datetime
 
 # 
@@ -27,6 +27,10 @@ from datetime import datetime
 # ALL OTHER RULES MUST BE ENFORCED BY THE USER OF THE MODEL. 
 # For example, there is no restriction on Leaves appearing in multiple Sets
 # 
+# Rather than walking the graph (with a query per node) every time it's
+# flattened, every (ancestor, descendant) pair is stored in a closure table
+# (see NodeClosure), which is kept up to date as children are added and
+# removed. It can be rebuilt from scratch with './rapidsms rebuild_closure'
 #
 
 class Node(models.Model):
@@ -63,31 +67,16 @@ class Node(models.Model):
         if 'klass' is a Class, downcast results
 
         """
-        seen=set()
-
         if max_alt is not None:
             max_alt=int(max_alt)
             if max_alt<1:
                 return
-            
-        def _recurse(node,alt):
-            if (max_alt is not None and alt>max_alt) or \
-                    node in seen:
-                return
-            else:
-                seen.add(node)
-                
-            for a in node.get_parents():
-                _recurse(a,alt+1)
 
-        _recurse(self,0)
-        seen.remove(self)
-        ret=None
-        if klass is not None:
-            ret = [r._downcast(klass) for r in seen]
-        else:
-            ret = list(seen) # make a list so indexable, but order not guaranteed
-        return ret
+        lookup={'_descendant_links__descendant':self}
+        if max_alt is not None:
+            lookup['_descendant_links__depth__lte']=max_alt
+        # make a list so indexable, but order not guaranteed
+        return _fetch(NodeSet, klass, **lookup)
     
     @property
     def depth(self):
@@ -95,25 +84,13 @@ class Node(models.Model):
     
     def get_depth(self):
         """
-        return the depth of this node in the graph
+        return the depth of this node in the graph: the distance
+        to its furthest ancestor (by the shortest path to it)
         """
-        seen=set()
-
-        def _recurse(node):
-            if node in seen:
-                #if we hit a cycle, return
-                return 0
-            else:
-                seen.add(node)
-            
-            max_depth = 0
-            for a in node.get_parents():
-                max_depth = max(max_depth, _recurse(a)+1 )
-            return max_depth
-
-        max_depth = _recurse(self)
-        seen.remove(self)
-        return max_depth
+        _ensure_closure()
+        depths=NodeClosure.objects.filter(descendant=self).\
+            order_by('-depth').values_list('depth', flat=True)[:1]
+        return (depths[0] if len(depths)>0 else 0)
 
     def get_parent_count(self):
         return self._parents.all().count()
@@ -150,6 +127,14 @@ class Node(models.Model):
     def remove_from_parents(self,*rents):
         for rent in rents:
             self.remove_from_parent(rent)
+
+    def delete(self, *args, **kwargs):
+        # the closure rows for this node are deleted along with it, but
+        # its ancestors' rows for anything reached _through_ it are not
+        ancestors=list(NodeClosure.objects.filter(descendant=self).\
+                           values_list('ancestor', flat=True))
+        super(Node, self).delete(*args, **kwargs)
+        _relink(ancestors)
             
     def _downcast(self, klass):
         """
@@ -264,13 +249,23 @@ class NodeSet(Node):
         """
         for n in sub_nodes:
             self._children.add(n)
+        _link(self, sub_nodes)
 
     def remove_children(self, *subnodes):
         for n in subnodes:
             self._children.remove(n)
+        self.__relink()
         
     def remove_all_children(self):
         self._children.clear()
+        self.__relink()
+
+    def __relink(self):
+        # removing an edge can only change the paths which
+        # start at this node, or one of its ancestors
+        ancestors=list(NodeClosure.objects.filter(descendant=self).\
+                           values_list('ancestor', flat=True))
+        _relink([self.pk]+ancestors)
         
     def get_children(self, klass=None):
         childs = self._children.all()
@@ -294,44 +289,20 @@ class NodeSet(Node):
         Breaks cycles.
 
         """
-        # hold unique set of NodeSets we've visited to break cycles
-        seen=set()
-        leaves=set()
-
         if max_depth is not None:
             max_depth=int(max_depth)
             if max_depth<1:
-                return leaves # empty set
-
-        # recursive function to do the flattening
-        def _recurse(node, depth):
-            # check terminating cases
-            # - node is None (shouldn't happen but why not be safe?)                        
-            # - reached max_depth
-            # - seen this guy before (which breaks any cycles)
-            ns = node.as_set
-            if (max_depth is not None and depth>max_depth) or \
-                    ns in seen: 
-                return
-            
-            if ns is not None:
-                seen.add(ns)
-                # recurse to its childsets
-                for n in ns.children:
-                    _recurse(n, depth+1)
-            else:
-                # add it to leaves
-                leaves.add(node)
-                
-        # Now call recurse
-        _recurse(self, 0)
-        
+                return set() # empty set
+
+        # leaves are the descendants which aren't NodeSets
+        lookup={'_ancestor_links__ancestor':self,
+                'nodeset__isnull':True}
+        if max_depth is not None:
+            lookup['_ancestor_links__depth__lte']=max_depth
+
         # downcast if requested and make sure returns are
         # indexable lists
-        if klass is not None:
-            return [l._downcast(klass) for l in leaves]
-        else:
-            return list(leaves)
+        return _fetch(Node, klass, **lookup)
 
     def flatten_preorder(self, klass=None):
         """ given a top-level node, return a preorder traversal list of child 
@@ -340,12 +311,199 @@ class NodeSet(Node):
         ret = []
         if self is None:
             return ret
-        for child in self.get_children():
-            if klass is not None:
-                ret.append( child._downcast(klass) )
-            else:
-                ret.append( child )
-            set_ = child.as_set
-            if set_ is not None:
-                ret.extend( set_.flatten_preorder(klass) )
+
+        # fetch everything below this node, and the
+        # edges between them, then walk them in memory
+        nodes = dict([(n.pk,n) for n in _fetch(
+                    Node, klass, _ancestor_links__ancestor=self)])
+        children = _children_of([self.pk]+nodes.keys())
+
+        path = set()
+        def _recurse(pk):
+            # (don't loop forever if it's not a tree after all)
+            path.add(pk)
+            for child in children.get(pk, []):
+                if child in path:
+                    continue
+                ret.append(nodes[child])
+                _recurse(child)
+            path.remove(pk)
+
+        _recurse(self.pk)
         return ret
+
+
+class NodeClosure(models.Model):
+    """
+    The closure of the graph: one row for every pair of nodes where the
+    descendant can be reached from the ancestor, with the length of the
+    shortest path between them. Nodes aren't their own ancestors, even
+    if they are part of a cycle.
+
+    """
+    ancestor = models.ForeignKey(Node, related_name='_descendant_links')
+    descendant = models.ForeignKey(Node, related_name='_ancestor_links')
+    depth = models.PositiveIntegerField()
+
+    class Meta:
+        unique_together = (('ancestor', 'descendant'),)
+
+    def __unicode__(self):
+        return u'%s > %s (%d)' % (self.ancestor_id, self.descendant_id, self.depth)
+
+
+# the number of ids to put into a single 'IN' clause,
+# to stay well clear of the database's parameter limit
+CHUNK_SIZE = 500
+
+def _chunks(seq):
+    seq = list(seq)
+    for i in range(0, len(seq), CHUNK_SIZE):
+        yield seq[i:i+CHUNK_SIZE]
+
+def _fetch(base, klass, **lookup):
+    """
+    Returns a list of the _base_ objects matching _lookup_, downcast
+    to _klass_ if it's given. Those which are _klass_ instances are
+    fetched in one query, rather than one (or more) per object, and
+    only the rest are cast as far as they'll go (see Node._downcast).
+
+    """
+    _ensure_closure()
+    if klass is None:
+        return list(base.objects.filter(**lookup))
+
+    found = list(klass.objects.filter(**lookup))
+    if len(found) < base.objects.filter(**lookup).count():
+        pks = set([o.pk for o in found])
+        found.extend([o._downcast(klass) for o in base.objects.filter(**lookup)
+                      if o.pk not in pks])
+    return found
+
+def _children_of(pks):
+    """
+    Returns a dict mapping the NodeSets in _pks_ to the list of
+    the pks of their children (in the order they were added).
+
+    """
+    field = NodeSet._meta.get_field('_children')
+    qn = connection.ops.quote_name
+    sql = 'SELECT %s, %s FROM %s WHERE %s IN (%%s) ORDER BY %s' % (
+        qn(field.m2m_column_name()), qn(field.m2m_reverse_name()),
+        qn(field.m2m_db_table()), qn(field.m2m_column_name()), qn('id'))
+
+    children = dict()
+    cursor = connection.cursor()
+    for chunk in _chunks(pks):
+        cursor.execute(sql % ','.join(['%s']*len(chunk)), chunk)
+        for parent, child in cursor.fetchall():
+            children.setdefault(parent, []).append(child)
+    return children
+
+def _link(parent, children):
+    """
+    Updates the closure after _children_ were added to _parent_: each
+    of the parent's ancestors (and the parent itself) can now reach
+    each of the children's descendants (and the children themselves).
+
+    """
+    _ensure_closure()
+    ups = dict(NodeClosure.objects.filter(descendant=parent).\
+                   values_list('ancestor', 'depth'))
+    ups[parent.pk] = 0
+
+    for child in children:
+        # (the distance from the parent to each of them)
+        downs = dict([(d, depth+1) for d, depth in NodeClosure.objects.\
+                          filter(ancestor=child).values_list('descendant', 'depth')])
+        downs[child.pk] = 1
+
+        # the paths which are already known, to see if the
+        # new edge makes any of them shorter
+        known = dict()
+        for a_chunk in _chunks(ups.keys()):
+            for d_chunk in _chunks(downs.keys()):
+                for row in NodeClosure.objects.filter(
+                    ancestor__in=a_chunk, descendant__in=d_chunk):
+                    known[(row.ancestor_id, row.descendant_id)] = row
+
+        for a, up in ups.iteritems():
+            for d, down in downs.iteritems():
+                if a == d:
+                    # a cycle, back to the ancestor
+                    continue
+                depth = up + down
+                row = known.get((a, d))
+                if row is None:
+                    NodeClosure(ancestor_id=a, descendant_id=d, depth=depth).save()
+                elif depth < row.depth:
+                    NodeClosure.objects.filter(pk=row.pk).update(depth=depth)
+
+def _relink(pks):
+    """
+    Recalculates the closure rows for the descendants of each of _pks_,
+    by walking the graph breadth first. This is needed after an edge
+    is removed, since there is no way to tell from the closure alone
+    whether the descendants are still reachable via another path.
+
+    """
+    _ensure_closure()
+    children = dict()
+    for pk in set(pks):
+        depths = dict()
+        frontier = [pk]
+        depth = 0
+        while frontier:
+            depth += 1
+
+            # fetch the children of everything in the frontier that
+            # we haven't seen yet, and share them between the walks
+            missing = [n for n in frontier if n not in children]
+            found = _children_of(missing)
+            for n in missing:
+                children[n] = found.get(n, [])
+
+            below = []
+            for n in frontier:
+                for child in children[n]:
+                    if child != pk and child not in depths:
+                        depths[child] = depth
+                        below.append(child)
+            frontier = below
+
+        # and bring the stored rows into line
+        for row in NodeClosure.objects.filter(ancestor=pk):
+            depth = depths.pop(row.descendant_id, None)
+            if depth is None:
+                row.delete()
+            elif depth != row.depth:
+                NodeClosure.objects.filter(pk=row.pk).update(depth=depth)
+        for descendant, depth in depths.iteritems():
+            NodeClosure(ancestor_id=pk, descendant_id=descendant, depth=depth).save()
+
+def rebuild_closure():
+    """
+    Rebuilds the whole closure table from the graph. This is only needed
+    if the table is lost, or the graph was changed without going through
+    add_children/remove_children (e.g. by editing _children directly).
+
+    """
+    NodeClosure.objects.all().delete()
+    _relink(NodeSet.objects.values_list('pk', flat=True))
+
+# whether this process has made sure that the closure table has been
+# populated. it's empty when it is first created, even if the graph
+# isn't, so it's filled in then (if needed), rather than returning nothing
+_closure_checked = False
+
+def _ensure_closure():
+    global _closure_checked
+    if _closure_checked:
+        return
+    _closure_checked = True
+
+    field = NodeSet._meta.get_field('_children')
+    cursor = connection.cursor()
+    cursor.execute('SELECT COUNT(*) FROM %s' % connection.ops.quote_name(field.m2m_db_table()))
+    if cursor.fetchone()[0]>0 and NodeClosure.objects.count()==0:
+        rebuild_closure()
@@ -4,3 +4,4 @@ import unittest
 # file for them to be included in the tests
 from basic import *
 from ancestors import *
+from closure import *
@@ -0,0 +1,69 @@
+from rapidsms.tests.scripted import TestScript
+from app import App
+import apps.nodegraph.app as nodegraph_app
+from apps.nodegraph.models import Node, NodeSet, NodeClosure, rebuild_closure
+from util import *
+
+class TestClosure (TestScript):
+    apps = (App, nodegraph_app.App)
+
+    def setUp(self):
+        TestScript.setUp(self)
+
+        # region(village1(a,b), village2(b,c))
+        self.a=user('a')
+        self.b=user('b')
+        self.c=user('c')
+        self.v1=group('village1',self.a,self.b)
+        self.v2=group('village2',self.b,self.c)
+        self.region=group('region',self.v1,self.v2)
+
+    def tearDown(self):
+        for n in [self.a,self.b,self.c,self.v1,self.v2,self.region]:
+            if n.pk is not None:
+                n.delete()
+
+    def closure(self):
+        return set(NodeClosure.objects.values_list('ancestor','descendant','depth'))
+
+    def test01Incremental(self):
+        print
+        print "CLOSURE TESTS"
+        self.assertTrue(set(self.region.flatten())==set([self.a,self.b,self.c]))
+        self.assertTrue(set(self.b.get_ancestors())==
+                        set([self.v1,self.v2,self.region]))
+
+        print 'Remove b from village1, it is still in the region via village2'
+        self.v1.remove_children(self.b)
+        self.assertTrue(set(self.v1.flatten())==set([self.a]))
+        self.assertTrue(set(self.region.flatten())==set([self.a,self.b,self.c]))
+
+        print 'Remove village2, and b and c leave the region'
+        self.region.remove_children(self.v2)
+        self.assertTrue(set(self.region.flatten())==set([self.a]))
+        self.assertTrue(set(self.c.get_ancestors())==set([self.v2]))
+
+        print 'Shortcuts shorten the paths'
+        self.v1.add_children(self.v2)
+        self.assertTrue(self.c.get_depth()==3)
+        self.region.add_children(self.c)
+        self.assertTrue(set(self.region.flatten(max_depth=1))==set([self.c]))
+
+    def test02CyclesAndRebuild(self):
+        print
+        print "CLOSURE CYCLE TESTS"
+        print 'Add region to village1, making a cycle'
+        self.v1.add_children(self.region)
+        self.assertTrue(set(self.v1.flatten())==set([self.a,self.b,self.c]))
+        self.assertTrue(set(self.v1.get_ancestors())==set([self.region]))
+        self.assertTrue(set(self.region.get_ancestors())==set([self.v1]))
+
+        print 'Rebuilt closure is the same as the incremental one'
+        before=self.closure()
+        rebuild_closure()
+        self.assertTrue(self.closure()==before)
+
+        print 'Deleting village1 breaks the cycle'
+        self.v1.delete()
+        self.assertTrue(set(self.region.flatten())==set([self.b,self.c]))
+        self.assertTrue(len(self.region.get_ancestors())==0)
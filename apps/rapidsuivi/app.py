@@ -9,8 +9,8 @@ from rapidsuivi.exceptions import *
 from rapidsuivi.models import *
 from rapidsuivi.utils import import_villages 
 import os
-import gettext
 import traceback 
+from rapidsms.catalog import Catalog
 from rapidsms.message import Message
 # Mon numero envoie moi un message si il y'a une erreur car  je ne serai pas 
 # la ,une fois que le systeme sera installe
@@ -26,6 +26,7 @@ _G = {
         'en':['English'],
         },
     'TRANSLATORS':dict(),
+    'CATALOG':None,
     'DEFAULT_LANG':'fr',
     'ADMIN_CMD_PWD': None
     }
@@ -34,17 +35,16 @@ _G = {
 # i18n #
 ########
 def _init_translators():
+    # the catalogs are loaded once, and each message is
+    # compiled the first time it's used (see catalog.py)
     path = os.path.join(os.path.dirname(__file__),"locale")
-    for lang,name in _G['SUPPORTED_LANGS'].items():
-        trans = gettext.translation('django',path,[lang,_G['DEFAULT_LANG']] )
-        _G['TRANSLATORS'].update( {lang:trans} )
+    catalog = Catalog.load(path, 'django', _G['SUPPORTED_LANGS'].keys(), _G['DEFAULT_LANG'])
+    _G['CATALOG'] = catalog
+    _G['TRANSLATORS'].update(catalog.translations)
 
 def _t(locale, text):
     """translate text with default language"""
-    translator=_G['TRANSLATORS'][_G['DEFAULT_LANG']]
-    if locale in _G['TRANSLATORS']:
-        translator=_G['TRANSLATORS'][locale]
-    return translator.ugettext(text)
+    return _G['CATALOG'].translate(locale, text)
 
 def _st(relay,text):
     """translate a message for the given sender"""
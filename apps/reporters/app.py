@@ -11,6 +11,7 @@ import re
 import rapidsms
 from rapidsms.parsers import Matcher
 from models import *
+from identities import identities, FLUSH_INTERVAL
 
 
 # this is a temporary hack for the nigeria
@@ -103,6 +104,26 @@ class App(rapidsms.app.App):
             if not be.slug in known_backends:
                 self.info("Creating PersistantBackend object for %s (%s)" % (be.slug, be.title))
                 PersistantBackend(slug=be.slug, title=be.title).save()
+        
+        # last_seen updates are queued by parse, and
+        # written in batches every FLUSH_INTERVAL secs
+        identities.logger = self
+        self.router.call_at(FLUSH_INTERVAL, self.flush_last_seen)
+    
+    
+    def stop(self):
+        # write any last_seen updates still waiting
+        identities.flush()
+    
+    
+    def flush_last_seen(self):
+        try:
+            identities.flush()
+        except Exception:
+            self.log_last_exception("Couldn't write last_seen updates")
+        
+        # returning the interval reschedules this call
+        return FLUSH_INTERVAL
     
     
     def parse(self, msg):
@@ -111,8 +132,10 @@ class App(rapidsms.app.App):
         # for this message's sender (or create
         # one if this is the first time we've
         # seen the sender), and stuff the meta-
-        # dta into the message for other apps
-        conn = PersistantConnection.from_message(msg)
+        # dta into the message for other apps.
+        # regular senders are resolved from the
+        # identity cache, without any queries
+        conn = identities.resolve(msg).connection
         msg.persistant_connection = conn
         msg.reporter = conn.reporter
         
@@ -136,8 +159,9 @@ class App(rapidsms.app.App):
         else:            self.info("Unidentified: %s" % (conn))
         
         # update last_seen, which automatically
-        # populates the same property 
-        conn.seen()
+        # populates the same property. it's saved
+        # by the next flush, rather than right now
+        identities.seen(conn)
             
     
     """
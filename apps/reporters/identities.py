@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4
+
+"""
+A process-wide cache of who sent each message, so that resolving the
+sender's PersistantConnection, Reporter and profile (e.g. a Contact)
+doesn't cost half a dozen queries for every incoming message.
+
+Entries are keyed by (backend slug, identity), and evicted when they
+haven't been used for a while (LRU), when any of their objects are
+saved or deleted by somebody else (via signals), or when they are older
+than _max_age_, to pick up changes made by other processes (the webui).
+
+Updates to PersistantConnection.last_seen are held in memory, and
+written in batches by flush(), rather than saved for every message.
+If they can't be written, they're kept for the next flush.
+
+"""
+
+from __future__ import with_statement
+import time
+from datetime import datetime
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from rapidsms.cache import LRUCache
+from models import Reporter, PersistantBackend, PersistantConnection
+
+SIZE = 5000
+MAX_AGE = 300
+FLUSH_INTERVAL = 30 # seconds between writing last_seen updates
+FLUSH_BATCH = 200 # or write them when this many are waiting
+
+
+class Identity(object):
+    """The persistant objects for one (backend, identity) pair."""
+
+    def __init__(self, connection, reporter=None, profile=None):
+        self.connection = connection
+        self.reporter = reporter
+        self.profile = profile
+
+
+class IdentityCache(object):
+    def __init__(self, size=SIZE, max_age=MAX_AGE, flush_batch=FLUSH_BATCH):
+        self.cache = LRUCache(size, max_age, on_evict=self.__unindex)
+        self.flush_batch = flush_batch
+        # share the cache's lock, since it calls __unindex with it held
+        self.lock = self.cache.lock
+        # (kind, pk) -> set of keys, to find the entries holding an
+        # object (of kind "connection", "reporter" or "profile")
+        self.index = {}
+        # connection pk -> last_seen, waiting to be written
+        self.pending = {}
+        # when seen() may next flush a full batch itself (it waits for
+        # FLUSH_INTERVAL after a failure), and where to log the failures
+        self.retry_at = 0
+        self.logger = None
+
+    def key(self, msg):
+        return (msg.connection.backend.slug, msg.connection.identity)
+
+    def get(self, msg):
+        """Returns the cached Identity of _msg_'s sender, or None"""
+        return self.cache.get(self.key(msg))
+
+    def put(self, msg, connection, reporter=None, profile=None):
+        key = self.key(msg)
+        identity = Identity(connection, reporter, profile)
+        with self.lock:
+            old = self.cache.pop(key)
+            if old is not None:
+                self.__unindex(key, old)
+            self.cache.put(key, identity)
+            for kind, obj in self.__objects(identity):
+                self.index.setdefault((kind, obj.pk), set()).add(key)
+        return identity
+
+    def resolve(self, msg):
+        """Returns the Identity of _msg_'s sender, creating a
+           PersistantConnection if this is a new one (but not
+           a Reporter, like PersistantConnection.from_message)"""
+        identity = self.get(msg)
+        if identity is None:
+            conn = PersistantConnection.from_message(msg)
+            identity = self.put(msg, conn, conn.reporter)
+        return identity
+
+    def evict(self, kind, instance, deleted=False):
+        """Removes the entries holding a copy of _instance_ (of _kind_),
+           which might now be stale. Unless it was _deleted_, entries
+           holding _instance_ itself are up to date, and are kept."""
+        with self.lock:
+            keys = self.index.get((kind, instance.pk), set())
+            for key in list(keys):
+                identity = self.cache.get(key, count=False)
+                if identity is not None and \
+                        (deleted or getattr(identity, kind) is not instance):
+                    self.cache.pop(key)
+                    self.__unindex(key, identity)
+
+    def clear(self):
+        with self.lock:
+            self.cache.clear()
+            self.index = {}
+
+    def __objects(self, identity):
+        for kind in ("connection", "reporter", "profile"):
+            obj = getattr(identity, kind)
+            if obj is not None and obj.pk is not None:
+                yield kind, obj
+
+    def __unindex(self, key, identity):
+        with self.lock:
+            for kind, obj in self.__objects(identity):
+                keys = self.index.get((kind, obj.pk))
+                if keys is not None:
+                    keys.discard(key)
+                    if not keys:
+                        del self.index[(kind, obj.pk)]
+
+    def seen(self, connection):
+        """Sets _connection_.last_seen to now, and queues it to be
+           saved by the next flush (see PersistantConnection.seen)"""
+        connection.last_seen = datetime.now()
+        with self.lock:
+            self.pending[connection.pk] = connection.last_seen
+            full = len(self.pending) >= self.flush_batch and time.time() >= self.retry_at
+        if full:
+            # (this is called while handling a message, which
+            # shouldn't fail because the batch couldn't be written)
+            try:
+                self.flush()
+            except Exception:
+                self.retry_at = time.time() + FLUSH_INTERVAL
+                if self.logger is not None:
+                    self.logger.log_last_exception("Couldn't write last_seen updates")
+
+    def flush(self):
+        """Writes the queued last_seen updates, in one transaction.
+           Returns the number of connections updated. If they can't
+           be written, they're kept for the next flush, and the
+           error is raised."""
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        if pending:
+            try:
+                self.__write(pending)
+            except Exception:
+                # keep them for the next flush, unless
+                # a connection has been seen again since
+                with self.lock:
+                    for pk, last_seen in pending.iteritems():
+                        newer = self.pending.get(pk)
+                        if newer is None or newer < last_seen:
+                            self.pending[pk] = last_seen
+                raise
+        return len(pending)
+
+    @transaction.commit_on_success
+    def __write(self, pending):
+        for pk, last_seen in pending.iteritems():
+            # (an update, rather than a save, so it
+            # doesn't clobber changes to other fields)
+            PersistantConnection.objects.filter(pk=pk).update(last_seen=last_seen)
+
+    def stats(self):
+        stats = self.cache.stats()
+        stats["pending"] = len(self.pending)
+        return stats
+
+
+identities = IdentityCache()
+
+
+#
+# Signal handlers, to evict entries when their objects are changed.
+# Saves of the very same objects held by the cache (i.e., made while
+# handling a message) don't need to evict anything.
+#
+
+def _connection_saved(sender, instance, **kwargs):
+    identities.evict("connection", instance)
+
+def _connection_deleted(sender, instance, **kwargs):
+    identities.evict("connection", instance, deleted=True)
+
+def _reporter_saved(sender, instance, **kwargs):
+    identities.evict("reporter", instance)
+
+def _reporter_deleted(sender, instance, **kwargs):
+    identities.evict("reporter", instance, deleted=True)
+
+def _backend_deleted(sender, instance, **kwargs):
+    identities.clear()
+
+post_save.connect(_connection_saved, sender=PersistantConnection)
+post_delete.connect(_connection_deleted, sender=PersistantConnection)
+post_save.connect(_reporter_saved, sender=Reporter)
+post_delete.connect(_reporter_deleted, sender=Reporter)
+post_delete.connect(_backend_deleted, sender=PersistantBackend)
@@ -1,8 +1,14 @@
+from datetime import datetime, timedelta
 from rapidsms.tests.scripted import TestScript
 from apps.reporters.models import *
 import apps.reporters.app as reporter_app
+from apps.reporters.identities import IdentityCache
 from app import App
 
+class ListLogger (list):
+    def log_last_exception(self, msg):
+        self.append(msg)
+
 class TestApp (TestScript):
     apps = (reporter_app.App, App )
 
@@ -10,6 +16,35 @@ class TestApp (TestScript):
     # to work properly in tests
     def setUp(self):
         TestScript.setUp(self)
+
+    def testLastSeenKept(self):
+        backend, created = PersistantBackend.objects.get_or_create(slug="mock", title="mock")
+        conn = PersistantConnection.objects.create(backend=backend, identity="8005551212")
+        cache = IdentityCache(flush_batch=1)
+        cache.logger = ListLogger()
+
+        # a failed write (even one made while handling
+        # a message) is logged, and the update kept
+        def fail(pending):
+            raise IOError("the database is down")
+        cache._IdentityCache__write = fail
+        cache.seen(conn)
+        self.assertEquals(len(cache.logger), 1)
+        self.assertEquals(cache.pending, {conn.pk: conn.last_seen})
+
+        # unless the connection is seen again in the meantime
+        def fail_after_seen(pending):
+            cache.pending[conn.pk] = newer
+            raise IOError("the database is down")
+        newer = datetime.now() + timedelta(seconds=1)
+        cache._IdentityCache__write = fail_after_seen
+        self.assertRaises(IOError, cache.flush)
+        self.assertEquals(cache.pending, {conn.pk: newer})
+
+        del cache._IdentityCache__write
+        self.assertEquals(cache.flush(), 1)
+        self.assertEquals(cache.pending, {})
+        self.assertNotEquals(PersistantConnection.objects.get(pk=conn.pk).last_seen, None)
     
     """
     Tostan : disabling default reporter app
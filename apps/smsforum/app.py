@@ -10,10 +10,13 @@ import logging
 import re, os
 import rapidsms
 from rapidsms.parsers.bestmatch import BestMatch, MultiMatch
-import gettext
+from rapidsms.parsers.dispatcher import Dispatcher
+from rapidsms.catalog import Catalog, Rendered, is_gsm, gsm_length, encoded_length
 import traceback
 from apps.smsforum.models import Village, villages_for_contact, MembershipLog
 from apps.contacts.models import Contact
+from apps.smsforum.matchers import village_matcher, contact_matcher
+from apps.smsforum.blast import BlastEngine, BATCH_SIZE, BACKGROUND_THRESHOLD
 
 MAX_LATIN_SMS_LEN = 160 
 MAX_LATIN_BLAST_LEN = MAX_LATIN_SMS_LEN - 20 # reserve 20 chars for us
@@ -47,6 +50,7 @@ _G = {
         'en':['English'],
         },
     'TRANSLATORS':dict(),
+    'CATALOG':None,
     'DEFAULT_LANG':'fr',
     'ADMIN_CMD_PWD': None
     }
@@ -82,17 +86,21 @@ def passwordProtectedCmd(f):
 # i18n #
 ########
 def _init_translators():
+    # the catalogs are loaded once, and each message
+    # is compiled the first time it's used (see catalog.py)
     path = os.path.join(os.path.dirname(__file__),"locale")
-    for lang,name in _G['SUPPORTED_LANGS'].items():
-        trans = gettext.translation('django',path,[lang,_G['DEFAULT_LANG']])
-        _G['TRANSLATORS'].update( {lang:trans} )
+    catalog = Catalog.load(path, 'django', _G['SUPPORTED_LANGS'].keys(), _G['DEFAULT_LANG'])
+    _G['CATALOG'] = catalog
+    _G['TRANSLATORS'].update(catalog.translations)
 
 def _t(locale, text):
     """translate text with default language"""
-    translator=_G['TRANSLATORS'][_G['DEFAULT_LANG']]
-    if locale in _G['TRANSLATORS']:
-        translator=_G['TRANSLATORS'][locale]
-    return translator.ugettext(text)
+    return _G['CATALOG'].translate(locale, text)
+
+def _rt(locale, text, format_values=None):
+    """translate and render text, returning a catalog.Rendered
+       string, which knows its encoding and length"""
+    return _G['CATALOG'].render(locale, text, format_values)
 
 def _st(sender,text):
     """translate a message for the given sender"""
@@ -101,12 +109,20 @@ def _st(sender,text):
     # new hotness 3-letter codes 'eng'
     return _t(sender.locale, text)
 
+def _add_domains(persistent_msg, domains):
+    for domain in domains:
+        persistent_msg.domains.add(domain)
+
 
 #
 # App class
 #
 
 class App(rapidsms.app.App):
+    blast_batch_size = BATCH_SIZE
+    blast_background = BACKGROUND_THRESHOLD
+    _blast_engine = None
+
     def __init__(self, router):
         rapidsms.app.App.__init__(self, router)
         
@@ -167,7 +183,11 @@ class App(rapidsms.app.App):
             (u'remove', {'lang':'en','func':self.destroy_community}),
             ]
         
-        self.cmd_matcher=BestMatch(self.cmd_targets)
+        # the commands (and their aliases, in every language) are
+        # indexed once, so matching one is a walk of a prefix tree
+        self.commands=Dispatcher()
+        for aliases,data in self.cmd_targets:
+            self.commands.add_keyword(aliases,data['func'],data)
         #villes=[(v.name, v) for v in Village.objects.all()]
         #self.village_matcher=BestMatch(villes, ignore_prefixes=['keur'])
         # swap dict so that we send in (name,code) tuples rather than (code,name
@@ -177,18 +197,18 @@ class App(rapidsms.app.App):
         
     def __get_village_matcher(self):
         """
-        HACK to force reload of names before each match
+        The matcher is cached, and kept up to date
+        when villages are saved (see matchers.py)
         
         """
-        villes = []
-        for v in Village.objects.all():
-            names = [v.name] + [a.alias for a in v.aliases.all()]
-            villes.append( (names,v) )
-        return BestMatch(villes, ignore_prefixes=['keur'])
+        return village_matcher.matcher
         
     def configure(self, **kwargs):
         try:
             _G['DEFAULT_LANG'] = kwargs.pop('default_lang')
+            if _G['CATALOG'] is not None:
+                _G['CATALOG'].default = _G['DEFAULT_LANG']
+                _G['CATALOG'].reset()
         except:
             pass
 
@@ -197,8 +217,37 @@ class App(rapidsms.app.App):
         except:
             pass
 
+        try:
+            # how often to reload the village and contact names,
+            # to pick up changes made outside of the router
+            max_age = int(kwargs.pop('matcher_max_age'))
+            village_matcher.max_age = max_age
+            contact_matcher.max_age = max_age
+        except:
+            pass
+
+        # blasts to more than this many contacts are sent
+        # in the background, in batches of blast_batch_size
+        self.blast_batch_size = int(kwargs.pop('blast_batch_size', BATCH_SIZE))
+        self.blast_background = int(kwargs.pop('blast_background_threshold', BACKGROUND_THRESHOLD))
+
     def start(self):
         self.__loadFixtures()
+
+    def __get_blast_engine(self):
+        # created on first use, since the engine needs the router
+        if self._blast_engine is None:
+            self._blast_engine = BlastEngine(self.router,
+                self.blast_batch_size, self.blast_background, logger=self)
+        return self._blast_engine
+    blast_engine=property(__get_blast_engine)
+
+    def stats(self):
+        """The hit rate and render time of the message catalog,
+           and the progress of the recent blasts"""
+        return {
+            'catalog': _G['CATALOG'].stats(),
+            'blasts': self.blast_engine.stats() }
     
     #####################
     # Message Lifecycle #
@@ -257,7 +306,7 @@ class App(rapidsms.app.App):
             rest=rest.strip()
 
         # Now match the possible command to ones we know
-        cmd_match=self.cmd_matcher.match(cmd,with_data=True)
+        cmd_match=[(target,data) for target,func,data in self.commands.match_keyword(cmd)]
 
         if len(cmd_match)==0:
             # no command match
@@ -493,9 +542,7 @@ class App(rapidsms.app.App):
         like handle in the field used for the match.
         
         """
-        contacts=[(c.common_name, c) for c in Contact.objects.all()]
-        cont_matcher=BestMatch(targets=contacts)
-        found=MultiMatch(self.__get_village_matcher(),cont_matcher).\
+        found=MultiMatch(self.__get_village_matcher(),contact_matcher.matcher).\
             match(address,with_data=True)
         
         if len(found)==0:
@@ -515,6 +562,10 @@ class App(rapidsms.app.App):
             # got one person or village!
             name,obj=found[0] # found is an array of tuples (name,obj)
 
+            # the matcher holds on to its objects between messages,
+            # so reload this one to get its current permissions
+            obj=obj.__class__.objects.get(pk=obj.pk)
+
             # prep the outbound message
             ok,out_text,enc=self.__prep_blast_message(msg,text,[name])
             if not ok:
@@ -591,30 +642,29 @@ class App(rapidsms.app.App):
         # it's what knows the message size limits...
         #
 
-        gsm_enc=True
+        # (is_gsm remembers the answer for short strings,
+        # like signatures, which are checked over and over)
         sender_sig=msg.sender.signature
-        try:
-            out_text.encode('gsm')
-            sender_sig.encode('gsm')
-        except Exception, e:
-            # Either message or sig needs UCS2 encoding
-            gsm_enc=False
-        finally:
-            encoding,max_len=(\
-                ('gsm',MAX_LATIN_BLAST_LEN) if gsm_enc \
-                    else ('ucs2',MAX_UCS2_BLAST_LEN))
+        gsm_enc=is_gsm(out_text) and is_gsm(sender_sig)
+        # Either message or sig needs UCS2 encoding if not
+        encoding,max_len=(\
+            ('gsm',MAX_LATIN_BLAST_LEN) if gsm_enc \
+                else ('ucs2',MAX_UCS2_BLAST_LEN))
             
-        if len(out_text)>max_len:
+        # measure the text as it will be sent: in septets for GSM
+        # (where a few characters take two), or characters for UCS2
+        msg_len=gsm_enc and gsm_length(out_text) or len(out_text)
+        if msg_len>max_len:
             if encoding == 'ucs2':
                 rsp= _st(msg.sender, "blast-fail_message-too-long_ucs2 %(msg_len)d %(max_unicode)d") % \
                     {
-                    'msg_len': len(out_text),
+                    'msg_len': msg_len,
                     'max_unicode': MAX_UCS2_BLAST_LEN
                     }
             else:
                 rsp= _st(msg.sender, "blast-fail_message-too-long %(msg_len)d %(max_latin)d") % \
                     {
-                    'msg_len': len(out_text),
+                    'msg_len': msg_len,
                     'max_latin': MAX_LATIN_BLAST_LEN,
                     } 
             self.__reply(msg,rsp)
@@ -639,17 +689,18 @@ class App(rapidsms.app.App):
         if villes is None or len(villes)==0:
             return True
 
-        recipients=set()
-        for ville in villes:
-            recipients.update(ville.flatten(klass=Contact))
-            
-        # now iterate every member of the group we are broadcasting
-        # to, and queue up the same message to each of them
-        for recipient in recipients:
-            if recipient != sender:
-                self.__blast_to_contact(recipient,text)
+        # TODO: move to lib/pygsm/gsm.py
+        # currently just log messages that are too long
+        # since these are not handled properly in modem
+        self._check_message_length(text)
+
+        # the engine sends the same message to every member
+        # of the groups we are broadcasting to, in batches
+        # (and in the background, for large groups)
+        blast = self.blast_engine.blast(villes, sender, text)
         vnames = ', '.join([v.name for v in villes])
-        self.debug("success! %(villes)s recvd msg: %(txt)s" % { 'villes':vnames,'txt':text})
+        self.debug("success! %(villes)s recvd msg: %(txt)s (%(blast)r)" % \
+                       { 'villes':vnames,'txt':text,'blast':blast})
         return True
 
     def __blast_to_contact(self, contact, text):
@@ -735,14 +786,15 @@ class App(rapidsms.app.App):
         the message's associated sender.
 
         """
-        reply_text=_st(msg.sender,reply_text) 
-        if format_values is not None:
-            try:
-                reply_text = reply_text % format_values
-            except TypeError:
-                err="Not all format values: %r were used in the string: %s" %\
-                    (format_values, reply_text)
-                self.error(err)
+        # rendering also works out the encoding and length,
+        # so checking it below doesn't re-encode the text
+        try:
+            reply_text=_rt(msg.sender.locale,reply_text,format_values)
+        except TypeError:
+            reply_text=_rt(msg.sender.locale,reply_text)
+            err="Not all format values: %r were used in the string: %s" %\
+                (format_values, reply_text)
+            self.error(err)
         # TODO: move to lib/pygsm/gsm.py
         # currently just log messages that are too long
         # since these are not handled properly in modem
@@ -767,8 +819,13 @@ class App(rapidsms.app.App):
         #msg.persistent_msg should never be none if app.logger is used
         #this is to ensure smsforum does not fail even if logger fails...
         if hasattr(msg,'persistent_msg'):
-            for domain in domains:
-                msg.persistent_msg.domains.add(domain)
+            # with the logger's write_behind mode, the message
+            # might not be saved yet, so let it add the domains
+            logger = self.router.get_app('logger')
+            if logger is not None:
+                logger.after_save(msg.persistent_msg, _add_domains, domains)
+            else:
+                _add_domains(msg.persistent_msg, domains)
         else:
             logging.error('persistent_msg not create for msg: %s from %s' % \
                           (msg.text, msg.sender.signature) )
@@ -781,21 +838,19 @@ class App(rapidsms.app.App):
         checks message length < 160 if gsm, else <70 if ucs-2/utf16
         """
 
-        gsm_enc=True
-        try:
-            text.encode('gsm')
-        except:
-            gsm_enc=False
-        finally:
-            encoding,max_len=(\
-                ('gsm',MAX_LATIN_SMS_LEN) if gsm_enc \
-                    else ('ucs2',MAX_UCS2_SMS_LEN))
+        # rendered text already knows its encoding and length
+        # (in septets, for gsm), so only plain text is encoded
+        if isinstance(text, Rendered):
+            encoding,msg_len=text.encoding,text.length
+        else:
+            encoding,msg_len=encoded_length(text)
+        max_len=MAX_LATIN_SMS_LEN if encoding=='gsm' else MAX_UCS2_SMS_LEN
         
-        if len(text)>max_len:
+        if msg_len>max_len:
             err= ("ERROR: %(encoding)s MESSAGE OF LENGTH '%(msg_len)d' IS TOO LONG. Max is %(max)d.") % \
                          {
                 'encoding': encoding,
-                'msg_len': len(text),
+                'msg_len': msg_len,
                 'max': MAX_LATIN_SMS_LEN if encoding=='gsm' else MAX_UCS2_SMS_LEN
                 } 
             self.error(err)
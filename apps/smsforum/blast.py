@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4 encoding=utf-8
+
+"""
+The bulk send engine for village blasts.
+
+Sending a blast one Contact at a time (Contact.send_to) costs several
+queries per member: checking their quota (which may save), fetching
+their connections, running the whole outgoing phase, and saving the
+contact again. For a village of a few thousand members, that blocks
+the router for minutes.
+
+Instead, the BlastEngine resolves the members of the villages and their
+connections with a few set-based queries, checks and counts a batch of
+them against their quotas at once (with contacts.quotas, in memory),
+and sends each batch with Router.outgoing_many, which runs the outgoing
+phase over the whole batch and hands it to the backends via send_many.
+Blasts to more than _background_threshold_ members are sent by a thread
+of their own, so the router can get on with the next message, and each
+Blast reports its progress.
+
+"""
+
+from __future__ import with_statement
+import time
+import threading
+from collections import deque
+from django.db import connection as db
+from rapidsms.message import Message
+from rapidsms.connection import Connection
+from rapidsms.outbound import DeliveryStatus
+from apps.contacts.models import Contact, quotas, quota_type
+from apps.reporters.models import PersistantConnection
+
+BATCH_SIZE = 200
+BACKGROUND_THRESHOLD = 50 # recipients
+CHUNK_SIZE = 500 # ids per IN (...) clause
+HISTORY = 20 # finished blasts to remember
+
+
+def _chunks(seq, size=CHUNK_SIZE):
+    seq = list(seq)
+    for i in range(0, len(seq), size):
+        yield seq[i:i+size]
+
+
+class Blast(object):
+    """One broadcast of _text_ to the members of _villages_, and its
+       progress. Counts are of messages, except for _recipients_ and
+       _skipped_, which are of contacts (who may have several
+       connections, or none at all)."""
+
+    def __init__(self, number, villages, sender, text):
+        self.number = number
+        self.villages = villages
+        self.sender = sender
+        self.text = text
+        self.recipients = 0
+        self.skipped = 0 # no permission, or over quota
+        self.messages = 0
+        self.sent = 0
+        self.cancelled = 0
+        self.failed = 0
+        self.started = None
+        self.finished = None
+
+    def __repr__(self):
+        return "<Blast %d to %s: %d/%d sent>" % (
+            self.number, ", ".join([v.name for v in self.villages]),
+            self.sent, self.messages)
+
+    @property
+    def running(self):
+        return self.started is not None and self.finished is None
+
+    @property
+    def throughput(self):
+        """Messages sent per second, so far"""
+        if self.started is None:
+            return 0.0
+        elapsed = (self.finished or time.time()) - self.started
+        return (self.sent / elapsed) if elapsed > 0 else 0.0
+
+    def stats(self):
+        return {
+            "blast":      self.number,
+            "villages":   [v.name for v in self.villages],
+            "recipients": self.recipients,
+            "skipped":    self.skipped,
+            "messages":   self.messages,
+            "sent":       self.sent,
+            "cancelled":  self.cancelled,
+            "failed":     self.failed,
+            "running":    self.running,
+            "throughput": self.throughput }
+
+
+class BlastEngine(object):
+    def __init__(self, router, batch_size=BATCH_SIZE,
+                 background_threshold=BACKGROUND_THRESHOLD, logger=None):
+        self.router = router
+        self.batch_size = batch_size
+        self.background_threshold = background_threshold
+        self.logger = logger
+        self.lock = threading.Lock()
+        self.count = 0
+        self.running = []
+        self.history = deque()
+
+    def blast(self, villages, sender, text):
+        """Sends _text_ to every member of _villages_ except _sender_,
+           returning the Blast. Unless it's a small one, the messages
+           are sent in the background, so it may still be running."""
+        with self.lock:
+            self.count += 1
+            blast = Blast(self.count, villages, sender, text)
+        blast.started = time.time()
+
+        recipients = self.recipients(villages, sender)
+        blast.recipients = len(recipients)
+
+        if blast.recipients > self.background_threshold:
+            with self.lock:
+                self.running.append(blast)
+            thread = threading.Thread(target=self.__run_background, args=(blast, recipients))
+            thread.setDaemon(True)
+            thread.start()
+        else:
+            self.__run(blast, recipients)
+        return blast
+
+    def recipients(self, villages, sender=None):
+        """Returns the Contacts who are members of any of _villages_
+           (other than _sender_), without duplicates."""
+        found = {}
+        for village in villages:
+            for contact in village.flatten(klass=Contact):
+                found[contact.pk] = contact
+        if sender is not None:
+            found.pop(sender.pk, None)
+        return found.values()
+
+    def connections(self, contacts):
+        """Returns a dict of reporter pk -> [(backend slug, identity)]
+           for _contacts_, in one query per CHUNK_SIZE contacts"""
+        conns = {}
+        for chunk in _chunks([c.reporter_id for c in contacts]):
+            rows = PersistantConnection.objects.filter(reporter__in=chunk)\
+                .values_list("reporter", "backend__slug", "identity")
+            for reporter_pk, slug, identity in rows:
+                conns.setdefault(reporter_pk, []).append((slug, identity))
+        return conns
+
+    def __run(self, blast, recipients):
+        try:
+            try:
+                for batch in _chunks(recipients, self.batch_size):
+                    self.__send_batch(blast, batch)
+                    self.__info("%r (%.1f msg/sec)", blast, blast.throughput)
+            except Exception:
+                self.__log_last_exception("%r failed" % blast)
+        finally:
+            blast.finished = time.time()
+            with self.lock:
+                if blast in self.running:
+                    self.running.remove(blast)
+                self.history.append(blast)
+                while len(self.history) > HISTORY:
+                    self.history.popleft()
+
+    def __run_background(self, blast, recipients):
+        try:
+            self.__run(blast, recipients)
+        finally:
+            # this thread's database connection isn't used again
+            db.close()
+
+    def __send_batch(self, blast, contacts):
+        conns = self.connections(contacts)
+
+        reservations = []
+        for contact in contacts:
+            if contact.perm_ignore or not contact.perm_receive:
+                blast.skipped += 1
+                continue
+            # like Contact.send_to, count a message to every one of
+            # the contact's connections against their quota
+            targets = conns.get(contact.reporter_id, [])
+            reservations.append((contact, len(targets)))
+
+        # check and count the whole batch at once
+        refused = self.__reserve(reservations)
+        blast.skipped += len(refused)
+
+        messages = []
+        for contact, n in reservations:
+            if contact.pk not in refused:
+                messages.extend(conns.get(contact.reporter_id, []))
+        self.__send(blast, messages)
+
+    def __reserve(self, reservations):
+        """Counts each (contact, number of messages) in _reservations_
+           against the contact's receive quota, and returns the set of
+           pks of the contacts which were over it"""
+        # (in memory, and saved by the quotas' next checkpoint)
+        return set([c.pk for c in quotas.reserve_many(reservations, quota_type.RECEIVE)])
+
+    def __send(self, blast, targets):
+        # resolve each backend once per batch, rather than per message
+        backends = {}
+        messages = []
+        for slug, identity in targets:
+            if slug not in backends:
+                backends[slug] = self.router.get_backend(slug)
+            backend = backends[slug]
+            blast.messages += 1
+            if backend is None:
+                blast.failed += 1
+                continue
+            messages.append(Message(Connection(backend, identity), blast.text))
+
+        # the router runs the outgoing phase over the whole batch,
+        # and hands it to each backend at once (via send_many)
+        self.router.outgoing_many(messages)
+        for msg in messages:
+            if msg.delivery_status == DeliveryStatus.SENT:
+                blast.sent += 1
+            elif msg.delivery_status == DeliveryStatus.CANCELLED:
+                blast.cancelled += 1
+            else:
+                blast.failed += 1
+
+    def stats(self):
+        """Returns the stats of the running and recently finished blasts"""
+        with self.lock:
+            return [b.stats() for b in self.running + list(self.history)]
+
+    def __info(self, msg, *args):
+        if self.logger is not None:
+            self.logger.info(msg, *args)
+
+    def __log_last_exception(self, msg):
+        if self.logger is not None:
+            self.logger.log_last_exception(msg)
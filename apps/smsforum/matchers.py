@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4 encoding=utf-8
+
+"""
+Cached BestMatch matchers for the names of villages and contacts,
+which smsforum uses to resolve commands and direct messages.
+
+Rather than being rebuilt from the database for every message, each
+matcher is built the first time it's used, and then kept up to date
+by the post_save and post_delete signals of the models it indexes.
+
+Signals are only sent within the process which changed the object,
+so changes made elsewhere (e.g. via the webui) are picked up when the
+matcher is rebuilt, once it is older than its _max_age_ (in seconds).
+
+"""
+
+from __future__ import with_statement
+import time
+import threading
+from django.db.models.signals import post_save, post_delete
+from rapidsms.parsers.bestmatch import BestMatch
+from apps.smsforum.models import Village, CommunityAlias
+from apps.contacts.models import Contact
+
+MAX_AGE = 300
+
+
+class ModelMatcher(object):
+    """
+    A BestMatch over the objects returned by _objects_ (a callable),
+    which are each matched by the list of names returned by _names_
+    (called with the object). The first name is the target, and the
+    rest are aliases for it.
+
+    """
+    def __init__(self, objects, names, ignore_prefixes=None, max_age=MAX_AGE):
+        self.__objects = objects
+        self.__names = names
+        self.__ignore_prefixes = ignore_prefixes
+        self.max_age = max_age
+        self.__lock = threading.RLock()
+        self.__matcher = None
+        self.__built = 0
+        # pk -> (target, object), and target -> set of pks, since
+        # names aren't unique, and several objects can share a target
+        self.__by_pk = dict()
+        self.__by_target = dict()
+
+    @property
+    def matcher(self):
+        """Returns the BestMatch, (re)building it if needed"""
+        with self.__lock:
+            if self.__matcher is None or \
+                    (self.max_age is not None and \
+                         time.time() - self.__built > self.max_age):
+                self.__build()
+            return self.__matcher
+
+    def match(self, src, **kwargs):
+        return self.matcher.match(src, **kwargs)
+
+    def reset(self):
+        """Discards the matcher, so it's rebuilt the next time it's used"""
+        with self.__lock:
+            self.__matcher = None
+
+    def update(self, obj):
+        """Adds _obj_, or refreshes its names if it's already there"""
+        with self.__lock:
+            if self.__matcher is None:
+                return
+            self.__discard(obj.pk)
+            self.__add(obj)
+
+    def remove(self, obj):
+        with self.__lock:
+            if self.__matcher is None:
+                return
+            self.__discard(obj.pk)
+
+    def __build(self):
+        self.__matcher = BestMatch(ignore_prefixes=self.__ignore_prefixes)
+        self.__by_pk = dict()
+        self.__by_target = dict()
+        for obj in self.__objects():
+            self.__add(obj)
+        self.__built = time.time()
+
+    def __add(self, obj):
+        names = [n.strip() for n in self.__names(obj) if n is not None]
+        if len(names)==0 or len(names[0])==0:
+            return
+        target = names[0]
+        self.__by_pk[obj.pk] = (target, obj)
+        self.__by_target.setdefault(target, set()).add(obj.pk)
+        self.__matcher.add_target((names, obj))
+
+    def __discard(self, pk):
+        if pk not in self.__by_pk:
+            return
+        target, obj = self.__by_pk.pop(pk)
+        pks = self.__by_target[target]
+        pks.discard(pk)
+        if len(pks)==0:
+            del self.__by_target[target]
+            self.__matcher.remove_target(target)
+        else:
+            # another object goes by the same
+            # name, so point the target at it
+            other = self.__by_pk[iter(pks).next()][1]
+            self.__matcher.add_target(([target] + list(self.__names(other)[1:]), other))
+
+
+def _village_names(village):
+    return [village.name] + [a.alias for a in village.aliases.all()]
+
+def _contact_names(contact):
+    return [contact.common_name]
+
+village_matcher = ModelMatcher(
+    Village.objects.all, _village_names, ignore_prefixes=['keur'])
+
+contact_matcher = ModelMatcher(
+    Contact.objects.all, _contact_names)
+
+
+#
+# Signal handlers, to keep the matchers in sync
+#
+
+def _village_saved(sender, instance, **kwargs):
+    village_matcher.update(instance)
+
+def _village_deleted(sender, instance, **kwargs):
+    village_matcher.remove(instance)
+
+def _alias_changed(sender, instance, **kwargs):
+    # aliases belong to communities, which may or may not be villages
+    try:
+        village = Village.objects.get(pk=instance.community_id)
+    except Village.DoesNotExist:
+        return
+    village_matcher.update(village)
+
+def _contact_saved(sender, instance, **kwargs):
+    contact_matcher.update(instance)
+
+def _contact_deleted(sender, instance, **kwargs):
+    contact_matcher.remove(instance)
+
+post_save.connect(_village_saved, sender=Village)
+post_delete.connect(_village_deleted, sender=Village)
+post_save.connect(_alias_changed, sender=CommunityAlias)
+post_delete.connect(_alias_changed, sender=CommunityAlias)
+post_save.connect(_contact_saved, sender=Contact)
+post_delete.connect(_contact_deleted, sender=Contact)
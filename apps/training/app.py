@@ -1,9 +1,7 @@
 import rapidsms
-import threading
 from apps.training.models import *
-from rapidsms.message import Message, StatusCodes
-from rapidsms.connection import Connection
-import time
+from apps.training.moderation import ModerationQueue, SWEEP_INTERVAL
+from rapidsms.message import StatusCodes
 
 class App (rapidsms.app.App):
     '''The training app saves error messages in a queue before they go out
@@ -58,10 +56,10 @@ class App (rapidsms.app.App):
         # were removed in the webui, and delete them
         msg.responses.filter(type="O").delete()
         
-        # mark the incoming message as "handled", so
-        # it will be picked up by the responder_loop
-        msg.status = "H"
-        msg.save()
+        # mark the incoming message as "handled", and
+        # queue its responses to be sent right away
+        msg.set_status("H")
+        self.queue.put(msg.pk)
         
         # TODO: send something more useful
         # back to the browser to confirm
@@ -75,14 +73,21 @@ class App (rapidsms.app.App):
         # Start the Responder Thread -----------------------------------------
         
         self.info("[responder] Starting up...")
-        # interval to check for responding (in seconds)
-        response_interval = 10
-        # start a thread for responding
-        responder_thread = threading.Thread(
-                target=self.responder_loop,
-                args=(response_interval,))
-        responder_thread.daemon = True
-        responder_thread.start()
+        # the moderated messages are sent by the queue's thread as
+        # soon as they're accepted. the sweep catches any which
+        # were marked as handled some other way
+        self.queue = ModerationQueue(self.router, logger=self)
+        self.queue.start()
+        self.router.call_at(SWEEP_INTERVAL, self.sweep_queue)
+    
+    def sweep_queue (self):
+        try:
+            self.queue.sweep()
+        except Exception:
+            self.log_last_exception("Couldn't sweep the moderation queue")
+        
+        # returning the interval reschedules this call
+        return SWEEP_INTERVAL
         
     def parse (self, message):
         """Parse and annotate messages in the parse phase."""
@@ -98,12 +103,13 @@ class App (rapidsms.app.App):
             self.info("Queueing up %s for further handling" % message)
             in_waiting = MessageInWaiting.from_message(message)
             in_waiting.save()
+            StatusChange.record([in_waiting.pk], None, in_waiting.status)
             for response in message.responses:
                 resp_in_waiting = ResponseInWaiting.objects.create(type='O', originator=in_waiting,text=response.text)
             
             # blank out the responses, they will be sent by the responder thread
             # after moderation
-            message.responses = []
+            message.responses.clear()
 
     def outgoing (self, message):
         """Handle outgoing message notifications."""
@@ -111,7 +117,7 @@ class App (rapidsms.app.App):
 
     def stop (self):
         """Perform global app cleanup when the application is stopped."""
-        pass
+        self.queue.stop()
 
     
     def _requires_action(self, message):
@@ -128,36 +134,3 @@ class App (rapidsms.app.App):
             elif response.status == StatusCodes.APP_ERROR or response.status == StatusCodes.GENERIC_ERROR:
                 to_return = True
         return to_return
-    
-    # Responder Thread --------------------
-    def responder_loop(self, seconds=10):
-        self.info("Starting responder...")
-        while True:
-            # look for any new handled messages
-            # in the database, and send the responses
-            for msg_in_waiting in MessageInWaiting.objects.filter(status="H"):
-                self.info("Responding to %s.", msg_in_waiting)
-                for response in msg_in_waiting.responses.all():
-                    self.info("Response: %s.", response)
-                    # only send confirmed or added responses
-                    if response.type != "O":
-                        db_connection = msg_in_waiting.get_connection()
-                        if db_connection is not None:
-		                      db_backend = db_connection.backend
-		                      # we need to get the real backend from the router 
-		                      # to properly send it 
-		                      real_backend = self.router.get_backend(db_backend.slug)
-		                      if real_backend:
-		                          connection = Connection(real_backend, db_connection.identity)
-		                          response_msg = Message(connection, response.text)
-		                          self.router.outgoing(response_msg)
-		                      else:
-		                          # TODO: should we fail harder here?  This will permanently
-		                          # disable responses to this message which is bad.  
-		                          self.error("Can't find backend %s.  Messages will not be sent")
-                # mark the original message as responded to
-                msg_in_waiting.status="R"
-                msg_in_waiting.save()
-            # wait until it's time to check again
-            time.sleep(seconds)
-
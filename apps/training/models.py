@@ -1,9 +1,13 @@
 #!/usr/bin/env python
 # vim: ai ts=4 sts=4 et sw=4
 
-from django.db import models
+from datetime import datetime
+from django.db import models, connection, transaction
 from apps.reporters.models import Reporter, PersistantConnection
 
+# (sqlite allows 999 parameters per statement)
+ROWS_PER_INSERT = 100
+
 # TODO: better name
 class MessageInWaiting(models.Model):
     '''A message in waiting for a response.'''
@@ -11,6 +15,8 @@ class MessageInWaiting(models.Model):
         ('P', 'Pending'), # the message has been received, but not handled
         ('H', 'Handled'), # the message has been handled by the user but not sent
         ('S', 'Sent'), # the message has been sent
+        ('R', 'Responded'), # the responses have been sent
+        ('F', 'Failed'), # the responses couldn't be sent (see the transitions)
     )
     
     # we need either a reporter or a connection to respond
@@ -19,7 +25,8 @@ class MessageInWaiting(models.Model):
     connection = models.ForeignKey(PersistantConnection, null=True, blank=True)
     time = models.DateTimeField()
     incoming_text = models.CharField(max_length=160)
-    status = models.CharField(max_length=1, choices=STATUS_TYPES)
+    # (indexed, since the queue is always filtered by status)
+    status = models.CharField(max_length=1, choices=STATUS_TYPES, db_index=True)
     
     @classmethod
     def from_message(klass, msg):
@@ -32,6 +39,13 @@ class MessageInWaiting(models.Model):
             # or connection, whichever we have
             **msg.persistance_dict)
     
+    def set_status(self, status, note=""):
+        """Saves the message with its new _status_,
+           and logs the change as a StatusChange"""
+        old, self.status = self.status, status
+        self.save()
+        StatusChange.record([self.pk], old, status, note)
+    
     def get_connection(self):
         if self.reporter:
             return self.reporter.connection()
@@ -49,6 +63,43 @@ class MessageInWaiting(models.Model):
 		    "responses":  list(self.responses.all()) }
 
 
+class StatusChange(models.Model):
+    """A log of the changes in status of the MessagesInWaiting,
+       as they're moderated and sent (or fail to be)."""
+    message = models.ForeignKey(MessageInWaiting, related_name="transitions")
+    old_status = models.CharField(max_length=1, blank=True)
+    new_status = models.CharField(max_length=1)
+    time = models.DateTimeField(auto_now_add=True)
+    note = models.CharField(max_length=255, blank=True)
+    
+    @classmethod
+    def record(klass, pks, old_status, new_status, note=""):
+        """Logs the change of the messages _pks_ from _old_status_
+           (which is blank for new messages) to _new_status_, with
+           one INSERT per ROWS_PER_INSERT messages"""
+        pks = list(pks)
+        if not pks:
+            return
+        meta = klass._meta
+        qn = connection.ops.quote_name
+        columns = [qn(meta.get_field(name).column) for name in
+            ("message", "old_status", "new_status", "time", "note")]
+        row_sql = "(%s)" % ", ".join(["%s"] * len(columns))
+        now = connection.ops.value_to_db_datetime(datetime.now())
+        cursor = connection.cursor()
+        for n in range(0, len(pks), ROWS_PER_INSERT):
+            chunk = pks[n:n + ROWS_PER_INSERT]
+            params = []
+            for pk in chunk:
+                params.extend((pk, old_status or "", new_status, now, note[:255]))
+            cursor.execute("INSERT INTO %s (%s) VALUES %s" % (
+                qn(meta.db_table), ", ".join(columns), ", ".join([row_sql] * len(chunk))), params)
+        transaction.commit_unless_managed()
+    
+    def __unicode__(self):
+        return "%s: %s -> %s" % (self.message_id, self.old_status, self.new_status)
+
+
 # TODO: better name    
 class ResponseInWaiting(models.Model):
     
@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4
+
+"""
+The queue of moderated messages, waiting for their responses to be sent.
+
+The responder used to scan the MessagesInWaiting every 10 seconds, and
+send the responses of each "handled" one, one at a time. Instead, when
+a message is accepted (in the training webui), its pk is queued right
+away, and a sender thread wakes up to send it (along with any others
+which are ready, in batches of up to _batch_size_ messages).
+
+If a message's responses can't be sent, it's retried after _backoff_
+seconds, then twice that, and so on, until it's been tried _attempts_
+times, when it's marked as failed ("F"). Responses are marked as "R"
+before they're sent (and put back if they can't be), so a retry never
+sends one twice, even if the update of its message fails.
+Every change of status is logged as a StatusChange.
+
+The database is still the durable copy of the queue: the handled
+messages are queued when the app starts, and any that were handled
+elsewhere (e.g. in the admin) are picked up by sweep().
+
+"""
+
+from __future__ import with_statement
+import time
+import heapq
+import threading
+from django.db import connection as db
+from rapidsms.message import Message
+from rapidsms.connection import Connection
+from models import *
+
+BATCH_SIZE = 20
+ATTEMPTS = 5
+BACKOFF = 5.0 # seconds, doubled after each failure
+SWEEP_INTERVAL = 300 # seconds
+
+
+class ModerationQueue(object):
+    def __init__(self, router, batch_size=BATCH_SIZE, attempts=ATTEMPTS,
+                 backoff=BACKOFF, logger=None):
+        self.router = router
+        self.batch_size = batch_size
+        self.attempts = attempts
+        self.backoff = backoff
+        self.logger = logger
+
+        self.lock = threading.Condition()
+        self.thread = None
+        self.running = False
+
+        # a heap of (when, pk), of the messages to send once
+        # _when_ has passed. and how often each has failed
+        self.waiting = []
+        self.queued = set()
+        self.failures = {}
+        self.sent = 0
+        self.failed = 0
+
+    def __len__(self):
+        return len(self.queued)
+
+    def put(self, pk, delay=0):
+        """Queues the MessageInWaiting _pk_, to have its
+           responses sent in _delay_ seconds (or right away)"""
+        with self.lock:
+            if pk in self.queued:
+                return
+            self.queued.add(pk)
+            heapq.heappush(self.waiting, (time.time() + delay, pk))
+            self.lock.notify()
+
+    def sweep(self):
+        """Queues every handled message which isn't already queued"""
+        pks = MessageInWaiting.objects.filter(status="H").values_list("pk", flat=True)
+        for pk in pks:
+            self.put(pk)
+        return len(pks)
+
+    def start(self):
+        self.sweep()
+        self.running = True
+        self.thread = threading.Thread(target=self.run)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def stop(self):
+        with self.lock:
+            self.running = False
+            self.lock.notify()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def next_batch(self):
+        """Waits for, and returns, the pks of up to _batch_size_ messages
+           which are ready to be sent (or None, once the queue is stopped)"""
+        with self.lock:
+            while self.running:
+                now = time.time()
+                if self.waiting and self.waiting[0][0] <= now:
+                    batch = []
+                    while self.waiting and self.waiting[0][0] <= now \
+                            and len(batch) < self.batch_size:
+                        batch.append(heapq.heappop(self.waiting)[1])
+                    return batch
+                # sleep until the next retry is due, or a message is put
+                if self.waiting:
+                    self.lock.wait(self.waiting[0][0] - now)
+                else:
+                    self.lock.wait()
+            return None
+
+    def run(self):
+        try:
+            while True:
+                batch = self.next_batch()
+                if batch is None:
+                    break
+                try:
+                    self.send_batch(batch)
+                except Exception:
+                    # (the database might be gone). try them all again later
+                    self.__log_last_exception("Couldn't send the moderated responses")
+                    for pk in batch:
+                        self.__failed(pk, "error while sending the batch")
+        finally:
+            # this thread's database connection isn't used again
+            db.close()
+
+    def send_batch(self, pks):
+        """Sends the responses to the (handled) messages _pks_, and
+           returns the pks of those which were completely sent"""
+        messages = MessageInWaiting.objects.filter(pk__in=pks, status="H")\
+            .select_related("reporter", "connection", "connection__backend")
+        responses = {}
+        for resp in ResponseInWaiting.objects.filter(originator__in=pks, type__in=("C", "A")):
+            responses.setdefault(resp.originator_id, []).append(resp)
+
+        # resolve each backend once per batch
+        backends = {}
+        done = []
+        retrying = set()
+        outgoing = []
+        for msg in messages:
+            db_connection = msg.get_connection()
+            if db_connection is None:
+                done.append(msg.pk)
+                continue
+            slug = db_connection.backend.slug
+            if slug not in backends:
+                # we need to get the real backend from the router
+                # to properly send it
+                backends[slug] = self.router.get_backend(slug)
+            backend = backends[slug]
+            if backend is None and responses.get(msg.pk):
+                if self.__failed(msg.pk, "Can't find backend %s" % slug):
+                    retrying.add(msg.pk)
+                continue
+            outgoing.append((msg, backend, db_connection.identity))
+
+        # the responses are marked as sent ("R") before they go out, so
+        # that nothing which fails after sending them (like the UPDATE of
+        # their message) can send them again. those which don't go out
+        # are put back the way they were, to be sent by a retry
+        marked = []
+        for msg, backend, identity in outgoing:
+            marked.extend([resp.pk for resp in responses.get(msg.pk, [])])
+        if marked:
+            ResponseInWaiting.objects.filter(pk__in=marked).update(type="R")
+        unsent = []
+        for msg, backend, identity in outgoing:
+            error = None
+            pending = responses.get(msg.pk, [])
+            while pending:
+                response = pending[0]
+                try:
+                    self.router.outgoing(Message(Connection(backend, identity), response.text))
+                except Exception, e:
+                    self.__log_last_exception("Couldn't send %s" % response)
+                    error = "Couldn't send %s: %r" % (response.pk, e)
+                    break
+                pending = pending[1:]
+
+            if error is None:
+                done.append(msg.pk)
+            else:
+                unsent.extend(pending)
+                if self.__failed(msg.pk, error):
+                    retrying.add(msg.pk)
+
+        for resp_type in ("C", "A"):
+            unsent_pks = [resp.pk for resp in unsent if resp.type == resp_type]
+            if unsent_pks:
+                ResponseInWaiting.objects.filter(pk__in=unsent_pks).update(type=resp_type)
+        if done:
+            MessageInWaiting.objects.filter(pk__in=done).update(status="R")
+            StatusChange.record(done, "H", "R")
+        # (any which weren't still handled are dropped, too)
+        with self.lock:
+            for pk in pks:
+                if pk not in retrying:
+                    self.queued.discard(pk)
+                    self.failures.pop(pk, None)
+            self.sent += len(done)
+        return done
+
+    def __failed(self, pk, error):
+        """Schedules a retry of _pk_, returning True, or marks it as
+           failed (if it's been tried too often), returning False"""
+        with self.lock:
+            attempts = self.failures.get(pk, 0) + 1
+            if attempts < self.attempts:
+                # try again later, backing off each time
+                self.failures[pk] = attempts
+                delay = self.backoff * (2 ** (attempts - 1))
+                heapq.heappush(self.waiting, (time.time() + delay, pk))
+                self.lock.notify()
+                note = "attempt %d failed, retrying in %ds: %s" % (attempts, delay, error)
+                new_status = "H"
+            else:
+                self.failures.pop(pk, None)
+                self.queued.discard(pk)
+                self.failed += 1
+                note = "giving up after %d attempts: %s" % (attempts, error)
+                new_status = "F"
+        try:
+            if new_status == "F":
+                MessageInWaiting.objects.filter(pk=pk).update(status="F")
+            StatusChange.record([pk], "H", new_status, note)
+        except Exception:
+            self.__log_last_exception("Couldn't log the failure of %s" % pk)
+        return new_status == "H"
+
+    def __log_last_exception(self, msg):
+        if self.logger is not None:
+            self.logger.log_last_exception(msg)
+
+    def stats(self):
+        return {
+            "queued":   len(self.queued),
+            "retrying": len(self.failures),
+            "sent":     self.sent,
+            "failed":   self.failed }
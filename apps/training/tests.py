@@ -1,20 +1,86 @@
+from datetime import datetime
 from rapidsms.tests.scripted import TestScript
+from apps.reporters.models import PersistantBackend, PersistantConnection
 from app import App
+from models import *
+from moderation import ModerationQueue
+
+class StubRouter (object):
+    """Records the messages sent by a ModerationQueue, and
+       refuses those whose text is in _failing_"""
+    def __init__(self):
+        self.backend = object()
+        self.sent = []
+        self.failing = set()
+
+    def get_backend(self, slug):
+        if slug == "mock":
+            return self.backend
+
+    def outgoing(self, msg):
+        if msg.text in self.failing:
+            raise IOError("can't send %s" % msg.text)
+        self.sent.append((msg.connection.identity, msg.text))
 
 class TestApp (TestScript):
     apps = (App,)
 
-    # define your test scripts here.
-    # e.g.:
-    #
-    # testRegister = """
-    #   8005551212 > register as someuser
-    #   8005551212 < Registered new user 'someuser' for 8005551212!
-    #   8005551212 > tell anotheruser what's up??
-    #   8005550000 < someuser said "what's up??"
-    # """
-    #
-    # You can also do normal unittest.TestCase methods:
-    #
-    # def testMyModel (self):
-    #   self.assertEquals(...)
+    def _handled(self, identity, *responses):
+        backend, created = PersistantBackend.objects.get_or_create(slug="mock", title="mock")
+        conn, created = PersistantConnection.objects.get_or_create(backend=backend, identity=identity)
+        msg = MessageInWaiting.objects.create(connection=conn, time=datetime.now(),
+            incoming_text="hello", status="H")
+        for text, type in responses:
+            ResponseInWaiting.objects.create(originator=msg, text=text, type=type)
+        return msg
+
+    def testSendBatch(self):
+        router = StubRouter()
+        queue = ModerationQueue(router, backoff=0)
+        a = self._handled("1001", ("one", "C"), ("two", "A"), ("original", "O"))
+        b = self._handled("1002", ("three", "C"), ("four", "A"))
+
+        # the second response to b fails, so only a is done
+        router.failing.add("four")
+        queue.put(a.pk)
+        queue.put(b.pk)
+        self.assertEquals(queue.send_batch([a.pk, b.pk]), [a.pk])
+        self.assertEquals(router.sent, [("1001", "one"), ("1001", "two"), ("1002", "three")])
+        self.assertEquals(MessageInWaiting.objects.get(pk=a.pk).status, "R")
+        self.assertEquals(MessageInWaiting.objects.get(pk=b.pk).status, "H")
+        self.assertEquals(list(b.responses.order_by("pk").values_list("type", flat=True)), ["R", "A"])
+        self.assertEquals(list(a.responses.order_by("pk").values_list("type", flat=True)), ["R", "R", "O"])
+        self.assertEquals(queue.stats()["retrying"], 1)
+
+        # the retry only sends what didn't go out
+        router.failing.clear()
+        self.assertEquals(queue.send_batch([a.pk, b.pk]), [b.pk])
+        self.assertEquals(router.sent[3:], [("1002", "four")])
+        self.assertEquals(MessageInWaiting.objects.get(pk=b.pk).status, "R")
+        self.assertEquals(list(StatusChange.objects.filter(message=b)\
+            .order_by("pk").values_list("new_status", flat=True)), ["H", "R"])
+        self.assertEquals(len(queue), 0)
+
+    def testSendBatchGivesUp(self):
+        router = StubRouter()
+        queue = ModerationQueue(router, attempts=2, backoff=0)
+        msg = self._handled("1003", ("five", "C"))
+        router.failing.add("five")
+        queue.put(msg.pk)
+        for n in range(2):
+            self.assertEquals(queue.send_batch([msg.pk]), [])
+        self.assertEquals(MessageInWaiting.objects.get(pk=msg.pk).status, "F")
+        # the unsent response is left as it was
+        self.assertEquals(msg.responses.get().type, "C")
+        self.assertEquals((len(queue), queue.stats()["failed"]), (0, 1))
+
+    def testSweep(self):
+        queue = ModerationQueue(StubRouter())
+        handled = self._handled("1004", ("six", "C"))
+        pending = self._handled("1005")
+        pending.set_status("P")
+        self.assertEquals(queue.sweep(), 1)
+        self.assertEquals(queue.queued, set([handled.pk]))
+        # messages already queued aren't queued again
+        queue.sweep()
+        self.assertEquals(len(queue.waiting), 1)
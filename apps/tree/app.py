@@ -3,6 +3,7 @@
 
 import rapidsms
 from models import *
+from engine import SessionEngine, Matcher
 from apps.reporters.models import Reporter
 from apps.i18n.utils import get_translation as _
 from apps.i18n.utils import get_language_code 
@@ -13,52 +14,58 @@ class App(rapidsms.app.App):
     session_listeners = {}
     
     def start(self):
-        pass
+        self.engine.start()
     
-    def configure(self, last_message="You are done with this survey.  Thanks for participating!", **kwargs):
+    def stop(self):
+        # write any entries which are still buffered
+        self.engine.stop()
+    
+    def configure(self, last_message="You are done with this survey.  Thanks for participating!",
+                  flush_size=None, flush_interval=None, **kwargs):
         self.last_message = last_message
+        
+        # the sessions, trees and entries (see engine.py)
+        self.engine = SessionEngine(
+            flush_size and int(flush_size), flush_interval and float(flush_interval),
+            logger=self)
     
     def handle(self, msg):
-        # if this caller doesn't have a session attribute,
+        # if this caller doesn't have a session,
         # they're not currently answering a question tree, so
         # just search for triggers and return
-        sessions = Session.objects.all().filter(state__isnull=False)\
-            .filter(connection=msg.persistant_connection)
-        if not sessions:
-            try:
-                tree = Tree.objects.get(trigger=msg.text)
-                # start a new session for this person and save it
-                session = Session(connection=msg.persistant_connection, 
-                                  tree=tree, state=tree.root_state, num_tries=0)
-                session.save()
-                self.debug("session %s saved" % session)
-                
-                # also notify any session listeners of this
-                # so they can do their thing
-                if self.session_listeners.has_key(tree.trigger):
-                    for func in self.session_listeners[tree.trigger]:
-                        func(session, False)
+        session = self.engine.session(msg.persistant_connection)
+        if session is None:
+            tree = self.engine.tree(msg.text)
             
             # no trigger found? no big deal. the
             # message is probably for another app
-            except Tree.DoesNotExist:
+            if tree is None:
                 return False
+            
+            # start a new session for this person and save it
+            session = self.engine.open(msg.persistant_connection, tree)
+            self.debug("session %s saved" % session)
+            
+            # also notify any session listeners of this
+            # so they can do their thing
+            if self.session_listeners.has_key(tree.trigger):
+                for func in self.session_listeners[tree.trigger]:
+                    func(session, False)
         
         # the caller is part-way though a question
         # tree, so check their answer and respond
         else:
-            session = sessions[0]
-            state = session.state
+            state = self.engine.state(session.state_id)
             
             self.debug(state)
             # loop through all transitions starting with  
             # this state and try each one depending on the type
             # this will be a greedy algorithm and NOT safe if 
             # multiple transitions can match the same answer
-            transitions = Transition.objects.filter(current_state=state)
+            transitions = self.engine.transitions_from(state)
             found_transition = None
             for transition in transitions:
-                if self.matches(transition.answer, msg):
+                if transition.matches(msg, self.registered_functions):
                     found_transition = transition
                     break
             
@@ -69,7 +76,6 @@ class App(rapidsms.app.App):
             # not a valid answer, so remind
             # the user of the valid options.
             if not found_transition:
-                transitions = Transition.objects.filter(current_state=state)
                 # there are no defined answers.  therefore there are no more questions to ask 
                 if len(transitions) == 0:
                     # send back some precanned response
@@ -100,47 +106,31 @@ class App(rapidsms.app.App):
                         session.state = None
                         msg.respond(_("Sorry, invalid answer %(retries)s times. Your session will now end. Please try again later.",
                                       get_language_code(session.connection)) % {"retries": session.num_tries })
-                        
-                    session.save()
+                        self.engine.close(session)
+                    else:
+                        self.engine.save_progress(session)
                     return True
             
-            # create an entry for this response
-            # first have to know what sequence number to insert
-            ids = Entry.objects.all().filter(session=session).order_by('sequence_id').values_list('sequence_id', flat=True)
-            if ids:
-                # not sure why pop() isn't allowed...
-                sequence = ids[len(ids) -1] + 1
-            else:
-                sequence = 1
-            entry = Entry(session=session,sequence_id=sequence,transition=found_transition,text=msg.text)
-            entry.save()
-            self.debug("entry %s saved" % entry)
-                
-            # advance to the next question, or remove
-            # this caller's state if there are no more
-            
-            # this might be "None" but that's ok, it will be the 
-            # equivalent of ending the session
-            session.state = found_transition.next_state
-            session.num_tries = 0
-            session.save()
+            # create an entry for this response (which is written
+            # later, in a batch) and advance to the next question,
+            # or remove this caller's state if there are no more
+            self.engine.advance(session, found_transition, msg.text)
             
             # if this was the last message, end the session, 
             # and also check if the tree has a defined 
             # completion text and if so send it
-            if not session.state:
+            if session.state_id is None:
                 self._end_session(session)
                 if session.tree.completion_text:
                     msg.respond(_(session.tree.completion_text, get_language_code(session.connection)))
                 
         # if there is a next question ready to ask
         # (and this includes THE FIRST), send it along
-        sessions = Session.objects.all().filter(state__isnull=False).filter(connection=msg.persistant_connection)
-        if sessions:
-            state = sessions[0].state
+        if session.state_id is not None:
+            state = self.engine.state(session.state_id)
             if state.question:
-                msg.respond(_(state.question.text, get_language_code(sessions[0].connection)))
-                self.info(_(state.question.text, get_language_code(sessions[0].connection)))
+                msg.respond(_(state.question.text, get_language_code(session.connection)))
+                self.info(_(state.question.text, get_language_code(session.connection)))
         
         # if we haven't returned long before now, we're
         # long committed to dealing with this message
@@ -151,7 +141,9 @@ class App(rapidsms.app.App):
            and alerting any session listeners'''
         session.state = None
         session.canceled = canceled
-        session.save()
+        # (this also writes the session's entries, which
+        # the listeners might want to read)
+        self.engine.close(session)
         if self.session_listeners.has_key(session.tree.trigger):
             for func in self.session_listeners[session.tree.trigger]:
                 func(session, True)
@@ -159,8 +151,7 @@ class App(rapidsms.app.App):
     def end_sessions(self, connection):
         ''' Ends all open sessions with this connection.  
             does nothing if there are no open sessions ''' 
-        sessions = Session.objects.filter(connection=connection).exclude(state=None)
-        for session in sessions:
+        for session in self.engine.open_sessions(connection):
             self._end_session(session, True)
             
     def register_custom_transition(self, name, function):
@@ -189,19 +180,5 @@ class App(rapidsms.app.App):
         self.session_listeners[tree_key] = [function]
         
     def matches(self, answer, message):
-        answer_value = message.text
         '''returns True if the answer is a match for this.'''
-        if not answer_value:
-            return False
-        if answer.type == "A":
-            return answer_value.lower() == answer.answer.lower()
-        elif answer.type == "R":
-            return re.match(answer.answer, answer_value, re.IGNORECASE)
-        elif answer.type == "C":
-            if self.registered_functions.has_key(answer.answer):
-                return self.registered_functions[answer.answer](message)
-            else:
-                raise Exception("Can't find a function to match custom key: %s", answer)
-        raise Exception("Don't know how to process answer type: %s", answer.type)
-        
-        
+        return Matcher(answer).matches(message, self.registered_functions)
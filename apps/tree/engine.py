@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4
+
+"""
+The in-memory state of the tree app. Answering a question used to cost
+two queries for the caller's session, one or two for the transitions
+out of their state, and one for every sequence id they'd already
+entered, before writing the Entry and the Session.
+
+The SessionEngine keeps:
+
+  * the trees, by trigger
+  * each state, and the transitions out of it, with their answers
+    compiled into matchers (regexes are compiled once)
+  * the active session of each connection (or the lack of one)
+  * the last sequence id of each active session
+
+so a reply only has to write the Session's progress (one UPDATE).
+The Entries are written in batches by a WriteBehindLog (see
+apps.logger.writer), and always before a session's end is announced
+to the session listeners, which may read them.
+
+The trees are cleared from the cache whenever any part of one is saved
+or deleted (in this process). Sessions are only created and advanced
+by the tree app, so the router must be the only process doing so.
+
+"""
+
+from __future__ import with_statement
+import re
+import threading
+from django.db.models import signals
+from rapidsms.cache import LRUCache
+from apps.logger.writer import WriteBehindLog
+from models import *
+
+# connections whose sessions (or lack of one) are kept in memory
+SESSION_CACHE_SIZE = 5000
+
+# cached for connections which aren't in a session
+_NO_SESSION = object()
+
+
+def _normalize(trigger):
+    return (trigger or "").strip().lower()
+
+
+class Matcher(object):
+    """An Answer, compiled to be matched against messages"""
+
+    def __init__(self, answer):
+        self.answer = answer
+        self.type = answer.type
+        if self.type == "A":
+            self.exact = answer.answer.lower()
+        elif self.type == "R":
+            self.regex = re.compile(answer.answer, re.IGNORECASE)
+
+    def matches(self, message, custom_functions):
+        '''returns True if the message is a match for this answer.'''
+        text = message.text
+        if not text:
+            return False
+        if self.type == "A":
+            return text.lower() == self.exact
+        elif self.type == "R":
+            return self.regex.match(text)
+        elif self.type == "C":
+            if custom_functions.has_key(self.answer.answer):
+                return custom_functions[self.answer.answer](message)
+            else:
+                raise Exception("Can't find a function to match custom key: %s", self.answer)
+        raise Exception("Don't know how to process answer type: %s", self.type)
+
+
+class CompiledTransition(object):
+    """A Transition, with its Answer ready to be matched"""
+
+    def __init__(self, transition):
+        self.transition = transition
+        self.answer = transition.answer
+        self.next_state_id = transition.next_state_id
+        self.matcher = Matcher(transition.answer)
+
+    def matches(self, message, custom_functions):
+        return self.matcher.matches(message, custom_functions)
+
+
+class SessionEngine(object):
+    def __init__(self, flush_size=None, flush_interval=None, logger=None):
+        self.lock = threading.RLock()
+        self.logger = logger
+        writer_args = {}
+        if flush_size is not None:
+            writer_args["flush_size"] = flush_size
+        if flush_interval is not None:
+            writer_args["flush_interval"] = flush_interval
+        self.entries = WriteBehindLog(logger=logger, **writer_args)
+
+        # trigger -> Tree, or None until they're loaded
+        self.trees = None
+        # state pk -> TreeState, and -> [CompiledTransition]
+        self.states = {}
+        self.transitions = {}
+        # connection pk -> Session (or _NO_SESSION)
+        self.sessions = LRUCache(SESSION_CACHE_SIZE)
+        # session pk -> the last sequence id used. (sessions which are
+        # abandoned are never closed, so these are forgotten in time,
+        # and looked up again if they're ever needed)
+        self.sequences = LRUCache(SESSION_CACHE_SIZE)
+
+        for model in (Tree, TreeState, Transition, Answer, Question):
+            signals.post_save.connect(self.tree_changed, sender=model)
+            signals.post_delete.connect(self.tree_changed, sender=model)
+        signals.post_save.connect(self.session_changed, sender=Session)
+        signals.post_delete.connect(self.session_changed, sender=Session)
+
+    def start(self):
+        if self.entries.thread is None:
+            self.entries.start()
+
+    def stop(self):
+        self.entries.stop()
+
+    # the trees
+
+    def tree(self, trigger):
+        """Returns the Tree triggered by _trigger_, or None. Like the
+           database's lookup was, this ignores case and surrounding
+           whitespace."""
+        with self.lock:
+            if self.trees is None:
+                self.trees = {}
+                for tree in Tree.objects.all():
+                    self.trees.setdefault(_normalize(tree.trigger), tree)
+            return self.trees.get(_normalize(trigger))
+
+    def state(self, pk):
+        """Returns the TreeState _pk_ (with its question), or None"""
+        if pk is None:
+            return None
+        with self.lock:
+            state = self.states.get(pk)
+            if state is None:
+                state = TreeState.objects.select_related("question").get(pk=pk)
+                self.states[pk] = state
+            return state
+
+    def transitions_from(self, state):
+        """Returns the CompiledTransitions out of _state_, in order"""
+        with self.lock:
+            compiled = self.transitions.get(state.pk)
+            if compiled is None:
+                compiled = [CompiledTransition(t) for t in
+                    Transition.objects.filter(current_state=state).select_related("answer")]
+                self.transitions[state.pk] = compiled
+            return compiled
+
+    def tree_changed(self, sender, **kwargs):
+        # trees are rarely edited, so forget them all
+        with self.lock:
+            self.trees = None
+            self.states = {}
+            self.transitions = {}
+
+    # the sessions
+
+    def session(self, connection):
+        """Returns the active Session of _connection_, or None"""
+        key = connection and connection.pk
+        with self.lock:
+            session = self.sessions.get(key)
+            if session is None:
+                sessions = Session.objects.filter(state__isnull=False)\
+                    .filter(connection=connection)[:1]
+                session = sessions and sessions[0] or _NO_SESSION
+                self.sessions.put(key, session)
+            if session is _NO_SESSION:
+                return None
+            return session
+
+    def open(self, connection, tree):
+        """Starts and returns a new Session of _tree_ for _connection_"""
+        session = Session(connection=connection, tree=tree,
+                          state=self.state(tree.root_state_id), num_tries=0)
+        session.save()
+        with self.lock:
+            self.sessions.put(connection and connection.pk, session)
+            self.sequences.put(session.pk, 0)
+        return session
+
+    def advance(self, session, transition, text):
+        """Records _text_ as the answer to _session_'s current question,
+           by _transition_, and moves it to the next state"""
+        with self.lock:
+            sequence = self.sequences.get(session.pk)
+            if sequence is None:
+                sequence = self.__last_sequence(session)
+            sequence += 1
+            self.sequences.put(session.pk, sequence)
+            self.entries.create(Entry, session=session, sequence_id=sequence,
+                                transition=transition.transition, text=text)
+
+            # this might be "None" but that's ok, it will be the
+            # equivalent of ending the session (which saves it)
+            session.state = self.state(transition.next_state_id)
+            session.num_tries = 0
+            if session.state_id is not None:
+                self.save_progress(session)
+
+    def save_progress(self, session):
+        """Writes _session_'s state and tries, with one UPDATE"""
+        # (and without the signals, which would be no use)
+        Session.objects.filter(pk=session.pk).update(
+            state=session.state_id, num_tries=session.num_tries)
+
+    def close(self, session):
+        """Writes the end of _session_, after all of its Entries. If they
+           can't be written right now, they're kept to be retried (see
+           apps.logger.writer), and the session is ended anyway"""
+        try:
+            self.entries.flush()
+        except Exception:
+            self.__log_last_exception("Couldn't write the entries of %s" % session)
+        with self.lock:
+            session.save()
+            self.sequences.pop(session.pk)
+            key = session.connection_id
+            if self.sessions.get(key, count=False) is session:
+                self.sessions.put(key, _NO_SESSION)
+
+    def open_sessions(self, connection):
+        """Returns all of the active Sessions of _connection_"""
+        with self.lock:
+            cached = self.session(connection)
+            sessions = []
+            for session in Session.objects.filter(connection=connection).exclude(state=None):
+                # use the cached instance, which may be further along
+                if cached is not None and session.pk == cached.pk:
+                    session = cached
+                sessions.append(session)
+            return sessions
+
+    def session_changed(self, sender, instance, **kwargs):
+        # a session was saved or deleted elsewhere, so the
+        # connection's will be looked up again when it's needed
+        with self.lock:
+            key = instance.connection_id
+            if self.sessions.get(key, count=False) is not instance:
+                self.sessions.pop(key)
+
+    def __log_last_exception(self, msg):
+        if self.logger is not None:
+            self.logger.log_last_exception(msg)
+
+    def __last_sequence(self, session):
+        ids = Entry.objects.filter(session=session).order_by("-sequence_id")\
+            .values_list("sequence_id", flat=True)[:1]
+        return ids and ids[0] or 0
+
+    def stats(self):
+        return {
+            "trees":       self.trees is not None and len(self.trees) or 0,
+            "states":      len(self.states),
+            "sessions":    self.sessions.stats(),
+            "sequences":   len(self.sequences),
+            "entries":     self.entries.stats() }
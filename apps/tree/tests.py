@@ -4,6 +4,7 @@ import apps.reporters.app as reporters_app
 import apps.i18n.app as i18n_app
 
 from models import *
+from engine import SessionEngine
 from apps.reporters.models import Reporter, PersistantConnection, PersistantBackend
     
 class TestApp (TestScript):
@@ -17,6 +18,12 @@ class TestApp (TestScript):
            8005551212 < hello
          """        
     
+    # triggers ignore case and surrounding whitespace
+    testTriggerCase = """
+           8005551214 > TEST
+           8005551214 < hello
+         """
+
     testPin = """
            8005551211 > pin
            8005551211 < Please enter your 4-digit PIN
@@ -41,6 +48,42 @@ class TestApp (TestScript):
            8005551213 < Thanks for entering.
          """
          
+    def testEngineTrees(self):
+        engine = SessionEngine()
+        self.assertEquals(engine.tree("test").trigger, "test")
+        self.assertEquals(engine.tree(" Test "), engine.tree("test"))
+        self.assertEquals(engine.tree("nonesuch"), None)
+
+        # saving any part of a tree forgets the cached trees
+        tree = Tree.objects.create(trigger="Nonesuch")
+        self.assertEquals(engine.tree("nonesuch"), tree)
+        tree.delete()
+        self.assertEquals(engine.tree("nonesuch"), None)
+
+    def testEngineCloseKeepsEntries(self):
+        engine = SessionEngine()
+        backend = PersistantBackend.objects.all()[0]
+        conn = PersistantConnection.objects.create(backend=backend, identity="8005559999")
+        session = engine.open(conn, engine.tree("test"))
+        transition = engine.transitions_from(engine.state(session.state_id))[0]
+        engine.advance(session, transition, "an answer")
+
+        # the session is ended even if its entries can't be written
+        def fail(records):
+            raise IOError("the database is down")
+        engine.entries._WriteBehindLog__write = fail
+        session.state = None
+        engine.close(session)
+        self.assertEquals(Session.objects.get(pk=session.pk).state, None)
+        self.assertEquals(Entry.objects.filter(session=session).count(), 0)
+
+        # and they're written by the next flush
+        del engine.entries._WriteBehindLog__write
+        self.assertEquals(engine.entries.flush(), 1)
+        self.assertEquals(list(Entry.objects.filter(session=session)
+            .values_list("sequence_id", flat=True)), [1])
+        self.assertEquals(engine.stats()["sequences"], 0)
+
     def testLocalization(self):
         '''Tests very basic localization of trees'''
         reporter = self._register('0004', 'en', "loc_en")
@@ -15,6 +15,10 @@ class DeviceWrapper(object):
         self.device = serial.Serial(*args, **kwargs)
         self.logger = logger
 
+        # bytes of a line which was only partially read when
+        # poll_line timed out, to be prepended to the next read
+        self._partial = []
+
     def isOpen(self):
         return self.device.isOpen()
 
@@ -23,12 +27,31 @@ class DeviceWrapper(object):
     
     def write(self, str):
         self.device.write(str)
+
+    def in_waiting(self):
+        """Returns the number of bytes waiting to be read, without
+           blocking. This doesn't need the modem lock."""
+        return self.device.inWaiting()
+
+    def poll_line(self, read_timeout):
+        """Reads a single line of (probably unsolicited) data from the modem,
+           and returns it stripped, or None if a whole line doesn't arrive
+           within _read_timeout_ seconds. Unlike _read, a partial line is
+           not lost; it is prepended to the next read."""
+        try:
+            return self._read(read_timeout=read_timeout).strip()
+        except errors.GsmReadTimeoutError, err:
+            # the last item in the pending data is the
+            # empty string that indicated the timeout
+            self._partial = err.pending_data[:-1]
+            return None
             
     def _read(self, read_term=None, read_timeout=None):
         """Read from the modem (blocking) until _terminator_ is hit,
            (defaults to \r\n, which reads a single "line"), and return."""
         
-        buffer = []
+        buffer = self._partial
+        self._partial = []
 
         # if a different timeout was requested just
         # for _this_ read, store and override the
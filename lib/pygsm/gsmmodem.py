@@ -8,6 +8,7 @@ from __future__ import with_statement
 
 import re
 import time
+import Queue
 import errors
 import threading
 import gsmcodecs
@@ -72,6 +73,17 @@ class GsmModem(object):
     retry_delay = 2
     max_retries = 10
     modem_lock = threading.RLock()
+
+    # new message indications. the default (mt=2) asks the modem
+    # to push incoming messages straight to us as +CMT, but many
+    # modems only support mt=1 (store, and notify with +CMTI)
+    cnmi = "2,2,0,0,0"
+
+    # how often the reader thread (see start_reader) checks the
+    # serial line for unsolicited data, and how often it sweeps
+    # the modem storage for messages that it wasn't told about
+    reader_interval = 0.05
+    sweep_interval = 30
     
     
     def __init__(self, *args, **kwargs):
@@ -88,6 +100,10 @@ class GsmModem(object):
 
         if "logger" in kwargs:
             self.logger = kwargs.pop("logger")
+
+        # each modem gets its own lock (rather than sharing the class
+        # attribute), so several modems can be driven at the same time
+        self.modem_lock = threading.RLock()
         
         mode = "PDU"
         if "mode" in kwargs:
@@ -115,7 +131,12 @@ class GsmModem(object):
         self.multipart = {}
 
         # to store unhandled incoming messages
-        self.incoming_queue = []
+        self.incoming_queue = Queue.Queue()
+
+        # set when a +CMTI notification tells us that a message
+        # has been stored, so it can be fetched with AT+CMGL
+        self._fetch_pending = False
+        self.reader = None
         
         if mode.lower() == "text":
             self.smshandler = TextSmsHandler(self)
@@ -191,6 +212,7 @@ class GsmModem(object):
         """Disconnects from the modem."""
         
         self._log("Disconnecting")
+        self.stop_reader()
         
         # attempt to close and destroy the device
         if hasattr(self, "device") and (self.device is None):
@@ -221,7 +243,7 @@ class GsmModem(object):
 
         # enable new message notification
         self.command(
-            "AT+CNMI=2,2,0,0,0",
+            "AT+CNMI=%s" % self.cnmi,
             raise_errors=False)
 
 
@@ -286,6 +308,14 @@ class GsmModem(object):
         # which is hard work for iterators)
         while n < len(lines):
 
+            # a +CMTI notification means that a message was
+            # stored rather than delivered directly. make a
+            # note to fetch it, and drop the notification
+            if lines[n][0:6] == "+CMTI:":
+                self._fetch_pending = True
+                n += 1
+                continue
+
             # not a CMT string? add it back into the
             # output (since we're not interested in it)
             # and move on to the next
@@ -315,7 +345,7 @@ class GsmModem(object):
 
             msg = self.smshandler.parse_incoming_message(lines[n], msg_line)
             if msg is not None:
-                self.incoming_queue.append(msg)
+                self.incoming_queue.put(msg)
 
             # jump over the CMT line, and the
             # pdu line, and continue iterating
@@ -446,6 +476,8 @@ class GsmModem(object):
         If max_messages < 1 it is forced to 1
 
         Raises 'ValueError' if text will not fit in max_messages
+
+        Returns True if the modem accepted the message
         
         NOTE: Only PDU mode respects max_messages! It has no effect in TEXT mode
 
@@ -463,7 +495,32 @@ class GsmModem(object):
             mm = 1
         
         with self.modem_lock:
-            self.smshandler.send_sms(recipient, text, mm)
+            return self.smshandler.send_sms(recipient, text, mm)
+
+    def send_sms_many(self, recipients, text, max_messages = 255):
+        """
+        Sends _text_ to each of _recipients_ (as send_sms does).
+        In PDU mode, the text is only encoded (and split) once,
+        rather than once per recipient.
+
+        Raises 'ValueError' if text will not fit in max_messages
+
+        Returns a dict mapping each recipient to True if the
+        modem accepted their message
+        """
+        mm = 255
+        try:
+            mm = int(max_messages)
+        except:
+            pass
+        
+        if mm > 255:
+            mm = 255
+        elif mm < 1:
+            mm = 1
+
+        # the handler locks the modem for each recipient
+        return self.smshandler.send_sms_many(recipients, text, mm)
 
     def break_out_of_prompt(self):
         self._write(chr(27))
@@ -541,19 +598,104 @@ class GsmModem(object):
         Return number fetched
         
         """    
+        self._fetch_pending = False
         lines = self.command('AT+CMGL=%s' % self.smshandler.CMGL_STATUS)
         lines = self._strip_ok(lines)
         messages = self.smshandler.parse_stored_messages(lines)
         for msg in messages:
-            self.incoming_queue.append(msg)
+            self.incoming_queue.put(msg)
+        return len(messages)
 
-    def next_message(self, ping=True, fetch=True):
+
+    def start_reader(self, sweep_interval=None):
+        """Starts a thread which watches the serial line for unsolicited
+           new message indications (+CMT and +CMTI, as configured by
+           GsmModem.cnmi), and queues incoming messages as soon as they
+           arrive. The modem storage is also swept for unread messages
+           every _sweep_interval_ seconds, in case any notifications were
+           missed. While the reader is running, call next_message with
+           ping=False and fetch=False, since there is no need to poll."""
+
+        if sweep_interval is not None:
+            self.sweep_interval = sweep_interval
+
+        if self.reader is None:
+            self._reading = True
+            self.reader = threading.Thread(target=self._reader_loop)
+            self.reader.setDaemon(True)
+            self.reader.start()
+
+
+    def stop_reader(self):
+        """Stops the thread started by start_reader, if it is running."""
+
+        if self.reader is not None:
+            self._reading = False
+            if self.reader is not threading.currentThread():
+                self.reader.join(5.0)
+            self.reader = None
+
+
+    def _reader_loop(self):
+        next_sweep = time.time() + self.sweep_interval
+
+        while self._reading:
+            try:
+                # only take the modem lock if there's something to
+                # read, so we don't hold up any threads sending sms
+                if self.device.in_waiting():
+                    with self.modem_lock:
+                        while self.device.in_waiting():
+                            line = self.device.poll_line(self.reader_interval)
+                            if line is None:
+                                break
+                            self._handle_unsolicited(line)
+
+                # fetch messages announced by +CMTI (whether we saw
+                # it here, or in the response to another command),
+                # or sweep the storage if it's been a while
+                if self._fetch_pending or time.time() >= next_sweep:
+                    next_sweep = time.time() + self.sweep_interval
+                    self._fetch_stored_messages()
+
+            except errors.GsmError, err:
+                self._log("Error in reader thread: %r" % err, "warn")
+
+            time.sleep(self.reader_interval)
+
+
+    def _handle_unsolicited(self, line):
+        """Handles a single line of unsolicited data read by the reader
+           thread. The modem lock must be held."""
+
+        if line == "":
+            return
+
+        if line[0:6] == "+CMTI:":
+            self._fetch_pending = True
+
+        # the message (pdu or text) follows +CMT on the next line.
+        # _parse_incoming_sms takes care of acknowledging it
+        elif line[0:5] == "+CMT:":
+            body = self.device.poll_line(1.0)
+            if body is None:
+                self._log("Timed out waiting for the body of %r" % line, "warn")
+            else:
+                self._parse_incoming_sms([line, body])
+
+        else:
+            self._log("Ignoring unsolicited: %r" % line)
+
+
+    def next_message(self, ping=True, fetch=True, timeout=None):
         """Returns the next waiting IncomingMessage object, or None if the
            queue is empty. The optional _ping_ and _fetch_ parameters control
            whether the modem is pinged (to allow new messages to be delivered
            instantly, on those modems which support it) and queried for unread
            messages in storage, which can both be disabled in case you're
-           already polling in a separate thread."""
+           already polling in a separate thread (see start_reader). If a
+           _timeout_ is given, block for up to that many seconds waiting
+           for a message to arrive."""
 
         # optionally ping the modem, to give it a
         # chance to deliver any waiting messages
@@ -566,14 +708,13 @@ class GsmModem(object):
         if fetch:
             self._fetch_stored_messages()
 
-        # abort if there are no messages waiting
-        if not self.incoming_queue:
+        # remove the message that has been waiting longest from the
+        # queue, and return it. or None, if there aren't any
+        try:
+            return self.incoming_queue.get(bool(timeout), timeout)
+        except Queue.Empty:
             return None
 
-        # remove the message that has been waiting
-        # longest from the queue, and return it
-        return self.incoming_queue.pop(0)
-
 
 if __name__ == "__main__":
 
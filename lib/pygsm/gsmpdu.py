@@ -8,6 +8,7 @@ import re, datetime
 import math
 import pytz
 import codecs
+import binascii
 import gsmcodecs
 import threading
 
@@ -35,6 +36,54 @@ def get_outbound_pdus(text, recipient):
     If the message goes beyond the max length for a CSM
     (it's gotta be _REALLY BIG_), this will raise a 'ValueError'
 
+    """
+    return get_outbound_pdus_many(text, [recipient])[recipient]
+
+
+def get_outbound_pdus_many(text, recipients):
+    """
+    Returns a dict mapping each of _recipients_ to the list
+    of PDUs needed to send them _text_ (see get_outbound_pdus).
+
+    The text is encoded (and, for concatenated messages,
+    split and packed into user data) just once, and shared
+    by all of the recipients' PDUs, so this is much faster
+    than calling get_outbound_pdus for each recipient.
+
+    """
+    encoding, segments = _split_segments(text)
+
+    pdus = {}
+    for recipient in recipients:
+        if len(segments) == 1:
+            pdus[recipient] = [segments[0].for_recipient(recipient)]
+            continue
+
+        csm_ref = _next_csm_ref(recipient)
+        pdus[recipient] = [
+            seg.for_recipient(recipient, csm_ref)
+            for seg in segments]
+
+    return pdus
+
+
+def _next_csm_ref(recipient):
+    # get our ref
+    with __ref_lock:
+        if recipient not in __csm_refs:
+            __csm_refs[recipient]=0
+        csm_ref = __csm_refs[recipient] % 256
+        __csm_refs[recipient]+=1
+    return csm_ref
+
+
+def _split_segments(text):
+    """
+    Returns a tuple of (encoding, [OutboundGsmPdu...]), where the
+    PDUs have no recipient, and serve as templates for the real
+    PDUs (see OutboundGsmPdu.for_recipient). Their user data is
+    encoded on demand, and then shared by all of the copies.
+
     """
 
     # first figure out the encoding
@@ -53,19 +102,12 @@ def get_outbound_pdus(text, recipient):
 
     # see if we are under the single PDU limit
     if len(encoded_text)<=MSG_LIMITS[encoding][0]:
-        return [OutboundGsmPdu(text, recipient)]
+        return (encoding, [OutboundGsmPdu(text, None,
+            gsm_text=(encoded_text if encoding=='gsm' else None))])
 
     # ok, we are a CSM, so lets figure out
-    # the parts
-    
-    # get our ref
-    with __ref_lock:
-        if recipient not in __csm_refs:
-            __csm_refs[recipient]=0
-        csm_ref = __csm_refs[recipient] % 256
-        __csm_refs[recipient]+=1
-
-    # make the PDUs
+    # the parts. the ref is filled in later,
+    # since it's different for each recipient
     num = int(math.ceil(len(encoded_text)/float(MSG_LIMITS[encoding][0])))
     pdus=[]
     for seq in range(num):
@@ -73,19 +115,20 @@ def get_outbound_pdus(text, recipient):
         seg_txt = encoded_text[i:i+csm_max]
         if encoding=='gsm':
             # a little silly to encode, decode, then have PDU
-            # re-encode but keeps PDU API clean
+            # re-encode but keeps PDU API clean (and it's only
+            # done once per segment, not once per recipient)
             seg_txt = seg_txt.decode('gsm')
         pdus.append(
             OutboundGsmPdu(
                 seg_txt,
-                recipient,
-                csm_ref=csm_ref,
+                None,
+                csm_ref=0,
                 csm_seq=seq+1,
                 csm_total=num
                 )
             )
 
-    return pdus
+    return (encoding, pdus)
 
 
 class SmsParseException(Exception):
@@ -129,28 +172,36 @@ class OutboundGsmPdu(GsmPdu):
 
     """
     
-    def __init__(self, text, recipient, csm_ref=None, csm_seq=None, csm_total=None):
+    def __init__(self, text, recipient, csm_ref=None, csm_seq=None, csm_total=None, gsm_text=None):
         GsmPdu.__init__(self)
 
         self.address = recipient
         self.text = text
-        self.gsm_text = None # if we are gsm, put the gsm encoded str here
+        self.gsm_text = gsm_text # if we are gsm, put the gsm encoded str here
         self.is_csm = csm_ref is not None
         self.csm_ref = ( None if csm_ref is None else int(csm_ref) )
         self.csm_seq = ( None if csm_seq is None else int(csm_seq) )
         self.csm_total = ( None if csm_total is None else int(csm_total) )
+
+        # the hex-encoded user data (excluding the header), which is
+        # built on demand, and shared with copies (see for_recipient)
+        self._user_data = None
         
-        try:
-            # following does two things:
-            # 1. Raises exception if text cannot be encoded GSM
-            # 2. measures the number of chars after encoding
-            #    since GSM is partially multi-byte, a string
-            #    in GSM can be longer than the obvious num of chars
-            #    e.g. 'hello' is 5 but 'hello^' is _7_
-            self.gsm_text=self.text.encode('gsm')
+        if self.gsm_text is not None:
+            # the caller already encoded the text
             num_chars=len(self.gsm_text)
-        except:
-            num_chars=len(self.text)
+        else:
+            try:
+                # following does two things:
+                # 1. Raises exception if text cannot be encoded GSM
+                # 2. measures the number of chars after encoding
+                #    since GSM is partially multi-byte, a string
+                #    in GSM can be longer than the obvious num of chars
+                #    e.g. 'hello' is 5 but 'hello^' is _7_
+                self.gsm_text=self.text.encode('gsm')
+                num_chars=len(self.gsm_text)
+            except:
+                num_chars=len(self.text)
 
         if self.is_csm:
             max = MSG_LIMITS[self.encoding][1]
@@ -171,6 +222,46 @@ class OutboundGsmPdu(GsmPdu):
     @property
     def is_ucs2(self):
         return not self.is_gsm
+
+    def for_recipient(self, recipient, csm_ref=None):
+        """
+        Returns a copy of this PDU addressed to _recipient_ (with
+        _csm_ref_, if it's part of a CSM), sharing the encoded
+        user data, so it isn't packed again for every recipient.
+
+        """
+        pdu = OutboundGsmPdu.__new__(OutboundGsmPdu)
+        pdu.__dict__.update(self.__dict__)
+        pdu.address = recipient
+        if self.is_csm:
+            pdu.csm_ref = int(csm_ref)
+
+        # encode the user data now, so that it's
+        # cached here (for the next copy) too
+        pdu._user_data = self.user_data
+        return pdu
+
+    @property
+    def user_data(self):
+        """
+        The hex-encoded text of this PDU (excluding the user data
+        header), which is the same for every recipient.
+
+        """
+        if self._user_data is None:
+            # if we are a CSM and GSM, need to pad the data. padding is
+            # number of bits to pad-out beyond the header to make
+            # everything land on a '7-bit' boundary rather than 8-bit.
+            # Can calculate as 7 - (UDH*8 % 7), but the UDH is always
+            # 48, so padding is always 1
+            padding = ( 1 if self.is_csm and self.is_gsm else 0 )
+            encoded_sm = ( 
+                _pack_septets(self.gsm_text, padding=padding)
+                if self.is_gsm 
+                else self.text.encode('utf_16_be') 
+                )
+            self._user_data = binascii.hexlify(encoded_sm).upper()
+        return self._user_data
         
     def __get_pdu_string(self):
         # now put the PDU string together
@@ -210,7 +301,7 @@ class OutboundGsmPdu(GsmPdu):
         # Complications:
         # 1. If we are a CSM, need the CSM header
         # 2. If we are a CSM and GSM, need to pad the data
-        padding = 0
+        #    (which is taken care of by self.user_data)
         udh=''
         if self.is_csm:
             # data header always starts the same:
@@ -218,22 +309,9 @@ class OutboundGsmPdu(GsmPdu):
             # type: CSM '00'
             # length of CSM info, 3 octets '03'
             udh='050003%02X%02X%02X' % (self.csm_ref, self.csm_total, self.csm_seq)
-
-            if self.is_gsm:
-                # padding is number of pits to pad-out beyond
-                # the header to make everything land on a '7-bit' 
-                # boundary rather than 8-bit.
-                # Can calculate as 7 - (UDH*8 % 7), but the UDH
-                # is always 48, so padding is always 1
-                padding = 1
                 
         # now encode contents
-        encoded_sm = ( 
-            _pack_septets(self.gsm_text, padding=padding)
-            if self.is_gsm 
-            else self.text.encode('utf_16_be') 
-            )
-        encoded_sm = encoded_sm.encode('hex').upper()
+        encoded_sm = self.user_data
 
         # and get the data length which is in septets
         # if GSM, and octets otherwise
@@ -295,17 +373,17 @@ class ReceivedGsmPdu(GsmPdu):
     """
 
     def __parse_pdu(self):
-        pdu=self.pdu_string # make copy
+        pdu=_PduReader(self.pdu_string)
         
         # grab smsc header, and throw away
         # length is held in first octet
-        smsc_len,pdu=_consume_one_int(pdu)
+        smsc_len=pdu.octet()
 
         # consume smsc header
-        c,pdu=_consume(pdu, smsc_len)
+        pdu.take(smsc_len)
 
         # grab the deliver octect
-        deliver_attrs,pdu=_consume_one_int(pdu)
+        deliver_attrs=pdu.octet()
 
         if deliver_attrs & 0x03 != 0:
             raise SmsParseException("Not a SMS-DELIVER, we ignore")
@@ -316,38 +394,38 @@ class ReceivedGsmPdu(GsmPdu):
         # get the sender number. 
         # First the length which is given in 'nibbles' (half octets)
         # so divide by 2 and round up for odd
-        sender_dec_len,pdu=_consume_one_int(pdu)
-        sender_len=int(math.ceil(sender_dec_len/2.0))
+        sender_dec_len=pdu.octet()
+        sender_len=(sender_dec_len+1)/2
         
         # next is sender id type
-        sender_type,pdu=_consume(pdu,1)
+        sender_type=pdu.take(1)
 
         # now the number itself, (unparsed)
-        num,pdu=_consume(pdu,sender_len)
+        num=pdu.take(sender_len)
 
         # now parse the number
         self.address=_parse_phone_num(sender_type,num)
 
         # now the protocol id
         # we only understand SMS (0)
-        tp_pid,pdu=_consume_one_int(pdu)
+        tp_pid=pdu.octet()
         if tp_pid >= 32:
             # can't deal
             print "TP PID: %s" % tp_pid
             raise SmsParseException("Not SMS protocol, bailing")
 
         # get and interpet DCS (char encoding info)
-        self.encoding,pdu=_consume(pdu,1,_read_dcs)
+        self.encoding=_read_dcs(pdu.take(1))
         if self.encoding not in ['gsm','ucs2']:
             raise SmsParseException("Don't understand short message encoding")
 
         #get and interpret timestamp
-        self.sent_ts,pdu=_consume(pdu,7,_read_ts)
+        self.sent_ts=_read_ts(pdu.take(7))
 
         # ok, how long is ud? 
         # note, if encoding is GSM this is num 7-bit septets
         # if ucs2, it's num bytes
-        udl,pdu=_consume_one_int(pdu)
+        udl=pdu.octet()
 
         # Now to deal with the User Data header!
         if tp_udhi:
@@ -358,23 +436,25 @@ class ReceivedGsmPdu(GsmPdu):
             # in fact this is the _only_ case we care about
             
             # get the header length
-            udhl,pdu=_consume_decimal(pdu)
+            udhl=pdu.decimal()
             
             # now loop through consuming the header
             # and looking to see if we are a csm
             i=0
             while i<udhl:
                 # get info about the element
-                ie_type,pdu=_consume_one_int(pdu)
-                ie_l,pdu=_consume_decimal(pdu) 
-                ie_d,pdu=_consume(pdu,ie_l)
+                ie_type=pdu.octet()
+                ie_l=pdu.decimal()
+                ie_d=pdu.take(ie_l)
                 i+=(ie_l+2) # move index up for all bytes read
                 if ie_type == 0x00:
                     # got csm info!
                     self.is_csm=True
-                    (ref,self.csm_total,self.csm_seq),r=_consume_bytes(ie_d,3)
+                    ref,self.csm_total,self.csm_seq=[
+                        int(ie_d[n:n+2],16) for n in (0,2,4)]
                     self.csm_ref=ref % 256 # the definition is 'modulo 256'
         # ok, done with header
+        ud=pdu.rest()
 
         # now see if we are gsm, in which case we need to unpack bits
         if self.encoding=='gsm':
@@ -389,7 +469,7 @@ class ReceivedGsmPdu(GsmPdu):
 
             # now decode
             try:
-                self.text=_unpack_septets(pdu, padding).decode('gsm')
+                self.text=_unpack_septets(ud, padding).decode('gsm')
             except Exception, ex:
                 # we have bogus data! But don't die
                 # as we are used deeply embedded
@@ -402,12 +482,12 @@ class ReceivedGsmPdu(GsmPdu):
             # popular Nokia's _don't_, in which case it
             # seems they use big-endian...
         
-            bom=pdu[0:4]
+            bom=ud[0:4]
             decoded_text = ''
-            if bom==codecs.BOM_UTF16_LE.encode('hex'):
-                decoded_text=pdu[4:].decode('hex').decode('utf_16_le')
+            if bom==_BOM_UTF16_LE_HEX:
+                decoded_text=binascii.unhexlify(ud[4:]).decode('utf_16_le')
             else:
-                decoded_text=pdu.decode('hex').decode('utf_16_be')
+                decoded_text=binascii.unhexlify(ud).decode('utf_16_be')
             self.text=decoded_text
         # some phones add a leading <cr> so strip it
         self.text=self.text.strip()
@@ -439,63 +519,50 @@ def _B(slot):
     """Convert slot to Byte boundary"""
     return slot*2
 
-def _consume(seq, num,func=None):
-    """
-    Consume the num of BYTES
-
-    return a tuple of (consumed,remainder)
+_BOM_UTF16_LE_HEX = binascii.hexlify(codecs.BOM_UTF16_LE)
 
-    func -- a function to call on the consumed. Result in tuple[0]
-    
-    """
-    num=_B(num)
-    c=seq[:num]
-    r=seq[num:]
-    if func:
-        c=func(c)
-    return (c,r)
-
-def _consume_decimal(seq):
-    """read 2 chars as a decimal"""
-    return (int(seq[0:2],10),seq[2:])
-
-def _consume_one_int(seq):
-    """
-    Consumes one byte and returns int and remainder
-    (int, remainder_of_seq)
-    
-    """
-    
-    ints,remainder = _consume_bytes(seq,1)
-    return (ints[0],remainder)
-    
-def _consume_bytes(seq,num=1):
+class _PduReader(object):
     """
-    consumes bytes for num ints (e.g. 2-chars per byte)
-    coverts to int, returns tuple of  ([byte...], remainder)
-       
+    Reads fields from the front of a hex-encoded PDU string. It
+    keeps track of an offset, rather than slicing the remainder
+    of the string after every field.
+
     """
-    
-    bytes=[]
-    for i in range(0,_B(num),2):
-        bytes.append(int(seq[i:i+2],16))
-    
-    return (bytes,seq[_B(num):])
+    def __init__(self, seq):
+        self.seq = seq
+        self.pos = 0
+
+    def take(self, num):
+        """Consume the num of BYTES, as hex"""
+        start = self.pos
+        self.pos += _B(num)
+        return self.seq[start:self.pos]
+
+    def octet(self):
+        """Consumes one byte and returns it as an int"""
+        return int(self.take(1), 16)
+
+    def decimal(self):
+        """read 2 chars as a decimal"""
+        return int(self.take(1), 10)
+
+    def rest(self):
+        return self.seq[self.pos:]
 
 def _twiddle(seq, decode=True):
     seq=seq.upper() # just in case
-    result=list()
-    for i in range(0,len(seq)-1,2):
-        result.extend((seq[i+1],seq[i]))
+
+    # swap each pair of characters
+    result=''.join([b+a for a,b in zip(seq[0::2], seq[1::2])])
     
     if len(result)<len(seq) and not decode:
         # encoding odd length
-        result.extend(('F',seq[-1]))
-    elif decode and result[-1:][0]=='F':
+        result+='F'+seq[-1]
+    elif decode and result[-1:]=='F':
         # strip trailing 'F'
-        result.pop()
+        result=result[:-1]
 
-    return ''.join(result)
+    return result
 
 def _parse_phone_num(num_type,seq):
     if num_type[0]=='D':
@@ -512,10 +579,6 @@ def _parse_phone_num(num_type,seq):
         intl_code='+'
     return '%s%s' % (intl_code,num)
 
-def _chop(seq,how_much):
-    """chops the number of octets given off front of seq"""
-    return seq[_B(how_much):]
-
 TS_MATCHER=re.compile(r'^(..)(..)(..)(..)(..)(..)(..)$')
 TZ_SIGN_MASK=0x08
 
@@ -563,53 +626,56 @@ def _read_ts(seq):
    
     return dt
 
-def _to_binary(n):
-    s = ""
-    for i in range(8):
-        s = ("%1d" % (n & 1)) + s
-        n >>= 1
-    return s
-
 def _unpack_septets(seq,padding=0):
-    """ 
-    this function taken from:
-    http://offog.org/darcs/misccode/desms.py
-
-    Thank you Adam Sampson <ats@offog.org>!
     """
+    Unpacks the hex-encoded _seq_ of GSM 7-bit septets into a str
+    of (still GSM encoded) characters, skipping _padding_ bits at
+    the start. Bits are consumed least significant first, so this
+    just feeds each octet into an integer accumulator, and pulls
+    out septets whenever it holds at least seven bits.
 
-    # Unpack 7-bit characters
-    msgbytes,r = _consume_bytes(seq,len(seq)/2)
-    msgbytes.reverse()
-    asbinary = ''.join(map(_to_binary, msgbytes))
-    if padding != 0:
-        asbinary = asbinary[:-padding]
+    """
+    data = bytearray(binascii.unhexlify(seq[:_B(len(seq)/2)]))
     chars = []
-    while len(asbinary) >= 7:
-        chars.append(int(asbinary[-7:], 2))
-        asbinary = asbinary[:-7]
-    return "".join(map(chr, chars))
-
-def _pack_septets(str, padding=0):
-    bytes=[ord(c) for c in str]
-    bytes.reverse()
-    asbinary = ''.join([_to_binary(b)[1:] for b in bytes])
-    # add padding
-    for i in range(padding):
-        asbinary+='0'
-    
-    # zero extend last octet if needed
-    extra = len(asbinary) % 8
-    if extra>0:
-        for i in range(8-extra):
-            asbinary='0'+asbinary
-        
-    # convert back to bytes
-    bytes=[]
-    for i in range(0,len(asbinary),8):
-        bytes.append(int(asbinary[i:i+8],2))
-    bytes.reverse()
-    return ''.join([chr(b) for b in bytes])
+    acc = 0
+    bits = -padding
+    for octet in data:
+        if bits < 0:
+            # drop the padding from the first octet
+            octet >>= padding
+            bits = 8 - padding
+            acc = octet
+        else:
+            acc |= octet << bits
+            bits += 8
+        while bits >= 7:
+            chars.append(_SEPTET_CHARS[acc & 0x7f])
+            acc >>= 7
+            bits -= 7
+    return "".join(chars)
+
+def _pack_septets(text, padding=0):
+    """
+    Packs _text_ (GSM encoded, one septet per character) into octets,
+    preceded by _padding_ zero bits (see _unpack_septets).
+
+    """
+    out = bytearray()
+    acc = 0
+    bits = padding
+    for c in text:
+        acc |= (ord(c) & 0x7f) << bits
+        bits += 7
+        if bits >= 8:
+            out.append(acc & 0xff)
+            acc >>= 8
+            bits -= 8
+    if bits > 0:
+        out.append(acc & 0xff)
+    return str(out)
+
+# lookup table for the characters of unpacked septets
+_SEPTET_CHARS = [chr(n) for n in range(128)]
 
 if __name__ == "__main__":
     # poor man's unit tests
@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 # vim: ai ts=4 sts=4 et sw=4 encoding=utf-8
 
+from __future__ import with_statement
 import gsmpdu
 import traceback
 import errors, message
@@ -25,6 +26,8 @@ class PduSmsHandler(SmsHandler):
         To enforce only a single SMS, set max_messages=1
  
         Raises 'ValueError' if text will not fit in max_messages
+
+        Returns True if every part was accepted by the modem
         """ 
         pdus = gsmpdu.get_outbound_pdus(text, recipient)
         if len(pdus) > max_messages:
@@ -33,8 +36,44 @@ class PduSmsHandler(SmsHandler):
                 (max_messages, len(pdus))
                 )
 
+        sent = True
         for pdu in pdus:
-            self._send_pdu(pdu)
+            if not self._send_pdu(pdu):
+                sent = False
+        return sent
+
+    def send_sms_many(self, recipients, text, max_messages = 255):
+        """
+        Sends _text_ to each of _recipients_. The text is only
+        encoded (and split) once, and each recipient's PDUs are
+        sent one after another.
+
+        Raises 'ValueError' if text will not fit in max_messages
+
+        Returns a dict mapping each recipient to True if
+        every part was accepted by the modem
+        """
+        pdus = gsmpdu.get_outbound_pdus_many(text, recipients)
+        for recipient_pdus in pdus.itervalues():
+            if len(recipient_pdus) > max_messages:
+                raise ValueError(
+                    'Max_message is %d and text requires %d messages' %
+                    (max_messages, len(recipient_pdus))
+                    )
+            # every recipient needs the same number
+            break
+
+        results = {}
+        for recipient in recipients:
+            sent = True
+            # (the modem is released between recipients, so
+            # the reader thread isn't held up by long batches)
+            with self.modem.modem_lock:
+                for pdu in pdus[recipient]:
+                    if not self._send_pdu(pdu):
+                        sent = False
+            results[recipient] = sent
+        return results
             
     def _send_pdu(self, pdu):
         # outer try to catch any error and make sure to
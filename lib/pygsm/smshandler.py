@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 # vim: ai ts=4 sts=4 et sw=4 encoding=utf-8
 
+from __future__ import with_statement
 import re
 
 ERR_MSG = "Must use one of concrete subclasses:PduSmsHandler or TextSmsHandler"
@@ -17,6 +18,20 @@ class SmsHandler(object):
         
         """
         raise Exception(ERR_MSG)
+
+    def send_sms_many(self, recipients, text, max_messages = 255):
+        """
+        Sends _text_ to each of _recipients_, returning a dict
+        mapping each recipient to the result of send_sms
+
+        """
+        results = {}
+        for recipient in recipients:
+            # (the modem is released between recipients, so
+            # the reader thread isn't held up by long batches)
+            with self.modem.modem_lock:
+                results[recipient] = self.send_sms(recipient, text, max_messages)
+        return results
     
     def get_mode_cmd(self):
         raise Exception(ERR_MSG)
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4 encoding=utf-8
+
+import time
+import threading
+from pygsm.devicewrapper import DeviceWrapper
+
+
+class FakeSerial(object):
+    """A stand-in for serial.Serial, which behaves (roughly) like a GSM
+       modem in PDU mode: every command is answered with OK, messages can
+       be sent with AT+CMGS, and stored messages are listed by AT+CMGL.
+       Incoming messages can be injected with deliver and store, which
+       write the same unsolicited notifications as a real modem."""
+
+    def __init__(self):
+        self.timeout = 1.0
+        self.commands = []
+        self.sent = []
+        self.stored = {}
+        self._in = ""
+        self._out = ""
+        self._lock = threading.Condition()
+        self._next_index = 1
+
+    def isOpen(self):
+        return True
+
+    def close(self):
+        pass
+
+    def inWaiting(self):
+        return len(self._out)
+
+    def read(self, size=1):
+        deadline = time.time() + (self.timeout or 0)
+        self._lock.acquire()
+        try:
+            while not self._out:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return ""
+                self._lock.wait(remaining)
+            data, self._out = self._out[:size], self._out[size:]
+            return data
+        finally:
+            self._lock.release()
+
+    def _emit(self, data):
+        self._lock.acquire()
+        try:
+            self._out += data
+            self._lock.notify()
+        finally:
+            self._lock.release()
+
+    def write(self, data):
+        self._in += data
+
+        # pdus are terminated by ctrl+z, commands by \r
+        for term in (chr(26), "\r"):
+            while term in self._in:
+                cmd, self._in = self._in.split(term, 1)
+                self.commands.append(cmd)
+                self._emit(self.respond(cmd, term))
+
+    def respond(self, cmd, term):
+        if term == chr(26):
+            self.sent.append(cmd)
+            return "\r\n+CMGS: %d\r\n\r\nOK\r\n" % len(self.sent)
+
+        # the prompt isn't followed by a newline, so pygsm
+        # reads it as the pending data of a read timeout
+        if cmd.startswith("AT+CMGS="):
+            return "> "
+
+        if cmd.startswith("AT+CMGL="):
+            lines = ["+CMGL: %d,0,,%d\r\n%s\r\n" % (i, len(pdu) / 2, pdu)
+                     for i, pdu in sorted(self.stored.items())]
+            self.stored = {}
+            return "\r\n%s\r\nOK\r\n" % "".join(lines)
+
+        return "\r\nOK\r\n"
+
+    def deliver(self, pdu):
+        """Pushes _pdu_ straight to the host, as with AT+CNMI=2,2."""
+        self._emit("\r\n+CMT: ,%d\r\n%s\r\n" % (len(pdu) / 2, pdu))
+
+    def store(self, pdu, notify=True):
+        """Stores _pdu_, and (optionally) notifies the host with +CMTI,
+           as with AT+CNMI=2,1."""
+        index = self._next_index
+        self._next_index += 1
+        self.stored[index] = pdu
+        if notify:
+            self._emit('\r\n+CMTI: "SM",%d\r\n' % index)
+
+
+class FakeDevice(DeviceWrapper):
+    """A DeviceWrapper around a FakeSerial, which can be passed to
+       GsmModem.__init__ as the _device_ argument."""
+
+    def __init__(self):
+        self.device = FakeSerial()
+        self._partial = []
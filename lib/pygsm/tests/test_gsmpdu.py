@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4 encoding=utf-8
+
+import unittest
+from pygsm import gsmpdu
+
+# an SMS-DELIVER pdu, from 27838890001, containing "hellohello"
+PDU = "07917283010010F5040BC87238880900F10000993092516195800AE8329BFD4697D9EC37"
+
+# the first part of a concatenated (gsm) message
+CSM_PDU = "07912180958729F6440B814151733717F500009070207095828AA00500030E0201986FF719C47EBBCF20F6DB7D06B1DFEE3388FD769F41ECB7FB0C62BFDD6710FBED3E83D8ECB7"
+
+# a ucs2 message, in big-endian byte order (with no BOM)
+UCS2_PDU = "0791227167830001040C912271271640910008906012024514001C002E004020AC00A300680065006C006C006F002000E900EC006B00F0"
+
+class TestGsmPdu(unittest.TestCase):
+    def test_received (self):
+        pdu = gsmpdu.ReceivedGsmPdu(PDU)
+        self.assertEquals(pdu.address, "27838890001")
+        self.assertEquals(pdu.text, "hellohello")
+        self.assertFalse(pdu.is_csm)
+
+        pdu = gsmpdu.ReceivedGsmPdu(CSM_PDU)
+        self.assertTrue(pdu.is_csm)
+        self.assertEquals((pdu.csm_ref, pdu.csm_seq, pdu.csm_total), (14, 1, 2))
+
+        pdu = gsmpdu.ReceivedGsmPdu(UCS2_PDU)
+        self.assertEquals(pdu.encoding, "ucs2")
+        self.assertEquals(pdu.text, u".@€\xa3hello \xe9\xec\x6b\xf0")
+
+    def test_septets (self):
+        # every padding must survive a round trip,
+        # including the awkward multiple-of-8 lengths
+        for text in ["", "a", "hellohello", "x" * 8, "x" * 160]:
+            for padding in range(7):
+                packed = gsmpdu._pack_septets(text, padding)
+                unpacked = gsmpdu._unpack_septets(packed.encode("hex"), padding)
+                self.assertEquals(unpacked[:len(text)], text)
+
+        # "hellohello", as it appears in the pdu above
+        self.assertEquals(gsmpdu._pack_septets("hellohello").encode("hex").upper(),
+            "E8329BFD4697D9EC37")
+
+    def test_outbound (self):
+        pdus = gsmpdu.get_outbound_pdus(u"hellohello", "+27838890001")
+        self.assertEquals(len(pdus), 1)
+        self.assertEquals(pdus[0].pdu_string,
+            "0011000B917238880900F10000AA0AE8329BFD4697D9EC37")
+
+        pdus = gsmpdu.get_outbound_pdus(u"山" * 100, "+27838890001")
+        self.assertEquals(len(pdus), 2)
+        self.assertEquals([p.csm_seq for p in pdus], [1, 2])
+        self.assertEquals(pdus[0].csm_ref, pdus[1].csm_ref)
+
+    def test_outbound_many (self):
+        recipients = ["+2783889000%d" % n for n in range(5)]
+        text = u"hello " * 60
+        many = gsmpdu.get_outbound_pdus_many(text, recipients)
+        self.assertEquals(sorted(many.keys()), recipients)
+
+        for recipient in recipients:
+            # the batch pdus must be exactly what the single-recipient
+            # call would have built, with the next csm ref in sequence
+            pdus = many[recipient]
+            single = gsmpdu.get_outbound_pdus(text, recipient)
+            self.assertEquals(len(pdus), 3)
+            self.assertEquals([p.address for p in pdus], [recipient] * 3)
+            self.assertEquals(single[0].csm_ref, (pdus[0].csm_ref + 1) % 256)
+            for p in single:
+                p.csm_ref = pdus[0].csm_ref
+            self.assertEquals([p.pdu_string for p in pdus], [p.pdu_string for p in single])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4 encoding=utf-8
+
+import unittest, time
+from pygsm import GsmModem
+from fakedevice import FakeDevice
+
+# an SMS-DELIVER pdu, from 27838890001, containing "hellohello"
+PDU = "07917283010010F5040BC87238880900F10000993092516195800AE8329BFD4697D9EC37"
+
+class FastModem (GsmModem):
+    cmd_delay = 0
+
+def quiet (modem, message, type):
+    pass
+
+class TestReader(unittest.TestCase):
+    def setUp (self):
+        self.device = FakeDevice()
+        self.modem = FastModem(device=self.device, logger=quiet)
+
+    def tearDown (self):
+        self.modem.stop_reader()
+
+    def wait_for_message (self, timeout=2.0):
+        start = time.time()
+        msg = self.modem.next_message(ping=False, fetch=False, timeout=timeout)
+        return msg, time.time() - start
+
+    def test_cmt (self):
+        self.modem.start_reader()
+        self.device.device.deliver(PDU)
+        msg, latency = self.wait_for_message()
+        self.assertEquals(msg.text, "hellohello", "message was delivered")
+        self.assertTrue(latency < 0.5, "message arrived quickly (%.3fs)" % latency)
+        self.assertTrue("AT+CNMA" in self.device.device.commands, "message was acknowledged")
+
+    def test_cmti (self):
+        self.modem.start_reader()
+        self.device.device.store(PDU)
+        msg, latency = self.wait_for_message()
+        self.assertEquals(msg.text, "hellohello", "stored message was fetched")
+        self.assertTrue(latency < 0.5, "message arrived quickly (%.3fs)" % latency)
+
+    def test_sweep (self):
+        self.modem.start_reader(sweep_interval=0.2)
+        self.device.device.store(PDU, notify=False)
+        msg, latency = self.wait_for_message()
+        self.assertEquals(msg.text, "hellohello", "sweep found the message")
+
+    def test_no_polling (self):
+        self.modem.start_reader()
+        commands = len(self.device.device.commands)
+        time.sleep(0.5)
+        self.assertEquals(len(self.device.device.commands), commands,
+            "reader doesn't write to an idle modem")
+
+    def test_send_while_reading (self):
+        self.modem.start_reader()
+        self.modem.send_sms("27838890001", "hello")
+        self.assertEquals(len(self.device.device.sent), 1, "message was sent")
+
+    def test_send_many_while_reading (self):
+        self.modem.start_reader()
+        results = self.modem.send_sms_many(["27838890001", "27838890002"], "hello")
+        self.assertEquals(results, {"27838890001": True, "27838890002": True})
+        self.assertEquals(len(self.device.device.sent), 2, "one pdu per recipient")
+        self.assertRaises(ValueError, self.modem.send_sms_many,
+            ["27838890001"], "x" * 200, max_messages=1)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -30,6 +30,14 @@ class Backend (Receiver):
     def stop(self):
         self._running = False
    
+    def send_many(self, messages):
+        """Queues each of _messages_ to be sent, as send does. This
+           is the entry point for bulk sends (via Router.outgoing_many,
+           as by smsforum's blasts), which backends can override to
+           send a batch more cheaply than one message at a time."""
+        for message in messages:
+            self.send(message)
+
     def message(self, identity, text, date=None):
         c = Connection(self, identity)
         return Message(c, text, date)
@@ -13,6 +13,9 @@ import backend
 from rapidsms import log
 
 POLL_INTERVAL=2 # num secs to wait between checking for inbound texts
+READ_TIMEOUT=0.5 # num secs to wait for an inbound text, when not polling
+SWEEP_INTERVAL=30 # num secs between storage sweeps, when not polling
+SEND_BATCH=50 # max recipients of one send_sms_many
 LOG_LEVEL_MAP = {
     'traffic':'info',
     'read':'info',
@@ -49,6 +52,14 @@ class Backend(Backend):
             self.max_csm = 255
         if self.max_csm<1:
                 self.max_csm = 1
+
+        # by default, let pygsm's reader thread tell us about incoming
+        # messages as they arrive. set reader=false to fall back to
+        # polling the modem every POLL_INTERVAL seconds
+        self.use_reader = True
+        if 'reader' in kwargs:
+            self.use_reader = self.config_bool(str(kwargs.pop('reader')))
+        self.sweep_interval = int(kwargs.pop('sweep_interval', SWEEP_INTERVAL))
                 
         # make a modem log
         self.modem_logger = None
@@ -72,11 +83,59 @@ class Backend(Backend):
         except ValueError, err:
             # TODO: Pass this error info on to caller!
             self.error('Error sending message: %s' % err)
+
+    def __send_many(self, messages):
+        # a blast queues the same text for many recipients, so it's
+        # encoded once and sent to all of them (see send_sms_many)
+        if len(messages) == 1:
+            return self.__send_sms(messages[0])
+        try:
+            self.modem.send_sms_many(
+                [str(m.connection.identity) for m in messages],
+                messages[0].text,
+                max_messages=self.max_csm)
+        except ValueError, err:
+            self.error('Error sending message: %s' % err)
+
+    def send_waiting(self, timeout=0.0):
+        """Sends every message in the outgoing queue, waiting up to
+           _timeout_ seconds for the first one. Consecutive messages
+           with the same text (to different recipients) are sent as
+           one batch. Returns the number of messages sent."""
+        msg = self.next_message(max(timeout, 0))
+        count = 0
+        run = []
+        recipients = set()
+        while msg is not None:
+            identity = msg.connection.identity
+            if run and (msg.text != run[0].text or identity in recipients
+                    or len(run) >= SEND_BATCH):
+                self.__send_many(run)
+                run = []
+                recipients = set()
+            run.append(msg)
+            recipients.add(identity)
+            count += 1
+            msg = self.next_message()
+        if run:
+            self.__send_many(run)
+        return count
         
     def run(self):
+        if self.use_reader:
+            self.modem.start_reader(self.sweep_interval)
+
         while self._running:
-            # check for new messages
-            msg = self.modem.next_message()
+            # check for new messages. the reader thread queues them
+            # as they arrive, so just wait a moment for one (unless
+            # we're polling, in which case we have to ask the modem).
+            # outgoing messages aren't kept waiting for incoming ones
+            if self.use_reader:
+                timeout = (not self.message_waiting) and READ_TIMEOUT or 0
+                msg = self.modem.next_message(
+                    ping=False, fetch=False, timeout=timeout)
+            else:
+                msg = self.modem.next_message()
         
             if msg is not None:
                 # we got an sms! create RapidSMS Connection and
@@ -90,16 +149,15 @@ class Backend(Backend):
                 self.router.send(m)
                 
             # process all outbound messages
-            while True:
-                try:
-                    self.__send_sms(self._queue.get_nowait())
-                except Queue.Empty:
-                    # break out of while
-                    break
+            self.send_waiting()
                 
-            # poll for new messages
-            # every POLL_INTERVAL seconds
-            time.sleep(POLL_INTERVAL)
+            # poll for new messages every POLL_INTERVAL
+            # seconds, sending any outgoing messages as
+            # they're queued in the meantime
+            if not self.use_reader:
+                deadline = time.time() + POLL_INTERVAL
+                while self._running and time.time() < deadline:
+                    self.send_waiting(deadline - time.time())
     
     def start(self):
         self.modem = pygsm.GsmModem(
@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4 encoding=utf-8
+
+import time
+import threading
+import Queue
+import pygsm
+
+from rapidsms.message import Message
+from rapidsms.connection import Connection
+import backend
+import gsm
+
+RETRY_INTERVAL=60 # num secs to wait before trying a failed modem again
+STRATEGIES = ("round-robin", "least-queue", "sticky")
+
+
+class PooledModem (object):
+    """One of the modems owned by a pooled GSM backend. Each has its own
+       queue of outgoing messages, and a thread which sends them."""
+
+    def __init__(self, backend, number, port):
+        self.backend = backend
+        self.number = number
+        self.port = port
+        self.modem = None
+        self.queue = Queue.Queue()
+        self.thread = None
+
+        # a modem starts out "down", and is brought
+        # up (and back up after failures) by connect
+        self.up = False
+        self.down_since = 0
+
+        self.sent = 0
+        self.failed = 0
+        self.started = None
+
+    def __repr__(self):
+        return "<PooledModem %d on %s (%s)>" % (
+            self.number, self.port, self.up and "up" or "down")
+
+    def connect(self):
+        """Connects to (and boots) the modem, returning True if
+           it's ready to send and receive messages."""
+        try:
+            if self.modem is None:
+                self.modem = pygsm.GsmModem(
+                    port=self.port,
+                    *self.backend.modem_args,
+                    **self.backend.modem_kwargs)
+            else:
+                self.modem.boot(reboot=True)
+
+            if self.backend.use_reader:
+                self.modem.start_reader(self.backend.sweep_interval)
+
+        except Exception:
+            self.backend.log_last_exception("Couldn't connect to modem on %s" % self.port)
+            self.mark_down()
+            return False
+
+        self.up = True
+        if self.started is None:
+            self.started = time.time()
+        self.backend.info("Modem on %s is up", self.port)
+        return True
+
+    def mark_down(self):
+        if self.up:
+            self.backend.warning("Taking modem on %s out of rotation", self.port)
+        self.up = False
+        self.down_since = time.time()
+
+        # hand any messages waiting for this modem back to
+        # the backend, so they're sent via another one
+        while True:
+            try:
+                self.backend.send(self.queue.get_nowait())
+            except Queue.Empty:
+                break
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def run(self):
+        while self.backend.running:
+            try:
+                msg = self.queue.get(True, 0.5)
+            except Queue.Empty:
+                continue
+
+            # if the modem went down while this message was
+            # waiting, give it back to the backend to re-route
+            if not self.up:
+                self.backend.send(msg)
+                continue
+
+            try:
+                ok = self.modem.send_sms(
+                    str(msg.connection.identity),
+                    msg.text,
+                    max_messages=self.backend.max_csm)
+
+            except ValueError, err:
+                # the message is too long. it won't
+                # fit on any other modem, either
+                self.backend.error("Error sending message: %s" % err)
+                continue
+
+            except Exception:
+                self.backend.log_last_exception("Modem on %s failed to send" % self.port)
+                ok = False
+
+            if ok:
+                self.sent += 1
+            else:
+                self.failed += 1
+                self.mark_down()
+                self.backend.send(msg)
+
+    def next_message(self):
+        if not self.up:
+            return None
+        if self.backend.use_reader:
+            return self.modem.next_message(ping=False, fetch=False)
+        return self.modem.next_message()
+
+    def stats(self):
+        elapsed = (time.time() - self.started) if self.started else 0
+        return {
+            "port":       self.port,
+            "up":         self.up,
+            "queued":     self.queue.qsize(),
+            "sent":       self.sent,
+            "failed":     self.failed,
+            "throughput": (self.sent / elapsed) if elapsed > 0 else 0.0 }
+
+
+class Backend(gsm.Backend):
+    """A GSM backend which spreads outgoing messages over several modems,
+       to send faster than a single modem can. Incoming messages from all
+       of the modems are routed under this backend's slug. Modems which
+       fail are taken out of rotation, and retried every _retry_interval_
+       seconds. Outgoing messages are assigned to modems by _strategy_:
+
+       round-robin: each modem in turn
+       least-queue: the modem with the fewest messages waiting
+       sticky:      always the same modem for each recipient (while it's
+                    up), so the parts of multipart messages arrive in order"""
+
+    _title = "pyGSM pool"
+
+    def configure(self, ports=None, strategy="round-robin",
+                  retry_interval=RETRY_INTERVAL, *args, **kwargs):
+        if strategy not in STRATEGIES:
+            raise Exception("Invalid GSM pool strategy: %s (use one of: %s)" %
+                (strategy, ", ".join(STRATEGIES)))
+
+        gsm.Backend.configure(self, *args, **kwargs)
+        ports = self.config_list(self.config_requires("ports", ports))
+        self.modems = [PooledModem(self, n, port) for n, port in enumerate(ports)]
+        self.strategy = strategy
+        self.retry_interval = int(retry_interval)
+        self._next = 0
+
+    def choose_modem(self, message):
+        """Returns the PooledModem which should send _message_, according
+           to self.strategy, or None if every modem is down."""
+        up = [m for m in self.modems if m.up]
+        if not up:
+            return None
+
+        if self.strategy == "least-queue":
+            return min(up, key=lambda m: m.queue.qsize())
+
+        if self.strategy == "sticky":
+            # hash over all of the modems (not just those which are up),
+            # so recipients don't move around when another modem fails
+            n = hash(message.connection.identity) % len(self.modems)
+            for offset in range(len(self.modems)):
+                modem = self.modems[(n + offset) % len(self.modems)]
+                if modem.up:
+                    return modem
+
+        modem = up[self._next % len(up)]
+        self._next += 1
+        return modem
+
+    def retry_failed_modems(self):
+        now = time.time()
+        for modem in self.modems:
+            if not modem.up and now - modem.down_since >= self.retry_interval:
+                self.info("Retrying modem on %s", modem.port)
+                modem.connect()
+
+    def stats(self):
+        return [m.stats() for m in self.modems]
+
+    def run(self):
+        while self._running:
+
+            # route incoming messages from every modem
+            for modem in self.modems:
+                msg = modem.next_message()
+                if msg is not None:
+                    c = Connection(self, msg.sender)
+                    m = Message(
+                        connection=c,
+                        text=msg.text,
+                        date=msg.sent.replace(tzinfo=None))
+                    self.router.send(m)
+
+            # hand outgoing messages to the modems. if they're all
+            # down, leave the message in our queue until one is back
+            while True:
+                msg = self.next_message()
+                if msg is None:
+                    break
+                modem = self.choose_modem(msg)
+                if modem is None:
+                    self.send(msg)
+                    break
+                modem.queue.put(msg)
+
+            self.retry_failed_modems()
+
+            # with the reader threads running, there's no need to
+            # wait any longer than it takes to notice new messages
+            if self.use_reader:
+                time.sleep(gsm.READ_TIMEOUT)
+            else:
+                time.sleep(gsm.POLL_INTERVAL)
+
+    def start(self):
+        for modem in self.modems:
+            modem.connect()
+
+        # start the senders before the run loop, since it's the
+        # loop which hands them the messages. (this sets _running)
+        self._running = True
+        for modem in self.modems:
+            modem.start()
+        backend.Backend.start(self)
+
+    def stop(self):
+        backend.Backend.stop(self)
+
+        for modem in self.modems:
+            if modem.modem is not None:
+                modem.modem.disconnect()
@@ -1,42 +1,122 @@
 #!/usr/bin/env python
 # vim: ai ts=4 sts=4 et sw=4 encoding=utf-8
 
-import BaseHTTPServer, SocketServer
+"""
+A backend which receives messages over HTTP, from an SMS gateway (or
+the httptester app), and sends them back via a pluggable _handler_
+(one of the classes in httphandlers).
+
+Requests are handled by a fixed pool of _threads_ (see
+rapidsms.httpserver), with keep-alive. Outgoing messages are sent by
+_senders_ threads, in batches of whatever is waiting. Gateway handlers
+send them to _outgoing_url_ through a pooled HttpClient, which keeps
+up to _connections_ connections to the gateway open, and retries each
+message up to _retries_ times, backing off from _backoff_ seconds.
+(with more than one sender, messages to the same phone may be sent
+out of order.)
+
+"""
+
 import select
-import urllib
+import threading
 import httphandlers as handlers
 import rapidsms
+from rapidsms.httpserver import PooledHTTPServer, POOL_SIZE, BACKLOG
+from httpclient import HttpClient, RETRIES, BACKOFF, TIMEOUT
+
+SEND_BATCH = 50 # max messages a sender takes at once
+
+class HttpServer (PooledHTTPServer):
 
-class HttpServer (BaseHTTPServer.HTTPServer, SocketServer.ThreadingMixIn):
-    
     def handle_request (self, timeout=1.0):
         # don't block on handle_request
         reads, writes, errors = (self,), (), ()
         reads, writes, errors = select.select(reads, writes, errors, timeout)
         if reads:
-            BaseHTTPServer.HTTPServer.handle_request(self)
+            PooledHTTPServer.handle_request(self)
 
 class Backend(rapidsms.backends.Backend):
-    def configure(self, host="localhost", port=8080, handler="HttpHandler"):
-        
+    def configure(self, host="localhost", port=8080, handler="HttpHandler",
+                  threads=POOL_SIZE, backlog=BACKLOG, outgoing_url=None,
+                  outgoing_method="GET", senders=1, connections=4,
+                  retries=RETRIES, backoff=BACKOFF, timeout=TIMEOUT):
+
         #module_name = "httphandlers"
         #module = __import__(module_name, {}, {}, [''])
         component_class = getattr(handlers, handler)
-        
+
         self.handler = component_class
-        self.server = HttpServer((host, int(port)), component_class)
+        self.server = HttpServer((host, int(port)), component_class,
+                                 int(threads), int(backlog))
         self.type = "HTTP"
-        # set this backend in the server instance so it 
+        # set this backend in the server instance so it
         # can callback when a message is received
         self.server.backend = self
-        
+
+        self.outgoing_url = outgoing_url
+        self.outgoing_method = outgoing_method.upper()
+        self.client = HttpClient(int(connections), int(retries),
+                                 float(backoff), float(timeout), logger=self)
+        self.senders = int(senders)
+        self.sent = 0
+        self.failed = 0
+        self.lock = threading.Lock()
+
         # set the slug based on the handler, so we can have multiple
         # http backends
-        self._slug = "http_%s" % handler  
-        
+        self._slug = "http_%s" % handler
+
     def run (self):
-        while self.running:
-            if self.message_waiting:
-                msg = self.next_message()
-                self.handler.outgoing(msg)
-            self.server.handle_request()
+        senders = []
+        for n in range(self.senders):
+            sender = threading.Thread(target=self.__send_loop)
+            sender.setDaemon(True)
+            sender.start()
+            senders.append(sender)
+
+        try:
+            while self.running:
+                self.server.handle_request()
+        finally:
+            self.server.server_close()
+            for sender in senders:
+                sender.join()
+            self.client.close()
+
+    def __send_loop(self):
+        # keep going until the queue is empty, so
+        # messages aren't lost when the backend stops
+        while self.running or self.message_waiting:
+            batch = self.next_batch()
+            if not batch:
+                continue
+            sent = self.handler.outgoing_many(batch)
+            self.lock.acquire()
+            try:
+                self.sent += sent
+                self.failed += len(batch) - sent
+            finally:
+                self.lock.release()
+
+    def next_batch(self, timeout=0.5):
+        """Waits up to _timeout_ seconds for an outgoing message, and
+           returns it along with any others that are already waiting
+           (up to SEND_BATCH in all)"""
+        msg = self.next_message(timeout)
+        if msg is None:
+            return []
+        batch = [msg]
+        while len(batch) < SEND_BATCH:
+            msg = self.next_message()
+            if msg is None:
+                break
+            batch.append(msg)
+        return batch
+
+    def stats(self):
+        return {
+            "sent":    self.sent,
+            "failed":  self.failed,
+            "queued":  self.message_waiting,
+            "server":  self.server.stats(),
+            "client":  self.client.stats() }
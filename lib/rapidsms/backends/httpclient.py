@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4
+
+"""
+An HTTP client for sending messages to SMS gateways, which keeps its
+connections open (with HTTP/1.1 keep-alive) and reuses them, rather
+than connecting to the gateway again for every message (as urllib2
+does). Up to _size_ idle connections are kept for each gateway.
+
+Requests which fail (because the connection broke, or the gateway
+answered with a 5xx error) are retried up to _retries_ times, after
+_backoff_ seconds, then twice that, and so on. Other errors (like a 4xx
+response) won't be fixed by trying again, so aren't retried.
+
+"""
+
+from __future__ import with_statement
+import time
+import socket
+import httplib
+import urlparse
+import threading
+
+POOL_SIZE = 4
+RETRIES = 3
+BACKOFF = 1.0 # seconds, doubled after each failure
+TIMEOUT = 10 # seconds
+
+
+class HttpError(Exception):
+    def __init__(self, status, reason, body=""):
+        Exception.__init__(self, "%d %s" % (status, reason))
+        self.status = status
+        self.reason = reason
+        self.body = body
+
+
+class HttpClient(object):
+    def __init__(self, size=POOL_SIZE, retries=RETRIES, backoff=BACKOFF,
+                 timeout=TIMEOUT, logger=None):
+        self.size = size
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.logger = logger
+
+        # (scheme, host, port) -> [idle connections]
+        self.lock = threading.Lock()
+        self.idle = {}
+
+        self.requests = 0
+        self.connections = 0
+        self.retried = 0
+        self.failed = 0
+
+    def __connect(self, key):
+        scheme, host, port = key
+        if scheme == "https":
+            conn = httplib.HTTPSConnection(host, port)
+        else:
+            conn = httplib.HTTPConnection(host, port)
+        conn.connect()
+        conn.sock.settimeout(self.timeout)
+        # requests are small, so don't wait to fill a packet
+        conn.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        with self.lock:
+            self.connections += 1
+        return conn
+
+    def __checkout(self, key):
+        # returns a connection to _key_, and whether it's been used before
+        with self.lock:
+            idle = self.idle.get(key)
+            if idle:
+                return idle.pop(), True
+        return self.__connect(key), False
+
+    def __checkin(self, key, conn):
+        with self.lock:
+            idle = self.idle.setdefault(key, [])
+            if len(idle) < self.size:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def request(self, method, url, body=None, headers=None):
+        """Sends a request to _url_, and returns the (status, body) of
+           the response, retrying if it fails. Raises HttpError if the
+           gateway returned an error, or the last exception raised
+           while trying to reach it."""
+        parts = urlparse.urlsplit(url)
+        scheme = parts[0] or "http"
+        host = parts[1]
+        port = None
+        if ":" in host:
+            host, port = host.rsplit(":", 1)
+            port = int(port)
+        key = (scheme, host, port or (scheme == "https" and 443 or 80))
+        path = parts[2] or "/"
+        if parts[3]:
+            path += "?" + parts[3]
+
+        headers = dict(headers or {})
+        if body is not None:
+            headers.setdefault("Content-Type", "application/x-www-form-urlencoded")
+
+        attempt = 0
+        while True:
+            attempt += 1
+            with self.lock:
+                self.requests += 1
+            try:
+                return self.__request(key, method, path, body, headers)
+            except (socket.error, httplib.HTTPException, HttpError), err:
+                # a 4xx response won't be any different next time
+                retry = not (isinstance(err, HttpError) and err.status < 500)
+                if not retry or attempt > self.retries:
+                    with self.lock:
+                        self.failed += 1
+                    raise
+                delay = self.backoff * (2 ** (attempt - 1))
+                self.__log("warning", "%s %s failed (%s), retrying in %.1fs",
+                    method, url, err, delay)
+                with self.lock:
+                    self.retried += 1
+                time.sleep(delay)
+
+    def __request(self, key, method, path, body, headers):
+        conn, reused = self.__checkout(key)
+        try:
+            try:
+                conn.request(method, path, body, headers)
+                response = conn.getresponse()
+            except (socket.error, httplib.HTTPException):
+                # an idle connection may have been closed by the
+                # gateway, so try once more on a new one before
+                # counting it as a failure
+                if not reused:
+                    raise
+                conn.close()
+                conn = self.__connect(key)
+                conn.request(method, path, body, headers)
+                response = conn.getresponse()
+            data = response.read()
+        except:
+            conn.close()
+            raise
+
+        if response.will_close:
+            conn.close()
+        else:
+            self.__checkin(key, conn)
+
+        if response.status >= 400:
+            raise HttpError(response.status, response.reason, data)
+        return response.status, data
+
+    def close(self):
+        """Closes all of the idle connections"""
+        with self.lock:
+            idle, self.idle = self.idle, {}
+        for conns in idle.itervalues():
+            for conn in conns:
+                conn.close()
+
+    def __log(self, level, msg, *args):
+        if self.logger is not None:
+            self.logger.log(level, msg, *args)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "requests":    self.requests,
+                "connections": self.connections,
+                "retried":     self.retried,
+                "failed":      self.failed,
+                "idle":        sum([len(c) for c in self.idle.itervalues()]) }
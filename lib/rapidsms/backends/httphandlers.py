@@ -4,8 +4,12 @@
 import BaseHTTPServer
 import random
 import re
+import cgi
+import time
 import urllib
+import urlparse
 from datetime import datetime
+from rapidsms.httpserver import IDLE_TIMEOUT
 
 def _uni(str):
     """
@@ -16,7 +20,7 @@ def _uni(str):
     try:
         return unicode(str)
     except:
-        return unicode(str,'utf-8')
+        return unicode(str,'utf-8','replace')
 
 def _str(uni):
     """
@@ -29,11 +33,31 @@ def _str(uni):
     except:
         return uni.encode('utf-8')
 
+def _parse_qs(query):
+    """
+    Returns a list of the (name, value) pairs in
+    the url-encoded _query_, with the values
+    decoded to unicode
+
+    """
+    return [(name, _uni(value)) for name, value
+            in cgi.parse_qsl(query, keep_blank_values=True)]
+
 class RapidBaseHttpHandler(BaseHTTPServer.BaseHTTPRequestHandler):
     '''The base handler for use in the http backends.  This is a
        simple extension of the python builtin handlers with
        logging capabilities and a utility method for responding
-       to incoming requiests.'''
+       to incoming requiests.
+
+       Connections are kept open between requests (every response
+       has a content-length), until the client has sent nothing for
+       IDLE_TIMEOUT seconds.'''
+
+    protocol_version = "HTTP/1.1"
+    timeout = IDLE_TIMEOUT
+    # buffer each response (it's flushed after every request), rather than
+    # writing each header separately, which stalls keep-alive clients
+    wbufsize = -1
 
     def log_error (self, format, *args):
         self.server.backend.error(format, *args)
@@ -41,142 +65,198 @@ class RapidBaseHttpHandler(BaseHTTPServer.BaseHTTPRequestHandler):
     def log_message (self, format, *args):
         self.server.backend.debug(format, *args)
 
-    def respond(self, code, msg):
+    def respond(self, code, msg, content_type="text/html", headers=()):
+        body = _str(msg)
         self.send_response(code)
-        self.send_header("Content-type", "text/html")
+        self.send_header("Content-type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in headers:
+            self.send_header(name, value)
         self.end_headers()
-        self.wfile.write(_str(msg))
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def read_body(self):
+        '''Returns the body of this request (which must be read,
+           even if it's not used, before the next request on the
+           same connection can be)'''
+        length = int(self.headers.get("Content-Length") or 0)
+        if length <= 0:
+            return ""
+        return self.rfile.read(length)
+
+    def params(self):
+        '''Returns a dict of the parameters of this request (from its
+           query string, and its body, if it's a url-encoded POST), with
+           their values decoded to unicode'''
+        params = dict(get_params(self) or [])
+        if self.command == "POST":
+            params.update(dict(post_params(self) or []))
+        return params
+
+    def do_POST(self):
+        self.read_body()
+        self.respond(405, "Method not allowed")
+
+    @classmethod
+    def outgoing_many(klass, messages):
+        '''Sends a batch of outgoing messages through this interface,
+           and returns the number which were sent. By default, each
+           one is passed to outgoing; handlers which can send a batch
+           more cheaply should override this.'''
+        sent = 0
+        for msg in messages:
+            try:
+                klass.outgoing(msg)
+                sent += 1
+            except Exception:
+                msg.connection.backend.log_last_exception(
+                    "Couldn't send message to %s" % msg.connection.identity)
+        return sent
+
 
-    
 class HttpHandler(RapidBaseHttpHandler):
     '''The original http handler, used by the httptester app.
        URLS are /PhoneNumber/Message'''
-    
+
     msg_store = {}
-    
+
     def do_GET(self):
         # if the path is just "/" then start a new session
         # and redirect to that session's URL
         if self.path == "/":
             session_id = random.randint(100000, 999999)
-            self.send_response(301)
-            self.send_header("Location", "/%d/" % session_id)
-            self.end_headers()
+            self.respond(301, "", headers=[("Location", "/%d/" % session_id)])
             return
-        
-        # if the path is of the form /integer/blah 
+
+        # if the path is of the form /integer/blah
         # send a new message from integer with content blah
         send_regex = re.compile(r"^/(\d+)/(.*)")
         match = send_regex.match(self.path)
         if match:
             # send the message
             session_id = match.group(1)
-            text = _str(match.group(2))
-            
+            text = _uni(urllib.unquote(match.group(2)))
+
             if text == "json_resp":
-                self.send_response(200)
-                self.send_header("Content-type", "text/html")
-                self.end_headers()
-                
+                resp = ""
                 if HttpHandler.msg_store.has_key(session_id) and len(HttpHandler.msg_store[session_id]):
                     resp=_str("{'phone':'%s', 'message':'%s'}" % (session_id, HttpHandler.msg_store[session_id].pop(0).replace("'", r"\'")))
-                    self.wfile.write(resp)
+                self.respond(200, resp)
                 return
-            
-            # get time
-            received = datetime.utcnow()
-            # leave Naive!
-            # received.replace(tzinfo=pytz.utc)
-            
-            msg = self.server.backend.message(session_id, urllib.unquote(text))
+
+            msg = self.server.backend.message(session_id, text)
             self.server.backend.route(msg)
-            # respond with the number and text 
-            self.send_response(200)
-            self.send_header("Content-type", "text/html")
-            self.end_headers()
-            self.wfile.write(_str("{'phone':'%s', 'message':'%s'}" % (session_id, urllib.unquote(text).replace("'", r"\'"))))
+            # respond with the number and text
+            self.respond(200, u"{'phone':'%s', 'message':'%s'}" % (session_id, text.replace("'", r"\'")))
             return
-            
-        return
-        
-    def do_POST(self):
-        # TODO move the actual sending over to here
-        return
-    
+
+        self.respond(404, "Not found")
+
     @classmethod
     def outgoing(klass, msg):
         '''Used to send outgoing messages through this interface.'''
         #self.log_message("http outgoing message: %s" % message)
         # the default http backend just stores outgoing messages in
-        # a store and provides access to them via the JSON/AJAX 
+        # a store and provides access to them via the JSON/AJAX
         # interface
         if HttpHandler.msg_store.has_key(msg.connection.identity):
             HttpHandler.msg_store[msg.connection.identity].append(_str(msg.text))
         else:
             HttpHandler.msg_store[msg.connection.identity] = []
             HttpHandler.msg_store[msg.connection.identity].append(_str(msg.text))
-                
-class MTechHandler(RapidBaseHttpHandler):
-    '''An HttpHandler for the mtech gateway, for use in Nigeria'''
+
+class GatewayHandler(RapidBaseHttpHandler):
+    '''A handler for SMS gateways which pass incoming messages to us as
+       parameters (in the query string, or the body of a url-encoded
+       POST), and accept outgoing messages the same way, at the backend's
+       outgoing_url. The names of the parameters (and the format of the
+       date) are class attributes, so supporting another gateway only
+       takes a subclass which sets them.'''
+
+    identity_param = "from"
+    text_param = "text"
+    date_param = "sent"
+    date_format = None # seconds since the epoch
+
+    out_identity_param = "to"
+    out_text_param = "text"
+
     def do_GET(self):
-        querystart = self.path.find("?")
-        if querystart == -1:
-            self.respond(500, "Must specify parameters in the URL!")
+        if _is_uptime_check(self):
+            self.respond(200, "success")
             return
-        
-        query_params = map((lambda t: t.split("=")), self.path[querystart + 1:].split("&"))
-        
-        self.accept_message(query_params)
-        
-        
+        self.accept_message(self.params())
+
     def do_POST(self):
-        if self.rfile:
-            content_len = int(self.headers["Content-Length"])
-            data = self.rfile.read(content_len)
-            params = map((lambda t: t.split("=")), data.split("&"))
-            self.accept_message(params)
-    
+        self.accept_message(self.params())
+
+    def parse_date(self, value):
+        if not value:
+            return None
+        try:
+            if self.date_format is None:
+                return datetime.fromtimestamp(float(value))
+            return datetime(*time.strptime(value, self.date_format)[:6])
+        except ValueError:
+            self.log_error("Invalid date: %r", value)
+            return None
+
     def accept_message(self, params):
-        # parameters are: 
-        # text=message%20body
-        # from=2347067277331
-        # sent=200904091443.21
-        # mtech_received=200904091444.48
-        # operator_received=200904091444.4
-        
-        text = None
-        sender = None
-        date = None
-        for key,val in params:
-            if key == "text":
-                # TODO watch out because urllib.unquote will blow up on unicode text 
-                text = _str(text)
-                text = urllib.unquote(val)
-                text = _uni(text)
-            elif key == "from":
-                sender = val
-            elif key == "sent":
-                date = datetime.strptime(val, "%Y%m%d%H%M.%S")
-        
-        if text and sender: 
-            # respond with the number and text 
-            msg = self.server.backend.message(text, sender, date)
+        text = params.get(self.text_param)
+        sender = params.get(self.identity_param)
+        date = self.parse_date(params.get(self.date_param))
+
+        if text and sender:
+            # respond with the number and text
+            msg = self.server.backend.message(sender, text, date)
             self.server.backend.route(msg)
-            self.respond(200, "{'phone':'%s', 'message':'%s'}" % (sender, _str(text)))
-            return
+            self.respond(200, u"{'phone':'%s', 'message':'%s'}" % (sender, text))
         else:
-            self.respond(500, "You must specify a valid number and message")
-            return
+            self.respond(400, "You must specify a valid number and message")
+
+    @classmethod
+    def outgoing_request(klass, backend, msg):
+        '''Returns the (method, url, body) of the request
+           which sends _msg_ to _backend_'s gateway'''
+        query = urllib.urlencode([
+            (klass.out_identity_param, _str(msg.connection.identity)),
+            (klass.out_text_param, _str(msg.text))])
+        if backend.outgoing_method == "POST":
+            return "POST", backend.outgoing_url, query
+        separator = ("?" in backend.outgoing_url) and "&" or "?"
+        return "GET", backend.outgoing_url + separator + query, None
+
+    @classmethod
+    def outgoing(klass, msg):
+        '''Sends _msg_ to the gateway (via the backend's pooled
+           client, which retries it if the gateway is unavailable)'''
+        backend = msg.connection.backend
+        if backend.outgoing_url is None:
+            # (raised, so that the message is counted as failed)
+            raise Exception("No outgoing_url is configured, so %s can't send to %s" % (
+                backend.slug, msg.connection.identity))
+        method, url, body = klass.outgoing_request(backend, msg)
+        backend.client.request(method, url, body)
+
+class MTechHandler(GatewayHandler):
+    '''An HttpHandler for the mtech gateway, for use in Nigeria.
+       The parameters are:
+         text=message%20body
+         from=2347067277331
+         sent=200904091443.21
+         mtech_received=200904091444.48
+         operator_received=200904091444.4'''
 
-    def outgoing(self, message):
-        '''An HttpHandler for the mtech gateway, for use in Nigeria'''
-        self.log_message("Mtech outgoing message: %s" % message)
+    date_format = "%Y%m%d%H%M.%S"
 
 class UptimeHandler(RapidBaseHttpHandler):
-    '''This is a dummy httphandler just to test whether route is responsive'''  
+    '''This is a dummy httphandler just to test whether route is responsive'''
     def do_GET(self):
         if _is_uptime_check(self):
             self.respond(200, "success")
+        else:
+            self.respond(404, "Not found")
 
 def _is_uptime_check(handler):
     '''Determines whether the server is an uptime check
@@ -189,19 +269,17 @@ def _is_uptime_check(handler):
         if param[0] == "uptimecheck":
             return True
     return False
-        
+
 def get_params(handler):
-    '''Pulls the parameters from a query string and returns them in
-       a dictionary'''
-    querystart = handler.path.find("?")
-    if querystart == -1:
+    '''Pulls the parameters from a query string and returns them as
+       a list of (name, value) pairs'''
+    query = urlparse.urlsplit(handler.path)[3]
+    if not query:
         return
-    return map((lambda t: t.split("=")), handler.path[querystart + 1:].split("&"))
+    return _parse_qs(query)
 
 def post_params(handler):
-    '''Pulls the parameters from the body of a POST and returns them
-       in a dictionary'''
+    '''Pulls the parameters from the body of a (url-encoded) POST and
+       returns them as a list of (name, value) pairs'''
     if handler.rfile:
-        content_len = int(handler.headers["Content-Length"])
-        data = handler.rfile.read(content_len)
-        return map((lambda t: t.split("=")), data.split("&"))
+        return _parse_qs(handler.read_body())
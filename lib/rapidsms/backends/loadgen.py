@@ -0,0 +1,269 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4
+
+"""
+A backend which generates synthetic traffic, to measure the throughput
+and latency of the router and the apps it's running (see the loadtest
+command in rapidsms.manager).
+
+Messages are sent from _identities_ virtual phones, at _rate_ messages
+per second (ramping up or down to _ramp_to_ over _ramp_secs_, if set),
+for _duration_ seconds (after waiting _delay_ seconds for the apps to
+start). Each message is one of the kinds listed in _mix_, as kind:weight
+pairs. The text of each kind is one of the templates in the option of
+the same name, separated by "|", which can include %(n)d (the number
+of the message), %(identity)s (the sender), and %(peer)s (another
+virtual phone).
+
+Each virtual phone only has one message outstanding at a time, so the
+first response to it can be matched to the message which it answers,
+to measure the latency from the backend, through the router and apps,
+and back to the backend. Messages which aren't answered within
+_timeout_ seconds are counted as unanswered, and any other messages
+sent to the virtual phones (like the other end of a blast) as received.
+
+"""
+
+from __future__ import with_statement
+import time
+import random
+import threading
+import backend
+from rapidsms.message import Message
+from rapidsms.connection import Connection
+
+DEFAULT_MIX = "direct:40,command:30,survey:20,blast:10"
+DEFAULT_TEXTS = {
+    "direct":  "@%(peer)s loadgen direct %(n)d",
+    "command": ".help|.join loadgen",
+    "survey":  "test",
+    "blast":   "loadgen blast %(n)d" }
+
+
+def percentile(values, p):
+    """Returns the _p_th percentile (0-100) of the sorted _values_"""
+    if not values:
+        return None
+    index = int(round((p / 100.0) * (len(values) - 1)))
+    return values[index]
+
+
+class Kind(object):
+    """The texts and counters of one kind of generated traffic"""
+
+    def __init__(self, name, weight, texts):
+        self.name = name
+        self.weight = weight
+        self.texts = texts
+        self.sent = 0
+        self.answered = 0
+        self.unanswered = 0
+        self.latencies = []
+
+    def stats(self):
+        latencies = sorted(self.latencies)
+        return {
+            "sent":       self.sent,
+            "answered":   self.answered,
+            "unanswered": self.unanswered,
+            "p50":        percentile(latencies, 50),
+            "p95":        percentile(latencies, 95),
+            "p99":        percentile(latencies, 99),
+            "max":        latencies and latencies[-1] or None }
+
+
+class GeneratedMessage(Message):
+    """A message from a virtual phone, marked with its serial number.
+       Its responses are copies of it (see Message.respond), so they
+       carry the mark, and can be told apart from anything else sent
+       to the same phone (like the other end of a blast)"""
+
+    journal_attributes = ("loadgen",)
+
+    def __init__(self, *args, **kwargs):
+        self.loadgen = kwargs.pop("loadgen", None)
+        Message.__init__(self, *args, **kwargs)
+
+
+class Backend(backend.Backend):
+    def configure(self, rate=50, ramp_to=None, ramp_secs=60, duration=60,
+                  identities=1000, prefix="99", mix=DEFAULT_MIX, timeout=30,
+                  delay=1, seed=None, **texts):
+        self.rate = float(rate)
+        self.ramp_to = ramp_to and float(ramp_to)
+        self.ramp_secs = float(ramp_secs)
+        self.duration = float(duration)
+        self.timeout = float(timeout)
+        self.delay = float(delay)
+        self.random = random.Random(seed)
+        self.identities = ["%s%07d" % (prefix, n) for n in range(int(identities))]
+
+        self.kinds = []
+        for item in mix.split(","):
+            name, weight = item.strip().split(":")
+            templates = texts.pop(name, DEFAULT_TEXTS.get(name))
+            if templates is None:
+                raise Exception("No texts are configured for '%s' messages" % name)
+            self.kinds.append(Kind(name, float(weight), templates.split("|")))
+        if texts:
+            raise Exception("Unknown loadgen options: %s" % ", ".join(texts.keys()))
+
+        self.lock = threading.Lock()
+        # identity -> (kind, time sent, serial) of the
+        # message awaiting a response
+        self.pending = {}
+        self.serial = 0
+        self.idle = list(self.identities)
+        self.skipped = 0 # no idle phone to send from
+        self.received = 0
+        self.started = None
+        self.stopped = None
+        self.finished = threading.Event()
+
+    def current_rate(self, elapsed):
+        """The number of messages per second to send, _elapsed_
+           seconds after the traffic started"""
+        if self.ramp_to is None or self.ramp_secs <= 0:
+            return self.rate
+        progress = min(elapsed / self.ramp_secs, 1.0)
+        return self.rate + (self.ramp_to - self.rate) * progress
+
+    def run(self):
+        # (finished is set however this ends, so that the loadtest
+        # command never waits for it forever)
+        try:
+            # give the apps a moment to start
+            time.sleep(self.delay)
+            self.started = time.time()
+            due = self.started
+            n = 0
+            while self.running:
+                now = time.time()
+                elapsed = now - self.started
+                if elapsed >= self.duration:
+                    break
+                self.expire(now)
+
+                rate = self.current_rate(elapsed)
+                if rate <= 0:
+                    time.sleep(0.1)
+                    due = time.time()
+                    continue
+                n += 1
+                self.generate(n)
+
+                # sleep until the next message is due. (if sending falls
+                # behind, the next ones are sent without sleeping, to
+                # keep up the rate)
+                due += 1.0 / rate
+                delay = due - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+            self.stopped = time.time()
+
+            # wait for the last responses, without sending any more
+            while self.running and self.pending and time.time() - self.stopped < self.timeout:
+                time.sleep(0.1)
+            self.expire(time.time() + self.timeout)
+        finally:
+            self.finished.set()
+
+    def choose_kind(self):
+        total = sum([k.weight for k in self.kinds])
+        pick = self.random.uniform(0, total)
+        for kind in self.kinds:
+            pick -= kind.weight
+            if pick <= 0:
+                return kind
+        return self.kinds[-1]
+
+    def generate(self, n):
+        """Sends the _n_th message from an idle virtual phone"""
+        with self.lock:
+            if not self.idle:
+                self.skipped += 1
+                return None
+            identity = self.idle.pop(self.random.randrange(len(self.idle)))
+            kind = self.choose_kind()
+            text = self.random.choice(kind.texts) % {
+                "n": n, "identity": identity,
+                "peer": self.random.choice(self.identities) }
+            kind.sent += 1
+            self.serial += 1
+            serial = self.serial
+            self.pending[identity] = (kind, time.time(), serial)
+
+        msg = GeneratedMessage(Connection(self, identity), text, date=None, loadgen=serial)
+        self.route(msg)
+        return msg
+
+    def send(self, message):
+        """Called (by the router) with each outgoing message, which
+           is matched to the message it answers, if it's a response
+           to the phone's pending message. anything else (like the
+           other end of a blast) is counted as received"""
+        now = time.time()
+        identity = message.connection.identity
+        with self.lock:
+            pending = self.pending.get(identity)
+            mark = getattr(message, "loadgen", None)
+            if pending is None or mark is None or pending[2] != mark:
+                self.received += 1
+                return True
+            del self.pending[identity]
+            kind, sent, serial = pending
+            kind.answered += 1
+            kind.latencies.append(now - sent)
+            self.idle.append(identity)
+        return True
+
+    def expire(self, now):
+        """Gives up on the messages sent more than _timeout_ seconds
+           before _now_, freeing their phones to send again"""
+        with self.lock:
+            for identity, (kind, sent, serial) in self.pending.items():
+                if now - sent >= self.timeout:
+                    del self.pending[identity]
+                    kind.unanswered += 1
+                    self.idle.append(identity)
+
+    def stats(self):
+        with self.lock:
+            kinds = dict([(k.name, k.stats()) for k in self.kinds])
+            total = Kind("all", 0, [])
+            for kind in self.kinds:
+                total.sent += kind.sent
+                total.answered += kind.answered
+                total.unanswered += kind.unanswered
+                total.latencies.extend(kind.latencies)
+            kinds["all"] = total.stats()
+            elapsed = ((self.stopped or time.time()) - self.started) if self.started else 0
+            return {
+                "elapsed":    elapsed,
+                "throughput": elapsed and (total.answered / elapsed) or 0.0,
+                "offered":    elapsed and (total.sent / elapsed) or 0.0,
+                "skipped":    self.skipped,
+                "received":   self.received,
+                "kinds":      kinds }
+
+    def report(self):
+        """Returns the stats as a table, for printing"""
+        stats = self.stats()
+        lines = [
+            "%s: %.1f msg/sec offered, %.1f msg/sec answered, over %.1f secs" % (
+                self.slug, stats["offered"], stats["throughput"], stats["elapsed"]),
+            "%d not sent (no idle phones), %d other messages received" % (
+                stats["skipped"], stats["received"]),
+            "%-10s %8s %8s %10s %9s %9s %9s %9s" % (
+                "kind", "sent", "answered", "unanswered", "p50 ms", "p95 ms", "p99 ms", "max ms")]
+
+        def ms(value):
+            return (value is None) and "-" or ("%.1f" % (value * 1000))
+
+        names = [k.name for k in self.kinds] + ["all"]
+        for name in names:
+            s = stats["kinds"][name]
+            lines.append("%-10s %8d %8d %10d %9s %9s %9s %9s" % (
+                name, s["sent"], s["answered"], s["unanswered"],
+                ms(s["p50"]), ms(s["p95"]), ms(s["p99"]), ms(s["max"])))
+        return "\n".join(lines)
@@ -1,76 +1,365 @@
 #!/usr/bin/env python
 # vim: ai ts=4 sts=4 et sw=4
 
+"""
+A backend which receives messages from the IncomingMessage queue in the
+database, which the dbmessagelog http front end (httplog.views.api)
+adds them to, and saves each message's responses for that view to send
+back as its http response.
+
+Messages are claimed from the queue in batches of up to _batch_, and up
+to _in_flight_ of them are routed at once. Rather than sleeping until
+each one is processed, the backend is called back when the router has
+finished with a message and its responses have been sent, and marks the
+finished messages as processed ("P") together.
+
+The view tells the backend as soon as it has queued a message, and is
+told as soon as it's done with (see httplog.notify), so neither end
+polls the database. The backend still sweeps the queue every _interval_
+seconds, for messages which were queued while it wasn't listening.
+Messages which aren't processed within _timeout_ seconds are marked as
+timed out ("T"), and their view gives up waiting for them.
+
+Only one router should claim messages from each database.
+
+"""
+
+from __future__ import with_statement
 import time
-from rapidsms.backends import Backend
-from rapidsms.message import Message
-from utilities.dbmessagelog.httplog.models import * 
+import threading
 from datetime import datetime
+from django.db import connection as db, transaction
+import backend
+from rapidsms.message import Message
+from rapidsms.connection import Connection
+from rapidsms.cache import LRUCache
+from utilities.dbmessagelog.httplog.models import *
+from utilities.dbmessagelog.httplog import notify
+
+# how long (in seconds) to remember which view is waiting for each
+# message, and that a message has been finished (in case the view's
+# notification arrives after the message was claimed by a sweep)
+WAITER_TTL = 60
+
+
+class QueuedMessage(Message):
+    """An incoming message from the queue, which tells its backend
+       once the router has processed it. The message's responses are
+       copies of it (see Message.respond), so they keep its _row_id_,
+       and are saved as responses to that IncomingMessage (rather than
+       to whichever message from the same phone is being handled)"""
+
+    # (so a message spilled from the router's queue is still finished)
+    journal_attributes = ("row_id",)
+
+    def __init__(self, *args, **kwargs):
+        self.row_id = kwargs.pop("row_id", None)
+        Message.__init__(self, *args, **kwargs)
+
+    def _get_processed(self):
+        return self._processed
+
+    def _set_processed(self, processed):
+        # the router sets this once the message
+        # has been handled, and its responses flushed
+        self._processed = processed
+        if processed and self.row_id is not None:
+            self.connection.backend.processed(self.row_id)
+
+    processed = property(_get_processed, _set_processed)
+
+    def flush_responses(self, callback=None):
+        # the message isn't finished until each of its
+        # responses has been sent (which might happen
+        # later, on one of the router's outbound threads)
+        while self.responses:
+            response = self.responses.popleft()
+            if self.row_id is not None:
+                self.connection.backend.expect(self.row_id)
+            response.connection.backend.router.queue_outgoing(
+                response, self.__sent(callback))
+
+    def __sent(self, callback):
+        def sent(response):
+            if self.row_id is not None:
+                self.connection.backend.delivered(self.row_id)
+            if callback is not None:
+                callback(response)
+        return sent
+
+
+class InFlight(object):
+    """An IncomingMessage which has been claimed, and routed"""
+
+    def __init__(self, row):
+        self.row = row
+        self.claimed = time.time()
+        self.outstanding = 0 # responses not sent yet
+        self.processed = False
+        self.responses = [] # (text, time) of each one
+
+
+class Backend(backend.Backend):
+    def configure(self, interval=2, timeout=10, batch=20, in_flight=100,
+                  notify_host=notify.HOST, notify_port=notify.PORT):
+        self.interval = float(interval)
+        self.timeout = float(timeout)
+        self.batch = int(batch)
+        self.max_in_flight = int(in_flight)
+        self.notify_address = (notify_host, int(notify_port))
+        self.throttled = False
+        self.watching = False
+
+        # IncomingMessage id -> InFlight, of the messages being
+        # handled. these are shared with the router's threads. the
+        # backend's thread claims, finishes and expires the messages,
+        # but send() and send_many() are called from whichever thread
+        # sends (the router's, or an outbound sender's), and save the
+        # messages which don't answer one in flight right away
+        self.lock = threading.Lock()
+        self.in_flight = {}
+        self.finished = []
+
+        self.waiters = LRUCache(1000, max_age=WAITER_TTL)
+        self.recent = LRUCache(1000, max_age=WAITER_TTL)
+        self.listener = None
+        # whether to claim messages right away (rather than at the
+        # next sweep), and whether the last claim might have left some
+        self.wanted = False
+        self.more = False
+
+        self.claimed = 0
+        self.processed_count = 0
+        self.timed_out = 0
+
+    def __throttle(self, queue):
+        self.info("Router queue is filling up (%d waiting); pausing", queue.qsize())
+        self.throttled = True
 
-class Backend(Backend):
-    def configure(self, interval=2, timeout=10):
-        self.interval = interval
-        self.timeout = timeout
+    def __unthrottle(self, queue):
+        self.info("Router queue has drained (%d waiting); resuming", queue.qsize())
+        self.throttled = False
+        self.wanted = True
+        self.__wake()
 
     def run(self):
-        while self.running:
-
-            # look for any new incoming messages
-            # in the database, and route them
-            for incoming_msg in IncomingMessage.objects.filter(status="R"):
-                incoming_msg.status = "H"
-                incoming_msg.save()
-                msg = self.message(incoming_msg.phone, incoming_msg.text, incoming_msg.time)
-                self.route(msg)
-
-                # pause until the msg.processed
-                # flag is set, to indicate that
-                # rapidsms is done with it
-                timestep = 0.5
-                countdown = self.timeout
-                while countdown > 0:
-                    if msg.processed:
-                        break
-
-                    # wait a short time before checking
-                    # again, to avoid pegging the cpu
-                    countdown -= timestep
-                    time.sleep(timestep)
-
-                # mark the message, so we don't
-                # receive it again next time
-                if msg.processed:
-                    incoming_msg.status = "P"
-                    incoming_msg.save()
-
-                else:
-                    # TODO: should we do anything other than warn, here?
-                    #self.warn("Router timed out while processing incoming message")
-                    pass 
-            # wait a few seconds
-            # before polling again
-            time.sleep(self.interval)
+        # stop fetching new messages from the database while the
+        # router's queue is above its high watermark (if it has one)
+        if not self.watching:
+            self.watching = self.router.watch_queue(self.__throttle, self.__unthrottle)
+
+        self.listener = notify.Listener(*self.notify_address)
+        if not self.listener.bound:
+            self.warning("Couldn't listen on %s:%d; the http front end will "
+                "have to wait for each message to time out" % self.notify_address)
+
+        try:
+            next_sweep = 0
+            while self.running:
+                try:
+                    self.receive()
+                    self.finish()
+                    self.expire(time.time())
+
+                    # claim more messages if we've been told about some,
+                    # or it's time to sweep, or the last claim was cut
+                    # short and there's room for more now
+                    now = time.time()
+                    if self.wanted or now >= next_sweep or (self.more and self.__room() > 0):
+                        self.wanted = False
+                        self.more = self.claim()
+                        next_sweep = now + self.interval
+                except Exception:
+                    # (the database might be gone.) try again next sweep
+                    self.log_last_exception("Couldn't process the message queue")
+                    self.more = False
+                    next_sweep = time.time() + self.interval
+
+                # sleep until something happens, or the next sweep
+                if not (self.wanted or (self.more and self.__room() > 0)):
+                    self.listener.wait(min(next_sweep - time.time(), self.__next_expiry()))
+        finally:
+            self.listener.close()
+            # this thread's database connection isn't used again
+            db.close()
+
+    def stop(self):
+        backend.Backend.stop(self)
+        self.__wake()
+
+    def __next_expiry(self):
+        with self.lock:
+            if not self.in_flight:
+                return self.interval
+            oldest = min([f.claimed for f in self.in_flight.itervalues()])
+        return oldest + self.timeout - time.time()
+
+    def __wake(self):
+        if self.listener is not None:
+            self.listener.wake()
+
+    def receive(self):
+        """Notes which views are waiting for which messages"""
+        for id, address in self.listener.receive():
+            if id in self.recent:
+                # it was finished before the view's notification arrived
+                self.listener.done(id, address)
+            else:
+                self.waiters.put(id, address)
+                self.wanted = True
+
+    def __room(self):
+        with self.lock:
+            return min(self.batch, self.max_in_flight - len(self.in_flight))
+
+    def claim(self):
+        """Claims up to _batch_ waiting messages (as many as there's room
+           in flight for), and routes them. Returns True if there might
+           be more waiting (because it claimed as many as it could)"""
+        room = self.__room()
+        if self.throttled or room <= 0:
+            return room <= 0
+
+        # claim the oldest messages, which haven't been claimed by now
+        ids = list(IncomingMessage.objects.filter(status="R")\
+            .order_by("id").values_list("id", flat=True)[:room])
+        if not ids:
+            return False
+        IncomingMessage.objects.filter(id__in=ids, status="R").update(status="H")
+        rows = IncomingMessage.objects.filter(id__in=ids, status="H").order_by("id")
+
+        count = 0
+        for row in rows:
+            with self.lock:
+                self.in_flight[row.id] = InFlight(row)
+            self.route(QueuedMessage(Connection(self, row.phone),
+                row.text, date=row.time, row_id=row.id))
+            count += 1
+        self.claimed += count
+        return len(ids) == room
+
+    def expect(self, id):
+        """Called when a response to message _id_ is queued to be sent"""
+        with self.lock:
+            entry = self.in_flight.get(id)
+            if entry is not None:
+                entry.outstanding += 1
+
+    def delivered(self, id):
+        """Called when a response to message _id_ has been sent (or not)"""
+        with self.lock:
+            entry = self.in_flight.get(id)
+            if entry is None:
+                return
+            entry.outstanding -= 1
+            self.__check(entry)
+
+    def processed(self, id):
+        """Called (by the router's thread) once message _id_ has been handled"""
+        with self.lock:
+            entry = self.in_flight.get(id)
+            if entry is None:
+                return
+            entry.processed = True
+            self.__check(entry)
+
+    def __check(self, entry):
+        # (called with the lock held)
+        if entry.processed and entry.outstanding <= 0:
+            del self.in_flight[entry.row.id]
+            self.finished.append(entry)
+            self.__wake()
+
+    def finish(self):
+        """Saves the responses to the finished messages, marks them as
+           processed, and tells the views which are waiting for them"""
+        with self.lock:
+            finished, self.finished = self.finished, []
+        if not finished:
+            return 0
+
+        for entry in finished:
+            if entry.responses:
+                entry.row.responses.add(*[
+                    OutgoingMessage.objects.create(phone=entry.row.phone,
+                        text=text, time=sent, status="R")
+                    for text, sent in entry.responses])
+        ids = [entry.row.id for entry in finished]
+        IncomingMessage.objects.filter(id__in=ids, status="H").update(status="P")
+        self.processed_count += len(ids)
+        self.__notify(ids)
+        return len(ids)
+
+    def expire(self, now):
+        """Gives up on the messages claimed more than _timeout_ seconds
+           before _now_, marking them as timed out"""
+        with self.lock:
+            expired = [id for id, entry in self.in_flight.iteritems()
+                if now - entry.claimed >= self.timeout]
+            for id in expired:
+                del self.in_flight[id]
+        if not expired:
+            return 0
+
+        self.warning("Router timed out while processing incoming messages %s", expired)
+        IncomingMessage.objects.filter(id__in=expired, status="H").update(status="T")
+        self.timed_out += len(expired)
+        self.__notify(expired)
+        return len(expired)
+
+    def __notify(self, ids):
+        for id in ids:
+            self.recent.put(id, True)
+            address = self.waiters.pop(id)
+            if address is not None:
+                self.listener.done(id, address)
+
+    def __attach(self, msg, sent):
+        # responses are kept with the message they answer, and saved
+        # along with it. (as they used to be, messages sent directly
+        # via the router to a phone with one message in flight are
+        # treated as responses.) returns False for any other message
+        with self.lock:
+            entry = self.in_flight.get(getattr(msg, "row_id", None))
+            if entry is None:
+                entries = [e for e in self.in_flight.itervalues()
+                    if e.row.phone == msg.connection.identity]
+                if len(entries) == 1:
+                    entry = entries[0]
+            if entry is None:
+                return False
+            entry.responses.append((msg.text, sent))
+            return True
 
     def send(self, msg):
-        outgoing = OutgoingMessage(
-            phone = msg.connection.identity,
-            time = datetime.now(),
-            text = msg.text,
-            status = "R"
-        )
-        outgoing.save()
-        try: 
-            # if this is a response then we we need a handle 
-            # to the original message we are responding to.
-            # As a first pass, assume that there is only one message
-            # per person in the "handle" phase and we just look it 
-            # up in the db
-            original_msg = IncomingMessage.objects.get(status="H", phone=msg.connection.identity)
-            original_msg.responses.add(outgoing)
-            original_msg.save()
-        except IncomingMessage.DoesNotExist:
-            # this might just be a standard outgoing message 
-            # so don't do anything special
-            pass
-        
-        
\ No newline at end of file
+        sent = datetime.now()
+        if not self.__attach(msg, sent):
+            OutgoingMessage.objects.create(phone=msg.connection.identity,
+                text=msg.text, time=sent, status="R")
+        return True
+
+    def send_many(self, messages):
+        """Saves a batch of _messages_ (like a blast) with a single
+           INSERT, rather than one per message"""
+        sent = datetime.now()
+        rows = [(msg.connection.identity, db.ops.value_to_db_datetime(sent), msg.text, "R")
+            for msg in messages if not self.__attach(msg, sent)]
+        if not rows:
+            return
+
+        meta = OutgoingMessage._meta
+        qn = db.ops.quote_name
+        columns = [qn(meta.get_field(name).column) for name in ("phone", "time", "text", "status")]
+        sql = "INSERT INTO %s (%s) VALUES (%s)" % (
+            qn(meta.db_table), ", ".join(columns), ", ".join(["%s"] * len(columns)))
+        db.cursor().executemany(sql, rows)
+        transaction.commit_unless_managed()
+
+    def stats(self):
+        with self.lock:
+            in_flight = len(self.in_flight)
+        return {
+            "in_flight": in_flight,
+            "claimed":   self.claimed,
+            "processed": self.processed_count,
+            "timed_out": self.timed_out }
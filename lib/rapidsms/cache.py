@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4
+
+import time
+import threading
+
+
+class LRUCache (object):
+    """A thread-safe dict-like cache, holding up to _size_ items. When it
+       is full, adding an item evicts the one which was least recently
+       used. If _max_age_ (in seconds) is given, items older than that
+       are treated as missing, so changes made elsewhere are picked up.
+       _on_evict_ is called with the key and value of every item which is
+       dropped for either of those reasons (but not popped or cleared)."""
+
+    def __init__(self, size=1000, max_age=None, on_evict=None):
+        if size < 1:
+            raise ValueError("An LRUCache must hold at least one item (got %d)" % size)
+        self.size = size
+        self.max_age = max_age
+        self.on_evict = on_evict
+        self.lock = threading.RLock()
+
+        # key -> [key, value, added, prev, next]. the entries form a
+        # circular doubly linked list (with a sentinel), ordered from
+        # the most recently used, so moving and evicting is O(1)
+        self.entries = {}
+        self.head = [None, None, None, None, None]
+        self.head[3] = self.head[4] = self.head
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return self.get(key, count=False) is not None
+
+    def __unlink(self, entry):
+        entry[3][4] = entry[4]
+        entry[4][3] = entry[3]
+
+    def __push(self, entry):
+        entry[3] = self.head
+        entry[4] = self.head[4]
+        self.head[4][3] = entry
+        self.head[4] = entry
+
+    def __evict(self, entry):
+        self.__unlink(entry)
+        del self.entries[entry[0]]
+        if self.on_evict is not None:
+            self.on_evict(entry[0], entry[1])
+
+    def get(self, key, default=None, count=True):
+        self.lock.acquire()
+        try:
+            entry = self.entries.get(key)
+            if entry is not None and self.max_age is not None and \
+                    time.time() - entry[2] > self.max_age:
+                self.__evict(entry)
+                entry = None
+
+            if entry is None:
+                if count: self.misses += 1
+                return default
+
+            if count: self.hits += 1
+            self.__unlink(entry)
+            self.__push(entry)
+            return entry[1]
+        finally:
+            self.lock.release()
+
+    def put(self, key, value):
+        self.lock.acquire()
+        try:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.__unlink(entry)
+            elif len(self.entries) >= self.size:
+                self.__evict(self.head[3])
+                self.evictions += 1
+
+            entry = [key, value, time.time(), None, None]
+            self.entries[key] = entry
+            self.__push(entry)
+        finally:
+            self.lock.release()
+
+    def pop(self, key, default=None):
+        self.lock.acquire()
+        try:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                return default
+            self.__unlink(entry)
+            return entry[1]
+        finally:
+            self.lock.release()
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.entries = {}
+            self.head[3] = self.head[4] = self.head
+        finally:
+            self.lock.release()
+
+    def keys(self):
+        """Returns the keys, from the most to the least recently used."""
+        self.lock.acquire()
+        try:
+            keys = []
+            entry = self.head[4]
+            while entry is not self.head:
+                keys.append(entry[0])
+                entry = entry[4]
+            return keys
+        finally:
+            self.lock.release()
+
+    def stats(self):
+        return {
+            "size":      len(self.entries),
+            "hits":      self.hits,
+            "misses":    self.misses,
+            "evictions": self.evictions }
@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4 encoding=utf-8
+
+"""
+A catalog of localized message templates, for apps which reply in the
+sender's language (like smsforum and rapidsuivi).
+
+The gettext catalogs are loaded once, and each (locale, key) template
+is compiled the first time it's used: its placeholders are found, and
+the encoding (GSM or UCS-2) and length of its fixed text are worked out.
+Rendering a template then only has to check the values substituted into
+it, rather than re-encoding the whole message, to know how it will be
+sent, and whether it fits in an SMS.
+
+Lengths are counted as they will be sent: in septets for GSM (where a
+few characters, like '{' and '^', take two) and in characters for UCS-2.
+
+"""
+
+from __future__ import with_statement
+import re
+import time
+import gettext
+import threading
+
+# registers the 'gsm' codec
+from pygsm import gsmcodecs
+from rapidsms.cache import LRUCache
+
+MAX_LENGTH = { "gsm": 160, "ucs2": 70 }
+
+# python's %-format placeholders, e.g. "%(name)s", "%d" or "%%"
+PLACEHOLDER = re.compile(r"%(?:\((\w+)\))?[#0\- +]*(?:\*|\d+)?(?:\.(?:\*|\d+))?[hlL]?([diouxXeEfFgGcrs%])")
+
+# the GSM cost of short strings (names, signatures, etc), since
+# the same ones are checked over and over. -1 means not GSM
+_gsm_cache = LRUCache(2000)
+
+
+def gsm_length(text):
+    """Returns the number of septets _text_ takes in the GSM 03.38
+       alphabet, or None if it must be sent as UCS-2."""
+    if not isinstance(text, basestring):
+        text = unicode(text)
+    cacheable = len(text) <= 64
+    if cacheable:
+        length = _gsm_cache.get(text)
+        if length is None:
+            length = _encode_gsm(text)
+            _gsm_cache.put(text, length)
+    else:
+        length = _encode_gsm(text)
+    if length < 0:
+        return None
+    return length
+
+
+def _encode_gsm(text):
+    try:
+        return len(text.encode("gsm"))
+    except Exception:
+        return -1
+
+
+def is_gsm(text):
+    """Returns True if _text_ can be encoded in the GSM 03.38 alphabet,
+       or False if a message containing it must be sent as UCS-2."""
+    return gsm_length(text) is not None
+
+
+def encoded_length(text):
+    """Returns the encoding ("gsm" or "ucs2") which _text_ would be
+       sent with, and its length in that encoding"""
+    length = gsm_length(text)
+    if length is None:
+        return "ucs2", len(text)
+    return "gsm", length
+
+
+class Rendered(unicode):
+    """The text of a rendered Template, which also knows how it will be
+       encoded ("gsm" or "ucs2"), its _length_ in that encoding, and so
+       whether it fits in one SMS."""
+
+    def __new__(cls, text, encoding, length):
+        self = unicode.__new__(cls, text)
+        self.encoding = encoding
+        self.length = length
+        return self
+
+    def __reduce__(self):
+        # (so replies can be pickled, e.g. into a queue's journal)
+        return (Rendered, (unicode(self), self.encoding, self.length))
+
+    @property
+    def max_length(self):
+        return MAX_LENGTH[self.encoding]
+
+    def fits(self, max_gsm=MAX_LENGTH["gsm"], max_ucs2=MAX_LENGTH["ucs2"]):
+        limit = (self.encoding == "gsm") and max_gsm or max_ucs2
+        return self.length <= limit
+
+
+class Template(object):
+    """A localized message, compiled for rendering. _static_length_ is
+       the length of the text around the placeholders (in septets, if
+       _gsm_ is True, i.e. that text can be sent as GSM)."""
+
+    def __init__(self, text):
+        self.text = text
+        self.names = []
+        self.positional = 0
+        # whether the values' lengths add up to the rendered
+        # length, i.e. all the placeholders are plain "%s"
+        self.countable = True
+        static = PLACEHOLDER.sub(self.__placeholder, text)
+        self.static_gsm = gsm_length(static)
+        self.gsm = self.static_gsm is not None
+        if self.gsm:
+            self.static_length = self.static_gsm
+        else:
+            self.static_length = len(static)
+
+    def __placeholder(self, match):
+        name, conversion = match.groups()
+        if conversion == "%":
+            return "%"
+        if name is not None:
+            self.names.append(name)
+        else:
+            self.positional += 1
+        if conversion != "s" or match.group(0) not in ("%s", "%%(%s)s" % name):
+            self.countable = False
+        return ""
+
+    def render(self, values=None):
+        """Returns the Rendered text, with _values_ (a dict, tuple or
+           single value, as for the % operator) substituted in. Raises
+           TypeError or KeyError if they don't match the placeholders."""
+        if values is None:
+            return Rendered(self.text, self.gsm and "gsm" or "ucs2", self.static_length)
+
+        text = self.text % values
+        if not self.gsm:
+            return Rendered(text, "ucs2", len(text))
+
+        if self.countable:
+            # only the substituted values can make it UCS-2 (or
+            # change its length), so there's no need to encode
+            # the whole text
+            if isinstance(values, dict):
+                values = [values[name] for name in self.names]
+            elif not isinstance(values, tuple):
+                values = [values]
+            length = self.static_gsm
+            for value in values:
+                n = gsm_length(value)
+                if n is None:
+                    return Rendered(text, "ucs2", len(text))
+                length += n
+            return Rendered(text, "gsm", length)
+
+        # the values are formatted (e.g. "%d"), so they
+        # can't be counted separately. check the whole text
+        encoding, length = encoded_length(text)
+        return Rendered(text, encoding, length)
+
+
+class Catalog(object):
+    """The message templates of one app, in each of its languages.
+       _translations_ is a dict of locale -> gettext translations, and
+       messages for any other locale are in the _default_ locale."""
+
+    def __init__(self, translations, default):
+        self.translations = translations
+        self.default = default
+        self.templates = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.renders = 0
+        self.render_time = 0.0
+
+    @classmethod
+    def load(klass, path, domain, locales, default):
+        """Loads the gettext catalogs of _domain_ for each of _locales_
+           from _path_ (falling back to _default_'s, for missing keys)."""
+        translations = {}
+        for locale in locales:
+            translations[locale] = gettext.translation(domain, path, [locale, default])
+        return klass(translations, default)
+
+    def template(self, locale, key):
+        """Returns the compiled Template for _key_ in _locale_"""
+        if locale not in self.translations:
+            locale = self.default
+        template = self.templates.get((locale, key))
+        if template is not None:
+            self.hits += 1
+            return template
+
+        self.misses += 1
+        translator = self.translations.get(locale)
+        text = translator and translator.ugettext(key) or unicode(key)
+        template = Template(text)
+        with self.lock:
+            self.templates[(locale, key)] = template
+        return template
+
+    def translate(self, locale, key):
+        return self.template(locale, key).text
+
+    def render(self, locale, key, values=None):
+        """Returns _key_ in _locale_, rendered with _values_, as a
+           Rendered string (see Template.render)"""
+        template = self.template(locale, key)
+        start = time.time()
+        try:
+            return template.render(values)
+        finally:
+            self.renders += 1
+            self.render_time += time.time() - start
+
+    def reset(self):
+        """Discards the compiled templates (e.g. after the default
+           locale is changed)"""
+        with self.lock:
+            self.templates = {}
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "templates":   len(self.templates),
+            "hits":        self.hits,
+            "misses":      self.misses,
+            "hit_rate":    lookups and (float(self.hits) / lookups) or 0.0,
+            "renders":     self.renders,
+            "render_time": self.renders and (self.render_time / self.renders) or 0.0 }
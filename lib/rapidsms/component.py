@@ -137,10 +137,39 @@ class Component(object):
 
 class Receiver(Component):
     def __init__(self):
-        # do we want to put a limit on the queue size?
-        # and what do we do if the queue gets full?
+        # unbounded by default. the queue can be limited via
+        # the queue_* config options (see limit_queue)
         self._queue = Queue.Queue()
 
+    def _configure(self, queue_size=0, queue_overflow="block", queue_journal=None,
+                   queue_high=None, queue_low=None, **kwargs):
+        if int(queue_size) > 0 or queue_high is not None:
+            self.limit_queue(int(queue_size), queue_overflow, queue_journal,
+                queue_high and int(queue_high), queue_low and int(queue_low))
+        Component._configure(self, **kwargs)
+
+    def limit_queue(self, maxsize, overflow="block", journal=None, high=None, low=None):
+        """Replaces this component's queue with a MessageQueue holding at
+           most _maxsize_ messages, handling overflow according to one of
+           queues.OVERFLOW_POLICIES. This must be called before any
+           messages have been queued."""
+        if self._queue.qsize():
+            raise Exception("Can't limit the queue of '%s' while it is in use" % self.title)
+
+        # imported here to avoid a circular import (via rapidsms.message)
+        from queues import MessageQueue
+        router = self.router if self.router else self
+        self._queue = MessageQueue(router, maxsize, overflow, journal, high, low)
+
+    def watch_queue(self, on_high=None, on_low=None):
+        """Registers callbacks to be notified when this component's queue
+           fills up past its high watermark, and drains back down to its low
+           watermark. Returns False if the queue has no watermarks."""
+        if not hasattr(self._queue, "watch"):
+            return False
+        self._queue.watch(on_high, on_low)
+        return True
+
     @property
     def message_waiting (self):
         return self._queue.qsize()
@@ -152,6 +181,7 @@ class Receiver(Component):
             return None
 
     def send(self, message):
-        # block until we can add to the queue.
-        # it shouldn't be that long.
+        # block until we can add to the queue. it shouldn't be
+        # that long (and won't block at all if the queue sheds
+        # or spills its overflow)
         self._queue.put(message, True)
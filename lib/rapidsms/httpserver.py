@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4
+
+"""
+An HTTPServer which handles its requests with a fixed pool of threads,
+rather than starting a new thread for every one (as ThreadingMixIn does).
+
+Connections are accepted by the server's own thread, and queued for the
+workers. Once all of the workers are busy, up to _backlog_ connections
+wait in the queue, after which the server stops accepting them (and
+they wait in the socket's listen queue instead).
+
+With HTTP/1.1 keep-alive, a worker handles one connection until the
+client closes it, or sends nothing for _idle_timeout_ seconds, so a few
+idle clients can't tie up the whole pool for long. (the timeout is set
+by the handler class, as IDLE_TIMEOUT is by the ajax app's.)
+
+This is used by the ajax app, and the http backend.
+
+"""
+
+import Queue
+import threading
+from BaseHTTPServer import HTTPServer
+
+POOL_SIZE = 8
+BACKLOG = 64
+IDLE_TIMEOUT = 5 # seconds
+
+
+class PooledHTTPServer(HTTPServer):
+    allow_reuse_address = True
+
+    def __init__(self, address, handler, pool_size=POOL_SIZE, backlog=BACKLOG):
+        HTTPServer.__init__(self, address, handler)
+        self.requests = Queue.Queue(backlog)
+        self.workers = []
+        for n in range(pool_size):
+            worker = threading.Thread(target=self.__work, name="http-%d" % n)
+            worker.setDaemon(True)
+            worker.start()
+            self.workers.append(worker)
+
+    def process_request(self, request, client_address):
+        # called by serve_forever, on the server's thread.
+        # (this blocks while the queue is full)
+        self.requests.put((request, client_address))
+
+    def server_close(self):
+        HTTPServer.server_close(self)
+        # stop the workers, once they've finished
+        # with the connections already queued
+        for worker in self.workers:
+            self.requests.put(None)
+
+    def __work(self):
+        while True:
+            item = self.requests.get()
+            if item is None:
+                break
+            request, client_address = item
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            self.close_request(request)
+
+    def stats(self):
+        return {
+            "workers": len(self.workers),
+            "waiting": self.requests.qsize() }
@@ -3,14 +3,19 @@
 
 from config import Config
 from router import get_router
-import os, sys, shutil
+import os, sys, shutil, threading
 
 # the Manager class is a bin for various RapidSMS specific management methods
 class Manager (object):
-    def route (self, conf, *args):
+    def _build_router (self, conf):
         router = get_router()
         router.set_logger(conf["log"]["level"], conf["log"]["file"])
         router.info("RapidSMS Server started up")
+
+        # the [router] section is optional, since
+        # the defaults are fine for most deployments
+        if "router" in conf:
+            router._configure(**conf["router"])
         
         # add each application from conf
         for app_conf in conf["rapidsms"]["apps"]:
@@ -19,6 +24,10 @@ class Manager (object):
         # add each backend from conf
         for backend_conf in conf["rapidsms"]["backends"]:
             router.add_backend(backend_conf)
+        return router
+
+    def route (self, conf, *args):
+        router = self._build_router(conf)
 
         # wait for incoming messages
         router.start()
@@ -26,6 +35,34 @@ class Manager (object):
         # TODO: Had to explicitly do this to end the script. Will need a fix.
         sys.exit(0)
 
+    def loadtest (self, conf, *args):
+        """Runs the router like route, with the apps and backends in
+           the config, until its loadgen backends have finished sending
+           their traffic, then prints their throughput and latency."""
+        from backends import loadgen
+        router = self._build_router(conf)
+        loadgens = [b for b in router.backends if isinstance(b, loadgen.Backend)]
+        if not loadgens:
+            print "Oops. Please add a loadgen backend to your rapidsms.ini backends."
+            sys.exit(1)
+
+        thread = threading.Thread(target=router.start)
+        thread.start()
+        try:
+            for backend in loadgens:
+                # (waiting with a timeout, so ctrl+c still works,
+                # and giving up if the router falls over)
+                while not backend.finished.isSet() and thread.isAlive():
+                    backend.finished.wait(1.0)
+        finally:
+            router.stop()
+            thread.join()
+
+        for backend in loadgens:
+            print backend.report()
+            print
+        sys.exit(0)
+
     def _skeleton (self, tree):
         return os.path.join(os.path.dirname(__file__), "skeleton", tree)
 
@@ -99,7 +136,7 @@ def start (args):
     # if one or more arguments were passed, we're
     # starting up django -- copied from manage.py
     if len(args) < 2:
-        print "Commands: route, startproject <name>, startapp <name>"
+        print "Commands: route, loadtest, startproject <name>, startapp <name>"
         sys.exit(1)
 
     if hasattr(Manager, args[1]):
@@ -2,6 +2,7 @@
 # vim: ai ts=4 sts=4 et sw=4
 
 import copy
+from collections import deque
 from datetime import datetime
 
 
@@ -14,6 +15,10 @@ class StatusCodes:
     
     
 class Message(object):
+    # the names of any other attributes which must survive the message
+    # being spilled to a queue journal, and rebuilt (see rapidsms.queues)
+    journal_attributes = ()
+
     def __init__(self, connection=None, text=None, person=None, date=datetime.now()):
         if connection == None and person == None:
             raise Exception("Message __init__() must take one of: connection, person")
@@ -21,8 +26,12 @@ class Message(object):
         self.text = text
         self.date = date
         self.person = person
-        self.responses = []
+        self.responses = deque()
         self.status = StatusCodes.NONE
+
+        # set by the router once this message has been queued
+        # for sending (see rapidsms.outbound.DeliveryStatus)
+        self.delivery_status = None
         
         # a message is considered "unprocessed" until
         # rapidsms has dispatched it to all apps, and
@@ -52,15 +61,19 @@ class Message(object):
            True if the message was sent successfully."""
         return self.connection.backend.router.outgoing(self)
 
-    def flush_responses (self):
+    def flush_responses (self, callback=None):
         """Sends all responses added to this message (via the
            Message.respond method) in the order which they were
-           added, and clears self.responses"""
+           added, and clears self.responses. If the router has an
+           outbound dispatcher, the responses are queued rather than
+           sent right away, and _callback_ is called with each one
+           once it has been sent."""
 
         # keep on iterating until all of
-        # the messages have been sent
+        # the messages have been queued
         while self.responses:
-            self.responses.pop(0).send()
+            response = self.responses.popleft()
+            response.connection.backend.router.queue_outgoing(response, callback)
 
     def error(self, text, level):
         """Apps send error messages here rather than through respond
@@ -75,6 +88,7 @@ class Message(object):
             response = copy.copy(self)
             response.text = text
             response.status = status
+            response.responses = deque()
             self.responses.append(response)
             return True
         else: 
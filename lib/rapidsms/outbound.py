@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4
+
+import threading
+
+import component
+
+
+class DeliveryStatus:
+    '''Enum for representing the progress of an outgoing message
+       through the router's outbound dispatcher.'''
+    QUEUED = "Queued" # waiting for a sender thread
+    SENT = "Sent" # handed to the backend
+    CANCELLED = "Cancelled" # an app's outgoing phase returned False
+    FAILED = "Failed" # the outgoing phase or the backend raised
+
+
+def deliver (router, message, callback=None):
+    """Runs the outgoing phase for _message_ and sends it via _router_,
+       sets its delivery_status, and calls _callback_ (with the message)."""
+    try:
+        if router.outgoing(message):
+            message.delivery_status = DeliveryStatus.SENT
+        else:
+            message.delivery_status = DeliveryStatus.CANCELLED
+    except Exception:
+        message.delivery_status = DeliveryStatus.FAILED
+        router.log_last_exception("Failed to send message to %s" % message.peer)
+
+    if callback is not None:
+        try:
+            callback(message)
+        except Exception:
+            router.log_last_exception("Delivery callback for %s failed" % message.peer)
+
+
+def deliver_many (router, batch):
+    """Sends a _batch_ of (message, callback) pairs with one call to
+       _router_.outgoing_many (so each backend's share of the batch goes
+       to its send_many), then calls each message's callback, in order."""
+    messages = [message for message, callback in batch]
+    try:
+        router.outgoing_many(messages)
+    except Exception:
+        # (outgoing_many catches the backends' errors, so this
+        # must be the outgoing phase, and nothing was sent)
+        for message in messages:
+            message.delivery_status = DeliveryStatus.FAILED
+        router.log_last_exception("Failed to send a batch of %d messages" % len(messages))
+
+    for message, callback in batch:
+        if callback is not None:
+            try:
+                callback(message)
+            except Exception:
+                router.log_last_exception("Delivery callback for %s failed" % message.peer)
+
+
+class Sender (component.Receiver):
+    """A thread which runs the outgoing phase for the messages routed to
+       it by an OutboundDispatcher, and hands them to their backends. Up
+       to _batch_ messages are taken from the queue at a time, and sent
+       together (see deliver_many), so that queued blasts still reach
+       their backends' send_many."""
+
+    def __init__(self, dispatcher, number):
+        component.Receiver.__init__(self)
+        self._router = dispatcher.router
+        self._title = "sender-%d" % number
+        self.dispatcher = dispatcher
+        self.number = number
+        self.thread = None
+        self.sent = 0
+        self.batches = 0
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def next_batch(self, timeout=0.5):
+        # block for the first message, then take
+        # whatever else is already waiting (up to
+        # the batch size) without blocking again
+        first = self.next_message(timeout)
+        if first is None:
+            return []
+        batch = [first]
+        while len(batch) < self.dispatcher.batch:
+            msg = self.next_message()
+            if msg is None:
+                break
+            batch.append(msg)
+        return batch
+
+    def run(self):
+        while self.dispatcher.running or self.message_waiting:
+            batch = self.next_batch()
+            if not batch:
+                continue
+
+            self.batches += 1
+            if len(batch) == 1:
+                msg, callback = batch[0]
+                deliver(self.router, msg, callback)
+            else:
+                deliver_many(self.router, batch)
+            self.sent += len(batch)
+
+
+class OutboundDispatcher (object):
+    """Sends outgoing messages on behalf of the router, in a pool of
+       Sender threads, so the router can get on with the next incoming
+       message. Messages to the same connection are always handled by
+       the same sender, so they are sent in the order they were queued."""
+
+    def __init__(self, router, size=1, batch=20):
+        if size < 1:
+            raise ValueError("An OutboundDispatcher needs at least one sender (got %d)" % size)
+        self.router = router
+        self.batch = batch
+        self.running = False
+        self.senders = [Sender(self, n) for n in range(size)]
+
+    def __len__(self):
+        return len(self.senders)
+
+    def sender_for(self, message):
+        key = (message.connection.backend.slug, message.connection.identity)
+        return self.senders[hash(key) % len(self.senders)]
+
+    def queue(self, message, callback=None):
+        message.delivery_status = DeliveryStatus.QUEUED
+        self.sender_for(message).send((message, callback))
+
+    def start(self):
+        self.running = True
+        for sender in self.senders:
+            sender.start()
+
+    def stop(self, timeout=5.0):
+        """Stops accepting new work, and waits up to _timeout_ seconds
+           for each sender to drain its queue and terminate."""
+        self.running = False
+        for sender in self.senders:
+            if sender.thread is not None:
+                sender.thread.join(timeout)
+                if sender.thread.isAlive():
+                    self.router.warning("Sender %d did not terminate", sender.number)
+
+    @property
+    def queued(self):
+        return sum([s.message_waiting for s in self.senders])
+
+    def stats(self):
+        return [{ "sender":  s.number,
+                  "queued":  s.message_waiting,
+                  "sent":    s.sent,
+                  "batches": s.batches } for s in self.senders]
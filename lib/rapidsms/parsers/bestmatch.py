@@ -2,7 +2,6 @@
 # vim: ai ts=4 sts=4 et sw=4
 
 from __future__ import with_statement
-import re
 import threading
 import sys
 
@@ -30,16 +29,102 @@ class MultiMatch(object):
         return list(matches)
 
         
+def _normalize(alias):
+    """
+    Returns the key under which _alias_ is indexed: stripped
+    and lower-cased, since matching is case insensitive.
+
+    """
+    return alias.strip().lower()
+
+
+class _TrieNode(object):
+    __slots__ = ('children', 'aliases')
+
+    def __init__(self):
+        self.children = dict()
+        # alias -> number of keys for it which
+        # pass through this node (see _Trie)
+        self.aliases = dict()
+
+
+class _Trie(object):
+    """
+    A prefix tree of normalized alias keys. Every node holds all
+    of the aliases with a key that passes through it, so finding
+    the aliases which start with a string costs one step per
+    character, regardless of how many aliases there are.
+
+    An alias can be added under several keys, so each node counts
+    them, and only forgets the alias when the last one is removed.
+
+    """
+    def __init__(self):
+        self.root = _TrieNode()
+
+    def add(self, key, alias):
+        node = self.root
+        for c in key:
+            child = node.children.get(c)
+            if child is None:
+                child = node.children[c] = _TrieNode()
+            node = child
+            node.aliases[alias] = node.aliases.get(alias, 0) + 1
+
+    def discard(self, key, alias):
+        path = [self.root]
+        for c in key:
+            node = path[-1].children.get(c)
+            if node is None:
+                return
+            path.append(node)
+
+        # walk back up, dropping nodes which no
+        # longer lead to any alias at all
+        for i in range(len(key), 0, -1):
+            node = path[i]
+            count = node.aliases.get(alias, 0) - 1
+            if count > 0:
+                node.aliases[alias] = count
+            else:
+                node.aliases.pop(alias, None)
+            if len(node.aliases) == 0:
+                del path[i-1].children[key[i-1]]
+
+    def find(self, prefix):
+        """Returns the aliases with a key starting with _prefix_"""
+        node = self.root
+        for c in prefix:
+            node = node.children.get(c)
+            if node is None:
+                return ()
+        return node.aliases.keys()
+
+
 class BestMatch(object):
+    """
+    Matches (abbreviated, case insensitive) strings against a set of
+    targets and their aliases. The aliases are indexed in a prefix
+    tree, so an anchored match costs O(len(src)) plus the number of
+    matches, and targets, aliases and ignore prefixes can be added and
+    removed without rebuilding anything.
+
+    """
     def __init__(self, targets=None, ignore_prefixes=None):
         self.__targets = dict()
         self.__data = dict()
-        # a dict of sets
+        # alias -> target
         self.__aliases = dict()
+        # alias -> normalized key
+        self.__keys = dict()
         self.__ignore_prefixes = list()
         self.__lock = threading.Lock()
+        # every alias, by key
+        self.__index = _Trie()
+        # every alias which starts with an ignore
+        # prefix, by its key with the prefix removed
+        self.__prefixed = _Trie()
         self.__set_targets(targets)
-        self.__ignore_prefix_pattern = ''
         self.__set_ignore_prefixes(ignore_prefixes)
     
     def match(self, src, anchored=True, with_data=False, exact_match_trumps=True):
@@ -70,55 +155,38 @@ class BestMatch(object):
         src = src.strip()
         if len(src)==0:
             return []
+
+        key = src.lower()
             
-        anchor = ('^' if anchored else '.*')
+        with self.__lock:
+            if exact_match_trumps and src in self.__aliases:
+                found = set([self.__aliases[src]])
 
-        # see if the source already has a prefix on it
-        # in which case we strip it and don't try to match other
-        # prefixes
-        has_prefix=False
-        for p in self.__ignore_prefixes:
-            # make sure to lowercase everything for
-            # case insensitive search
-            left,pref,right = src.lower().partition(p.lower())
-            if len(left)==0 and \
-                    len(pref)!=0:
-                # we matched a prefix
-                has_prefix=True
-                break
-
-        # now make the matching regex
-        match_prefixes = None
-        if not has_prefix and len(self.__ignore_prefixes)>0:
-            match_prefixes = self.__ignore_prefix_pattern 
-
-        if match_prefixes is not None:
-            src_matcher = re.compile(ur'%s\s*%s\s*%s.*' % \
-                                         (anchor,
-                                          match_prefixes,
-                                          re.escape(src),
-                                          ),
-                                     re.IGNORECASE | re.U)
-        else:
-            src_matcher = re.compile(ur'%s\s*%s.*' % \
-                                         (anchor,
-                                          re.escape(src),
-                                          ),
-                                     re.IGNORECASE | re.U)
-
-        # now look for matches
-        found = set()
-        for a in self.__aliases:
-            if exact_match_trumps and src==a:
-                found = set([self.__aliases[a]])
-                break
-            if src_matcher.match(a) is not None:    
-                found.add(self.__aliases[a])
-
-        if len(found)>0 and not with_data:
-            return list(found)
-        else:
-            return [(t,self.__data[t]) for t in found]
+            elif not anchored:
+                # unanchored matches can start anywhere in an alias,
+                # which the prefix tree can't help with, but at least
+                # the keys are already normalized
+                found = set([self.__aliases[a] for a,k in self.__keys.iteritems()
+                             if key in k])
+
+            else:
+                found = set([self.__aliases[a] for a in self.__index.find(key)])
+
+                # if the source already has a prefix on it, we
+                # don't try to match it against other prefixes
+                has_prefix=False
+                for p in self.__ignore_prefixes:
+                    if key.startswith(p.lower()):
+                        has_prefix=True
+                        break
+
+                if not has_prefix:
+                    found.update([self.__aliases[a] for a in self.__prefixed.find(key)])
+
+            if len(found)>0 and not with_data:
+                return list(found)
+            else:
+                return [(t,self.__data[t]) for t in found]
 
 
     #
@@ -133,12 +201,47 @@ class BestMatch(object):
         target: string
         alias: string
         """
-        self.__targets[target].add(alias)
-        self.__aliases[alias] = target
+        with self.__lock:
+            self.__targets[target].add(alias)
+            self.__add_alias(alias, target)
 
     def remove_alias_for_target(self, target, alias):
-        self.__targets[target].remove(alias)
+        with self.__lock:
+            self.__targets[target].remove(alias)
+            self.__remove_alias(alias)
+
+    def __add_alias(self, alias, target):
+        if alias in self.__aliases:
+            self.__remove_alias(alias)
+        key = _normalize(alias)
+        self.__aliases[alias] = target
+        self.__keys[alias] = key
+        self.__index.add(key, alias)
+        for p in self.__prefix_keys(key):
+            self.__prefixed.add(p, alias)
+
+    def __remove_alias(self, alias):
         del self.__aliases[alias]
+        key = self.__keys.pop(alias)
+        self.__index.discard(key, alias)
+        for p in self.__prefix_keys(key):
+            self.__prefixed.discard(p, alias)
+
+    def __prefix_keys(self, key):
+        """
+        Returns the keys to index _key_ under in the prefixed
+        index: what's left after removing each ignore prefix
+        (and any whitespace following it) that it starts with.
+
+        """
+        keys = []
+        for p in self.__ignore_prefixes:
+            p = p.lower()
+            if key.startswith(p):
+                rest = key[len(p):].lstrip()
+                if len(rest)>0:
+                    keys.append(rest)
+        return keys
 
     def __get_targets(self):
         """
@@ -156,6 +259,9 @@ class BestMatch(object):
             self.__targets = dict()
             self.__data = dict()
             self.__aliases = dict()
+            self.__keys = dict()
+            self.__index = _Trie()
+            self.__prefixed = _Trie()
 
         if val is None or len(val)==0:
             return
@@ -175,6 +281,7 @@ class BestMatch(object):
         # erase existing
         with self.__lock:
             self.__ignore_prefixes = list()
+            self.__prep_prefixes()
           
         if val is None or len(val)==0: 
             return
@@ -199,6 +306,9 @@ class BestMatch(object):
 
         ([target, alias...], data) -- combo of above, target, aliases and data
 
+        Adding a target which already exists replaces its
+        aliases and data.
+
         """
         if val is None:
             return
@@ -223,9 +333,11 @@ class BestMatch(object):
             return
 
         with self.__lock:
+            if target in self.__targets:
+                self.__remove_target(target)
             self.__data[target] = data
             for a in aliases:
-                self.__aliases[a] = target
+                self.__add_alias(a, target)
             al_set=set(aliases)
             al_set.remove(target)
             self.__targets[target] = al_set
@@ -245,43 +357,38 @@ class BestMatch(object):
         with self.__lock:
             try:
                 self.__ignore_prefixes.remove(val)
-            except KeyError:
+            except ValueError:
                 return False
             if prep:
                 self.__prep_prefixes()
         return True
 
     def __prep_prefixes(self):
-        # check for do nothing case
-        if len(self.__ignore_prefixes)==0:
-            self.__ignore_prefix_pattern=''
-            return
-
         # sort longest to shortest
         self.__ignore_prefixes.sort(lambda x,y: len(y)-len(x))
-        
-        # and make the regex pattern
-        ppats=[ur'(?:%s)' % re.escape(p) \
-                   for p in self.__ignore_prefixes]
 
-        if len(ppats)==1:
-            self.__ignore_prefix_pattern = '%s?' % ppats[0]
-        else:
-            self.__ignore_prefix_pattern = '(%s)?' % u'|'.join(ppats)
+        # and re-index the aliases which start with them
+        self.__prefixed = _Trie()
+        for alias,key in self.__keys.iteritems():
+            for p in self.__prefix_keys(key):
+                self.__prefixed.add(p, alias)
 
     def remove_target(self, val):
         """Returns 'True' if removed, 'False' if not in the set"""
         targ = val.strip()
         with self.__lock:
-            try:
-                del self.__data[targ]
-                for k in self.__aliases.keys():
-                    if self.__aliases[k] == targ:
-                        del self.__aliases[targ]
-            except KeyError:
+            if targ not in self.__targets:
                 return False
+            self.__remove_target(targ)
         return True
 
+    def __remove_target(self, targ):
+        del self.__data[targ]
+        for a in self.__targets.pop(targ) | set([targ]):
+            # (unless the alias was since given to another target)
+            if self.__aliases.get(a) == targ:
+                self.__remove_alias(a)
+
 
 # cruddy manual test script
 
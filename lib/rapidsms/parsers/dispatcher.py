@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4
+
+from __future__ import with_statement
+import re
+import threading
+from bestmatch import _Trie, _normalize
+
+# characters which end the literal prefix of a pattern
+_SPECIAL = ".^$*+?{}[]\\|()"
+
+
+def literal_prefix(pattern, flags=0):
+    """
+    Returns the (lower-cased) literal text which every string matched by
+    _pattern_ (anchored at the start, as by re.match) must begin with, or
+    an empty string if it can start with anything. e.g. "^report\s+(.+)"
+    must begin with "report", and "rep(ort)?" with "rep".
+
+    """
+    if flags & re.VERBOSE or _has_alternation(pattern):
+        return ""
+
+    i = 1 if pattern.startswith("^") else 0
+    prefix = []
+    while i < len(pattern):
+        c = pattern[i]
+        if c in _SPECIAL or ord(c) > 127:
+            break
+        # a character which may be repeated zero times isn't
+        # required, and nothing after a repeated one is fixed
+        following = pattern[i+1:i+2]
+        if following and following in "*?{":
+            break
+        prefix.append(c)
+        if following == "+":
+            break
+        i += 1
+    return "".join(prefix).lower()
+
+
+def _has_alternation(pattern):
+    """True if _pattern_ has a "|" outside of any group, in which
+       case its branches can each start with something different."""
+    depth = 0
+    in_class = False
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if c == "\\":
+            i += 2
+            continue
+        if in_class:
+            if c == "]":
+                in_class = False
+        elif c == "[":
+            in_class = True
+            # a "]" straight after the "[" (or "[^") is a literal
+            if pattern[i+1:i+2] == "^":
+                i += 1
+            if pattern[i+1:i+2] == "]":
+                i += 1
+        elif c == "(":
+            depth += 1
+        elif c == ")":
+            depth -= 1
+        elif c == "|" and depth == 0:
+            return True
+        i += 1
+    return False
+
+
+class Route(object):
+    __slots__ = ("priority", "regex", "handler", "data")
+
+    def __init__(self, priority, regex, handler, data=None):
+        self.priority = priority
+        self.regex = regex
+        self.handler = handler
+        self.data = data
+
+    def __repr__(self):
+        return "<Route %d: %s>" % (self.priority, self.regex.pattern)
+
+
+class _PrefixNode(object):
+    __slots__ = ("children", "routes")
+
+    def __init__(self):
+        self.children = dict()
+        # the routes whose literal prefix ends here
+        self.routes = []
+
+
+class Dispatcher(object):
+    """
+    Routes text to handlers, by regular expression (like the Keyworder)
+    or by keyword (like a BestMatch of commands).
+
+    Patterns are matched in the order they were added, and the first one
+    to match wins. Rather than trying every pattern in turn, they're
+    indexed by their literal prefix (see literal_prefix), so only those
+    which could possibly match the text are tried. With hundreds of
+    keyword-style patterns, that's usually only one or two.
+
+    Keywords can be abbreviated: a word matches every keyword (or alias)
+    which it's the start of, unless it's exactly one of them.
+
+    """
+    def __init__(self, flags=re.IGNORECASE):
+        self.flags = flags
+        self.routes = []
+        self.__root = _PrefixNode()
+        self.__lock = threading.Lock()
+
+        # keyword (target) -> (handler, data), and
+        # the index of the keywords and their aliases
+        self.__keywords = dict()
+        self.__aliases = dict()
+        self.__keyword_index = _Trie()
+
+    def __len__(self):
+        return len(self.routes)
+
+    def add(self, pattern, handler, data=None):
+        """Routes text matching _pattern_ (a string, compiled with
+           self.flags, or an already compiled regex) to _handler_."""
+        if isinstance(pattern, basestring):
+            regex = re.compile(pattern, self.flags)
+        else:
+            regex = pattern
+
+        with self.__lock:
+            route = Route(len(self.routes), regex, handler, data)
+            self.routes.append(route)
+
+            node = self.__root
+            for c in literal_prefix(regex.pattern, regex.flags):
+                child = node.children.get(c)
+                if child is None:
+                    child = node.children[c] = _PrefixNode()
+                node = child
+            node.routes.append(route)
+        return route
+
+    def candidates(self, text):
+        """Returns the routes which might match _text_, in order"""
+        node = self.__root
+        found = list(node.routes)
+        for c in text.lower():
+            node = node.children.get(c)
+            if node is None:
+                break
+            found.extend(node.routes)
+        found.sort(key=lambda r: r.priority)
+        return found
+
+    def match_route(self, text):
+        """Returns the first (Route, match object) for _text_,
+           or None if none of the patterns match it"""
+        for route in self.candidates(text):
+            match = route.regex.match(text)
+            if match:
+                return (route, match)
+        return None
+
+    def match(self, text):
+        """Returns the (handler, groups) of the first pattern to match
+           _text_, with whitespace stripped from the groups (which may
+           be None), or None if none of them match."""
+        found = self.match_route(text)
+        if found is None:
+            return None
+        route, match = found
+        groups = [g and g.strip() or g for g in match.groups()]
+        return (route.handler, groups)
+
+    def add_keyword(self, keywords, handler, data=None):
+        """Routes _keywords_ (one, or a list of a keyword followed by
+           its aliases) to _handler_. Keywords are case insensitive."""
+        if isinstance(keywords, basestring):
+            keywords = [keywords]
+        target = keywords[0].strip()
+        with self.__lock:
+            self.__keywords[target] = (handler, data)
+            for alias in keywords:
+                key = _normalize(alias)
+                old = self.__aliases.get(key)
+                if old is not None:
+                    self.__keyword_index.discard(key, old)
+                self.__aliases[key] = target
+                self.__keyword_index.add(key, key)
+
+    def match_keyword(self, word):
+        """Returns a list of (keyword, handler, data) for the keywords
+           which _word_ matches: just the one it's an alias of, if it's
+           exactly one, or else all of those which it's the start of."""
+        key = _normalize(word or "")
+        if len(key) == 0:
+            return []
+        with self.__lock:
+            if key in self.__aliases:
+                targets = [self.__aliases[key]]
+            else:
+                targets = set([self.__aliases[k] for k in self.__keyword_index.find(key)])
+            return [(t,) + self.__keywords[t] for t in targets]
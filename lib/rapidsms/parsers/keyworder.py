@@ -2,6 +2,7 @@
 # vim: ai ts=4 sts=4 et sw=4
 
 import re
+from dispatcher import Dispatcher
 
 class Keyworder(object):
 
@@ -16,6 +17,12 @@ class Keyworder(object):
         self.prefix = ""
         self.pattern = "^%s$"
 
+        # the regexen are matched via a dispatcher, which only tries
+        # those with a prefix that fits the message. it's filled in as
+        # they're needed, since some apps append to self.regexen directly
+        self.dispatcher = Dispatcher()
+        self.indexed = 0
+
     def prepare(self, prefix, suffix):
 
         # no prefix is defined, so match
@@ -73,16 +80,15 @@ class Keyworder(object):
         return decorator
 
     def match(self, sself, str):
-        print "\n\nMATCHING\n\n: %s" % str
-        for pat, func in self.regexen:
-            match = pat.match(str)
-            if match:
-                # clean up leading and trailing whitespace
-                # note: match groups can be None, hence the and/or business
-                groups = map(lambda x: x and x.strip() or x, match.groups())
-                return (func, groups)
-        # TODO proper logging??
-        #print "No method called %s" % (str)
+        # index any regexen added since the last match
+        while self.indexed < len(self.regexen):
+            pat, func = self.regexen[self.indexed]
+            self.dispatcher.add(pat, func)
+            self.indexed += 1
+
+        # returns (func, groups), with the leading and trailing
+        # whitespace cleaned from the groups, or None
+        return self.dispatcher.match(str)
 
     # a semantic way to add a default
     # handler (when nothing else is matched)
@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4
+
+import threading
+import Queue
+import cPickle as pickle
+
+from message import Message
+
+
+# what to do when a message is put into a full queue:
+#   block: wait until there is room (the default)
+#   shed:  drop the oldest message in the queue to make room
+#   spill: write the message to a journal on disk, and read
+#          it back into the queue when there is room again
+OVERFLOW_POLICIES = ("block", "shed", "spill")
+
+
+def freeze_message (msg):
+    """Returns a picklable tuple containing everything needed to rebuild
+       _msg_ via thaw_message. Messages can't be pickled directly, since
+       they hold a reference to their (live) backend. The message's class
+       is kept, along with the attributes it lists in journal_attributes
+       (like the row_id of a polling.QueuedMessage)."""
+    extra = dict([(name, getattr(msg, name, None)) for name in msg.journal_attributes])
+    return (msg.connection.backend.slug, msg.connection.identity,
+            msg.text, msg.date, msg.status, type(msg), extra)
+
+def thaw_message (router, record):
+    # imported here to avoid a circular import (via rapidsms.router)
+    from connection import Connection
+
+    slug, identity, text, date, status, klass, extra = record
+    backend = router.get_backend(slug)
+    if backend is None:
+        raise Exception("Can't restore a message for the unknown '%s' backend" % slug)
+    msg = klass(Connection(backend, identity), text, date=date)
+    msg.status = status
+    for name, value in extra.items():
+        setattr(msg, name, value)
+    return msg
+
+
+class Journal (object):
+    """A simple first-in, first-out store of pickled records in a file.
+       The file is truncated whenever every record has been read back."""
+
+    def __init__(self, path):
+        self.path = path
+        self.count = 0
+        self.offset = 0
+
+        # any records left from a previous run are discarded; the
+        # messages they reference may no longer mean anything
+        open(self.path, "wb").close()
+
+    def __len__(self):
+        return self.count
+
+    def append(self, record):
+        f = open(self.path, "ab")
+        try:
+            pickle.dump(record, f, pickle.HIGHEST_PROTOCOL)
+        finally:
+            f.close()
+        self.count += 1
+
+    def pop(self):
+        try:
+            f = open(self.path, "rb")
+            try:
+                f.seek(self.offset)
+                record = pickle.load(f)
+                self.offset = f.tell()
+            finally:
+                f.close()
+        finally:
+            # a record which can't be read is dropped, too (there's
+            # no finding the next one), so the journal always drains
+            self.count -= 1
+            if self.count == 0:
+                open(self.path, "wb").close()
+                self.offset = 0
+        return record
+
+
+class MessageQueue (Queue.Queue):
+    """A Queue.Queue which can be bounded without blocking the producer
+       (see OVERFLOW_POLICIES), and notifies listeners when its depth
+       crosses a high or low watermark, so producers can slow down."""
+
+    def __init__(self, router, maxsize=0, overflow="block", journal=None, high=None, low=None):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError("Invalid queue overflow policy: %s (use one of: %s)" %
+                (overflow, ", ".join(OVERFLOW_POLICIES)))
+        if overflow == "spill" and journal is None:
+            raise ValueError("The 'spill' overflow policy requires a journal file")
+
+        Queue.Queue.__init__(self, maxsize)
+        self.router = router
+        self.overflow = overflow
+        self.journal = Journal(journal) if overflow == "spill" else None
+
+        # default the watermarks to 80% and 20% of a bounded queue.
+        # unbounded queues have no watermarks, unless they are given
+        if high is None and maxsize > 0:
+            high = max(1, int(maxsize * 0.8))
+        if low is None and high is not None:
+            low = int(high / 4)
+        self.high = high
+        self.low = low
+        self.above_high = False
+        self.listeners = []
+        self.watch_lock = threading.Lock()
+
+        self.dropped = 0
+        self.spilled = 0
+
+    def watch(self, on_high=None, on_low=None):
+        """Registers callbacks to be called (with this queue) when its
+           depth reaches the high watermark, and when it falls back
+           to the low watermark."""
+        self.listeners.append((on_high, on_low))
+
+    def qsize(self):
+        # include the messages spilled to disk, since
+        # they are still waiting to be processed
+        self.mutex.acquire()
+        try:
+            n = self._qsize()
+            if self.journal is not None:
+                n += len(self.journal)
+            return n
+        finally:
+            self.mutex.release()
+
+    def put(self, item, block=True, timeout=None):
+        if self.maxsize <= 0 or self.overflow == "block":
+            Queue.Queue.put(self, item, block, timeout)
+
+        else:
+            self.mutex.acquire()
+            try:
+                if self.overflow == "shed":
+                    if self._qsize() >= self.maxsize:
+                        self._get()
+                        self.unfinished_tasks -= 1
+                        self.dropped += 1
+                    self._put(item)
+
+                # once messages start spilling to the journal, all new
+                # messages must follow them there until it has drained,
+                # otherwise they would be processed out of order
+                elif self._qsize() >= self.maxsize or len(self.journal):
+                    self.journal.append(freeze_message(item))
+                    self.spilled += 1
+
+                else:
+                    self._put(item)
+
+                self.unfinished_tasks += 1
+                self.not_empty.notify()
+            finally:
+                self.mutex.release()
+
+        self.__check_watermarks()
+
+    def get(self, block=True, timeout=None):
+        item = Queue.Queue.get(self, block, timeout)
+        self.__check_watermarks()
+        return item
+
+    def _get(self):
+        item = Queue.Queue._get(self)
+
+        # refill the in-memory queue from the journal, now that there
+        # is room for one more message. any which can't be restored are
+        # dropped, and the next tried, so that the journal can't be left
+        # holding messages while the in-memory queue (which get waits
+        # on) is empty
+        while self.journal is not None and len(self.journal):
+            try:
+                self._put(thaw_message(self.router, self.journal.pop()))
+                break
+            except Exception:
+                self.unfinished_tasks -= 1
+                self.router.log_last_exception("Dropped a message from the queue journal")
+        return item
+
+    def __check_watermarks(self):
+        if self.high is None or not self.listeners:
+            return
+
+        # work out whether a watermark was crossed while holding the
+        # lock, but call the listeners after releasing it, since they
+        # are allowed to do slow things (or touch the queue)
+        depth = self.qsize()
+        self.watch_lock.acquire()
+        try:
+            if not self.above_high and depth >= self.high:
+                self.above_high = True
+                index = 0
+            elif self.above_high and depth <= self.low:
+                self.above_high = False
+                index = 1
+            else:
+                return
+        finally:
+            self.watch_lock.release()
+
+        for callbacks in self.listeners:
+            if callbacks[index] is not None:
+                callbacks[index](self)
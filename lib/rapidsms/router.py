@@ -1,11 +1,15 @@
 #!/usr/bin/env python
 # vim: ai ts=4 sts=4 et sw=4
 
-import time, datetime, heapq
+import time, datetime
 import threading
 import traceback
 
 import component
+from workers import WorkerPool
+from scheduler import Scheduler, to_timestamp
+from outbound import OutboundDispatcher, DeliveryStatus, deliver
+from app import App
 import log
 import sys
 
@@ -38,9 +42,45 @@ class Router (component.Receiver):
         component.Receiver.__init__(self)
         self.backends = []
         self.apps = []
-        self.events = []
+        self.scheduler = Scheduler(self)
         self.running = False
         self.logger = None
+        self.pool = None
+        self.outbound = None
+
+        # the per-phase dispatch table is built lazily
+        # by __dispatch_table, and rebuilt whenever the
+        # list of apps changes (see rebuild_dispatch)
+        self._dispatch = None
+        self._dispatch_size = 0
+
+    def configure(self, workers=0, worker_type="thread", scheduler_journal=None,
+                  outbound_threads=0, outbound_batch=20, **kwargs):
+        """Configures the router from the [router] section of
+           rapidsms.ini. If _workers_ is greater than zero, incoming
+           messages are handled by a pool of that many threads rather
+           than by the main loop. If _scheduler_journal_ is set, calls
+           scheduled via call_at are saved to that file, and survive
+           a restart of the router. If _outbound_threads_ is greater
+           than zero, responses are sent by a pool of that many threads,
+           in batches of up to _outbound_batch_ messages."""
+        self.scheduler.journal = scheduler_journal
+
+        outbound_threads = int(outbound_threads)
+        if outbound_threads > 0:
+            self.outbound = OutboundDispatcher(
+                self, outbound_threads, int(outbound_batch))
+        else:
+            self.outbound = None
+        if worker_type != "thread":
+            raise Exception("Router does not support '%s' workers "
+                "(only 'thread' is available)" % worker_type)
+
+        workers = int(workers)
+        if workers > 0:
+            self.pool = WorkerPool(self, workers)
+        else:
+            self.pool = None
 
     def log(self, level, msg, *args):
         self.logger.write(self, level, msg, *args)
@@ -100,6 +140,7 @@ class Router (component.Receiver):
             app = self.build_component("apps.%s.app.App", conf)
             self.info("Added app: %r" % conf)
             self.apps.append(app)
+            self.rebuild_dispatch()
             
         except:
             self.log_last_exception("Failed to add app: %r" % conf)
@@ -162,6 +203,20 @@ class Router (component.Receiver):
         return not raised
 
 
+    def stop_all_apps (self):
+        """Calls the _stop_ method of each app, once the router has
+           finished processing messages, so they can save anything
+           they are holding in memory. Exceptions are logged, but
+           not allowed to propagate (or stop the other apps)."""
+
+        for app in self.apps:
+            try:
+                app.stop()
+
+            except Exception:
+                self.log_last_exception("The %s app failed to stop" % app.slug)
+
+
     def start_all_backends (self):
         """Starts all backends registed via Router.add_backend,
            by calling self.start_backend in a new thread for each."""
@@ -220,21 +275,20 @@ class Router (component.Receiver):
     If the callback returns a true value that is one of the time objects
     understood by call_at(), the callback will be called again at the
     specified time with the same arguments.
+
+    Callbacks are run by the router's scheduler, in a thread of its own,
+    so they fire on time even while the router is busy with messages.
+    call_at() returns a ScheduledCall, which can be cancel()ed.
     """
     def call_at (self, when, callback, *args, **kwargs):
-        if isinstance(when, datetime.timedelta):
-            when = datetime.datetime.now() + when
-        if isinstance(when, datetime.datetime):
-            when = time.mktime(when.timetuple())
-        elif isinstance(when, (int, float)):
-            when = time.time() + when
-        else:
+        timestamp = to_timestamp(when)
+        if timestamp is None:
             self.debug("Call to %s wasn't scheduled with a suitable time: %s",
                 callback.func_name, when)
-            return
+            return None
         self.debug("Scheduling call to %s at %s",
-            callback.func_name, datetime.datetime.fromtimestamp(when).ctime())
-        heapq.heappush(self.events, (when, callback, args, kwargs))
+            callback.func_name, datetime.datetime.fromtimestamp(timestamp).ctime())
+        return self.scheduler.schedule(timestamp, callback, args, kwargs)
 
     def start (self):
         self.running = True
@@ -244,19 +298,32 @@ class Router (component.Receiver):
         self.info("APPS: %r" % (self.apps))
         self.info("SERVING FOREVER...")
         
+        self.rebuild_dispatch()
+        self.scheduler.start()
         self.start_all_backends()
         self.start_all_apps()
+        if self.pool is not None:
+            self.info("Starting %d message workers" % len(self.pool))
+            self.pool.start()
+        if self.outbound is not None:
+            self.info("Starting %d outbound senders" % len(self.outbound))
+            self.outbound.start()
 
         # wait until we're asked to stop
         while self.running:
             try:
-                self.call_scheduled()
                 self.run()
             except KeyboardInterrupt:
                 break
             except SystemExit:
                 break
         
+        if self.pool is not None:
+            self.pool.stop()
+        if self.outbound is not None:
+            self.outbound.stop()
+        self.stop_all_apps()
+        self.scheduler.stop()
         self.stop_all_backends()
         self.running = False
 
@@ -266,44 +333,90 @@ class Router (component.Receiver):
     def run(self):
         msg = self.next_message(timeout=1.0)
         if msg is not None:
-            self.incoming(msg)
+            if self.pool is not None:
+                self.pool.dispatch(msg)
+            else:
+                self.incoming(msg)
+
+    def worker_stats(self):
+        """Returns a dict describing the depth of the router's queue,
+           and the queue depth and utilisation of each worker (if the
+           router is running with a worker pool)."""
+        stats = { "queued": self.message_waiting, "workers": [], "senders": [] }
+        if self.pool is not None:
+            stats["workers"] = self.pool.stats()
+        if self.outbound is not None:
+            stats["senders"] = self.outbound.stats()
+        return stats
 
     def call_scheduled(self):
-        while self.events and self.events[0][0] < time.time():
-            when, callback, args, kwargs = heapq.heappop(self.events)
-            self.info("Calling %s(%s, %s)",
-                callback.func_name, args, kwargs)
-            result = callback(*args, **kwargs)
-            if result:
-                self.call_at(result, callback, *args, **kwargs)
+        """Runs any scheduled calls which are due, in the calling thread.
+           This isn't necessary while the router is running (the scheduler
+           has its own thread), but is useful when driving it by hand."""
+        self.scheduler.run_due()
     
     def __sorted_apps(self):
         return sorted(self.apps, key=lambda a: a.priority())
-    
+
+    def rebuild_dispatch(self):
+        """Compiles the apps into a table mapping each incoming and
+           outgoing phase to a list of (slug, bound method) pairs, in
+           the order that they should be called. Apps which inherit the
+           no-op implementation of a phase from rapidsms.app.App are
+           left out of that phase entirely. This is called once when the
+           router starts, and again whenever an app is added."""
+
+        apps = self.__sorted_apps()
+        table = {}
+
+        for phase in self.incoming_phases + self.outgoing_phases:
+            table[phase] = [
+                (app.slug, getattr(app, phase))
+                for app in apps
+                if _overrides(app, phase)]
+
+        # outgoing phases are called in the opposite order of the
+        # incoming phases so that, for example, the first app
+        # called with an incoming message is the last app called
+        # with an outgoing message
+        for phase in self.outgoing_phases:
+            table[phase].reverse()
+
+        self._dispatch = table
+        self._dispatch_size = len(self.apps)
+
+    def __dispatch_table(self):
+        # apps are sometimes appended to self.apps directly (most
+        # often by tests), so check that the table is still current
+        if self._dispatch is None or self._dispatch_size != len(self.apps):
+            self.rebuild_dispatch()
+        return self._dispatch
+
     def incoming(self, message):   
-        self.info("Incoming message via %s: %s ->'%s'" %\
-			(message.connection.backend.slug, message.connection.identity, message.text))
+        self.info("Incoming message via %s: %s ->'%s'",
+            message.connection.backend.slug, message.connection.identity, message.text)
         
         # loop through all of the apps and notify them of
         # the incoming message so that they all get a
         # chance to do what they will with it                      
+        dispatch = self.__dispatch_table()
         for phase in self.incoming_phases:
-            for app in self.__sorted_apps():
-                self.debug('IN' + ' ' + phase + ' ' + app.slug)
+            for slug, method in dispatch[phase]:
+                self.debug("IN %s %s", phase, slug)
                 responses = len(message.responses)
                 handled = False
                 try:
-                    handled = getattr(app, phase)(message)
+                    handled = method(message)
                 except Exception, e:
                     type, value, tb = sys.exc_info()
-                    self.error("%s failed on %s: %r\n%s", app, phase, e, '\n'.join(traceback.format_tb(tb)))
+                    self.error("%s failed on %s: %r\n%s", slug, phase, e, '\n'.join(traceback.format_tb(tb)))
                 if phase == 'handle':
                     if handled is True:
-                        self.debug("%s short-circuited handle phase", app.slug)
+                        self.debug("%s short-circuited handle phase", slug)
                         break
                 elif responses < len(message.responses):
                     self.warning("App '%s' shouldn't send responses in %s()!", 
-                        app.slug, phase)
+                        slug, phase)
 
         # now send the message's responses
         message.flush_responses()
@@ -314,32 +427,121 @@ class Router (component.Receiver):
         message.processed = True
 
 
+    def queue_outgoing(self, message, callback=None):
+        """Sends _message_ via the outbound dispatcher, if the router has
+           one, returning without waiting for it to be sent. Otherwise, it
+           is sent right away. Either way, message.delivery_status is set,
+           and _callback_ (if given) is called with the message once it
+           has been sent (or cancelled, or failed)."""
+        if self.outbound is not None:
+            self.outbound.queue(message, callback)
+        else:
+            deliver(self, message, callback)
+
     def outgoing(self, message):
-        self.info("Outgoing message via %s: %s <- '%s'" %\
-			(message.connection.backend.slug, message.connection.identity, message.text))
+        self.info("Outgoing message via %s: %s <- '%s'",
+            message.connection.backend.slug, message.connection.identity, message.text)
         
-        # first notify all of the apps that want to know
-        # about outgoing messages so that they can do what
-        # they will before the message is actually sent
+        if not self.run_outgoing_phases(message):
+            return False
+
+        # now send the message out
+        message.connection.backend.send(message)
+        self.debug("SENT message '%s' to %s via %s", message.text,
+            message.connection.identity, message.connection.backend.slug)
+        return True
+
+    def run_outgoing_phases(self, message):
+        """Notifies all of the apps that want to know about outgoing
+           messages, so they can do what they will before _message_ is
+           actually sent. Returns False if one of them cancelled it.
+           (Router.outgoing calls this, and then sends the message.)"""
+
+        # the dispatch table is already in reverse order
+        dispatch = self.__dispatch_table()
         for phase in self.outgoing_phases:
             continue_sending = True
             
-            # call outgoing phases in the opposite order of the
-            # incoming phases so that, for example, the first app
-            # called with an incoming message is the last app called
-            # with an outgoing message
-            for app in reversed(self.__sorted_apps()):
-                self.debug('OUT' + ' ' + phase + ' ' + app.slug)
+            for slug, method in dispatch[phase]:
+                self.debug("OUT %s %s", phase, slug)
                 try:
-                    continue_sending = getattr(app, phase)(message)
+                    continue_sending = method(message)
                 except Exception, e:
-                    self.error("%s failed on %s: %r\n%s", app, phase, e, traceback.print_exc())
+                    self.error("%s failed on %s: %r\n%s", slug, phase, e, traceback.format_exc())
                 if continue_sending is False:
-                    self.info("App '%s' cancelled outgoing message", app.slug)
+                    self.info("App '%s' cancelled outgoing message", slug)
                     return False
+        return True
 
-        # now send the message out
-        message.connection.backend.send(message)
-        self.debug("SENT message '%s' to %s via %s" % (message.text,\
-			message.connection.identity, message.connection.backend.slug))
+    def outgoing_many(self, messages):
+        """Sends a batch of _messages_ (such as a blast) at once. The
+           outgoing phase is run over the whole batch (see
+           run_outgoing_phases_many), and the messages which weren't
+           cancelled are handed to their backends with one call to
+           Backend.send_many per backend. Sets the delivery_status of
+           every message, and returns a list of those which were sent."""
+        if not messages:
+            return []
+        self.info("Outgoing batch of %d messages", len(messages))
+        for message in messages:
+            message.delivery_status = DeliveryStatus.CANCELLED
+
+        # group the messages by backend, keeping their order
+        backends = []
+        by_backend = {}
+        for message in self.run_outgoing_phases_many(messages):
+            backend = message.connection.backend
+            if backend not in by_backend:
+                backends.append(backend)
+                by_backend[backend] = []
+            by_backend[backend].append(message)
+
+        sent = []
+        for backend in backends:
+            batch = by_backend[backend]
+            try:
+                backend.send_many(batch)
+                status = DeliveryStatus.SENT
+                sent.extend(batch)
+            except Exception:
+                self.log_last_exception("%s failed to send a batch of %d messages" % (
+                    backend.slug, len(batch)))
+                status = DeliveryStatus.FAILED
+            for message in batch:
+                message.delivery_status = status
+        self.debug("SENT %d of %d messages", len(sent), len(messages))
+        return sent
+
+    def run_outgoing_phases_many(self, messages):
+        """Runs the outgoing phase over a batch of _messages_, and returns
+           a list of those which weren't cancelled. Rather than passing
+           each message through every app, each app is called with every
+           message in turn (except those which an earlier app cancelled),
+           so the dispatch table is only walked once per batch."""
+        dispatch = self.__dispatch_table()
+        for phase in self.outgoing_phases:
+            for slug, method in dispatch[phase]:
+                self.debug("OUT %s %s (%d messages)", phase, slug, len(messages))
+                remaining = []
+                for message in messages:
+                    try:
+                        if method(message) is False:
+                            continue
+                    except Exception, e:
+                        self.error("%s failed on %s: %r\n%s", slug, phase, e, traceback.format_exc())
+                    remaining.append(message)
+                if len(remaining) < len(messages):
+                    self.info("App '%s' cancelled %d outgoing messages",
+                        slug, len(messages) - len(remaining))
+                messages = remaining
+        return messages
+
+
+def _overrides(app, phase):
+    """Returns True if _app_ provides its own implementation of _phase_,
+       rather than inheriting the no-op method from rapidsms.app.App."""
+    if phase in app.__dict__:
         return True
+    method = getattr(type(app), phase, None)
+    default = getattr(App, phase, None)
+    return getattr(method, "im_func", method) is not getattr(default, "im_func", default)
@@ -0,0 +1,343 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4
+
+import os, sys, time, datetime, heapq
+import threading, tempfile
+import cPickle as pickle
+
+import component
+
+# how often (at most) the journal is rewritten, in seconds
+JOURNAL_INTERVAL = 1.0
+
+
+def to_timestamp (when):
+    """Converts any of the time objects understood by Router.call_at
+       (a number of seconds from now, a datetime.datetime or a
+       datetime.timedelta) into a unix timestamp, or returns None
+       if _when_ isn't one of those."""
+    if isinstance(when, datetime.timedelta):
+        when = datetime.datetime.now() + when
+    if isinstance(when, datetime.datetime):
+        return time.mktime(when.timetuple()) + (when.microsecond / 1e6)
+    elif isinstance(when, (int, float)) and not isinstance(when, bool):
+        return time.time() + when
+    return None
+
+
+class ScheduledCall (object):
+    """A handle for a callback scheduled via Router.call_at. Calling
+       cancel() prevents it from firing (again, if it repeats)."""
+
+    _counter = 0
+
+    def __init__(self, when, callback, args, kwargs):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.kwargs = kwargs
+        self.cancelled = False
+
+        # the sequence number breaks ties between
+        # calls scheduled for the exact same time
+        ScheduledCall._counter += 1
+        self.seq = ScheduledCall._counter
+
+    def __cmp__(self, other):
+        return cmp((self.when, self.seq), (other.when, other.seq))
+
+    def __repr__(self):
+        return "<ScheduledCall %s at %s>" % (
+            getattr(self.callback, "func_name", self.callback),
+            datetime.datetime.fromtimestamp(self.when).ctime())
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class Scheduler (component.Component):
+    """Runs the callbacks scheduled via Router.call_at in a thread of its
+       own, so they fire on time regardless of how busy the router is.
+       If a _journal_ path is given, pending calls which can be found again
+       by name (module-level functions, and methods of the router's apps)
+       are saved there, and rescheduled when the router next starts.
+
+       The journal is rewritten by the scheduler's thread (at most every
+       JOURNAL_INTERVAL seconds, and when it stops), not by every call to
+       schedule(). A call restored from the journal is replaced if the
+       same callback is scheduled again with the same arguments (as apps
+       do for their recurring calls, every time they start), so restarts
+       don't pile up copies of it."""
+
+    def __init__(self, router, journal=None):
+        self._router = router
+        self._title = "scheduler"
+        self.journal = journal
+        self.calls = []
+        self.running = False
+        self.thread = None
+        self.condition = threading.Condition()
+
+        # whether the journal is out of date, when it was last
+        # written, and a lock so only one thread writes it at once
+        self.dirty = False
+        self.saved_at = 0.0
+        self.journal_lock = threading.Lock()
+
+        # reference -> [calls restored from the journal]
+        self.restored = {}
+
+        # latency (actual - scheduled fire time) stats,
+        # to check that the scheduler is keeping up
+        self.fired = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    def schedule(self, when, callback, args=(), kwargs={}):
+        call = ScheduledCall(when, callback, args, kwargs)
+        self.condition.acquire()
+        try:
+            self.__replace_restored(call)
+            heapq.heappush(self.calls, call)
+            self.dirty = self.journal is not None
+            self.condition.notify()
+        finally:
+            self.condition.release()
+        return call
+
+    def __replace_restored(self, call):
+        # cancels any restored call to the same callback,
+        # with the same arguments (which _call_ replaces)
+        if not self.restored:
+            return
+        ref = self.__reference(call.callback)
+        for old in self.restored.get(ref, []):
+            if not old.cancelled and old.args == call.args and old.kwargs == call.kwargs:
+                old.cancel()
+
+    @property
+    def pending(self):
+        return len([c for c in self.calls if not c.cancelled])
+
+    def start(self):
+        self.restore()
+        self.running = True
+        self.thread = threading.Thread(target=self.run)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def stop(self, timeout=5.0):
+        self.condition.acquire()
+        try:
+            self.running = False
+            self.condition.notify()
+        finally:
+            self.condition.release()
+        if self.thread is not None:
+            self.thread.join(timeout)
+        self.__save_quietly()
+
+    def run(self):
+        while self.running:
+            call = self.__next_due(block=True)
+            if call is not None:
+                self.fire(call)
+            if self.dirty and time.time() >= self.saved_at + JOURNAL_INTERVAL:
+                self.__save_quietly()
+
+    def run_due(self):
+        """Fires every call which is due, in the calling thread."""
+        while True:
+            call = self.__next_due(block=False)
+            if call is None:
+                break
+            self.fire(call)
+        if self.dirty:
+            self.__save_quietly()
+
+    def __next_due(self, block):
+        # pops the next call which is due, discarding any which have been
+        # cancelled. if _block_ is true, waits until a call becomes due or
+        # the scheduler is stopped. if _block_ is false, returns None right
+        # away if there is nothing to do yet
+        self.condition.acquire()
+        try:
+            while True:
+                while self.calls and self.calls[0].cancelled:
+                    heapq.heappop(self.calls)
+
+                if self.calls and self.calls[0].when <= time.time():
+                    return heapq.heappop(self.calls)
+
+                if not block or not self.running:
+                    return None
+
+                # sleep until the next call is due (or the journal needs
+                # rewriting), or until schedule() or stop() wakes us up
+                timeout = None
+                if self.calls:
+                    timeout = self.calls[0].when - time.time()
+                if self.dirty:
+                    until_save = self.saved_at + JOURNAL_INTERVAL - time.time()
+                    if until_save <= 0:
+                        return None
+                    if timeout is None or until_save < timeout:
+                        timeout = until_save
+
+                if timeout is not None:
+                    self.condition.wait(max(0.0, timeout))
+                else:
+                    self.condition.wait()
+        finally:
+            self.condition.release()
+
+    def fire(self, call):
+        latency = time.time() - call.when
+        self.fired += 1
+        self.total_latency += latency
+        self.max_latency = max(self.max_latency, latency)
+
+        self.info("Calling %s(%s, %s)",
+            getattr(call.callback, "func_name", call.callback), call.args, call.kwargs)
+        try:
+            result = call.callback(*call.args, **call.kwargs)
+        except Exception:
+            self.log_last_exception("Scheduled call to %r failed" % call)
+            result = None
+
+        # if the callback returned a time, reschedule it (re-using
+        # the same handle, so it can still be cancelled later)
+        when = to_timestamp(result) if result else None
+        self.condition.acquire()
+        try:
+            if when is not None and not call.cancelled:
+                call.when = when
+                heapq.heappush(self.calls, call)
+            self.dirty = self.journal is not None
+        finally:
+            self.condition.release()
+
+    def stats(self):
+        return {
+            "pending":      self.pending,
+            "fired":        self.fired,
+            "mean_latency": (self.total_latency / self.fired) if self.fired else 0.0,
+            "max_latency":  self.max_latency }
+
+    def __reference(self, callback):
+        # returns a picklable reference to _callback_, which can
+        # be resolved back into the callable by __resolve, or None
+        # if there is no way to find this callback again later
+        owner = getattr(callback, "im_self", None)
+        if owner is not None:
+            if owner in self.router.apps:
+                return ("app", owner.slug, callback.__name__)
+            return None
+
+        module = getattr(callback, "__module__", None)
+        name = getattr(callback, "__name__", None)
+        if module and name and getattr(sys.modules.get(module), name, None) is callback:
+            return ("func", module, name)
+        return None
+
+    def __resolve(self, ref):
+        kind, owner, name = ref
+        if kind == "app":
+            for app in self.router.apps:
+                if app.slug == owner:
+                    return getattr(app, name, None)
+            return None
+        module = __import__(owner, {}, {}, [name])
+        return getattr(module, name, None)
+
+    def __save_quietly(self):
+        # a journal which can't be written mustn't stop the scheduler
+        try:
+            self.save()
+        except Exception:
+            self.log_last_exception("Couldn't write the scheduler journal")
+
+    def save(self):
+        if self.journal is None:
+            return
+
+        self.journal_lock.acquire()
+        try:
+            try:
+                self.__save()
+            except:
+                # try again later
+                self.dirty = True
+                raise
+        finally:
+            self.journal_lock.release()
+
+    def __save(self):
+        self.condition.acquire()
+        try:
+            calls = list(self.calls)
+            self.dirty = False
+            self.saved_at = time.time()
+        finally:
+            self.condition.release()
+
+        entries = []
+        for call in calls:
+            if call.cancelled:
+                continue
+            ref = self.__reference(call.callback)
+            if ref is None:
+                continue
+            try:
+                entries.append(pickle.dumps(
+                    (call.when, ref, call.args, call.kwargs), pickle.HIGHEST_PROTOCOL))
+            except (pickle.PicklingError, TypeError):
+                self.debug("Not saving %r (arguments can't be pickled)", call)
+
+        # write to a temporary file (of our own) and move it into place,
+        # so a crash can never leave a half-written journal behind
+        fd, tmp = tempfile.mkstemp(prefix=os.path.basename(self.journal) + ".",
+            dir=os.path.dirname(os.path.abspath(self.journal)))
+        try:
+            f = os.fdopen(fd, "wb")
+            try:
+                pickle.dump(entries, f, pickle.HIGHEST_PROTOCOL)
+            finally:
+                f.close()
+            os.rename(tmp, self.journal)
+        except:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+    def restore(self):
+        if self.journal is None or not os.path.exists(self.journal):
+            return
+
+        f = open(self.journal, "rb")
+        try:
+            entries = pickle.load(f)
+        finally:
+            f.close()
+
+        for entry in entries:
+            try:
+                when, ref, args, kwargs = pickle.loads(entry)
+                callback = self.__resolve(ref)
+            except Exception:
+                self.log_last_exception("Couldn't restore a scheduled call")
+                continue
+
+            if callback is None:
+                self.warning("Dropping scheduled call to %s.%s (not found)", ref[1], ref[2])
+                continue
+
+            # calls which were due while the router was down
+            # will fire right away, and show up as late
+            call = ScheduledCall(when, callback, args, kwargs)
+            self.condition.acquire()
+            try:
+                heapq.heappush(self.calls, call)
+                self.restored.setdefault(ref, []).append(call)
+            finally:
+                self.condition.release()
@@ -8,7 +8,18 @@ from test_app import *
 from test_backend import *
 from test_backend_irc import *
 from test_backend_spomc import *
+from test_backend_gsmpool import *
+from test_backend_loadgen import *
+from test_backend_http import *
+from test_backend_polling import *
 from test_router import *
+from test_workers import *
+from test_scheduler import *
+from test_queues import *
+from test_outbound import *
+from test_cache import *
+from test_catalog import *
+from test_dispatcher import *
 from scripted import MockTestScript
 
 if __name__ == "__main__":
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4
+
+import unittest, time
+from harness import MockRouter
+
+class FakeModem (object):
+    def __init__ (self, works=True):
+        self.works = works
+        self.sent = []
+
+    def send_sms (self, recipient, text, max_messages=1):
+        if not self.works:
+            return None
+        self.sent.append((recipient, text))
+        return True
+
+class TestBackendGsmPool(unittest.TestCase):
+    def setUp (self):
+        try:
+            from rapidsms.backends.gsmpool import Backend
+        except ImportError:
+            # pygsm needs pyserial
+            self.backend = None
+            return
+
+        self.router = MockRouter()
+        self.backend = Backend(self.router)
+        self.backend._configure(ports="/dev/ttyUSB0,/dev/ttyUSB1,/dev/ttyUSB2",
+            strategy="sticky", retry_interval=3600)
+        for modem in self.backend.modems:
+            modem.modem = FakeModem()
+            modem.up = True
+            modem.started = time.time()
+        self.router.add_backend(self.backend)
+
+    def message (self, identity):
+        return self.backend.message(identity, "hello")
+
+    def test_configure (self):
+        if self.backend is None: return
+        self.assertEquals(len(self.backend.modems), 3, "pool has three modems")
+        self.assertRaises(Exception, self.backend._configure,
+            ports="/dev/ttyUSB0", strategy="random")
+
+    def test_strategies (self):
+        if self.backend is None: return
+        modems = self.backend.modems
+        msg = self.message("1234")
+        sticky = self.backend.choose_modem(msg)
+        self.assertTrue(sticky is self.backend.choose_modem(msg), "sticky modem is stable")
+        sticky.up = False
+        self.assertTrue(self.backend.choose_modem(msg) is not sticky, "skips a failed modem")
+        sticky.up = True
+
+        self.backend.strategy = "round-robin"
+        chosen = [self.backend.choose_modem(msg) for n in range(3)]
+        self.assertEquals(set(chosen), set(modems), "round-robin uses every modem")
+
+        self.backend.strategy = "least-queue"
+        modems[0].queue.put(msg)
+        modems[1].queue.put(msg)
+        self.assertTrue(self.backend.choose_modem(msg) is modems[2], "emptiest modem")
+
+        for modem in modems: modem.up = False
+        self.assertEquals(self.backend.choose_modem(msg), None, "no modems are up")
+
+    def test_failover (self):
+        if self.backend is None: return
+        broken = self.backend.modems[0]
+        broken.modem.works = False
+        self.backend._running = True
+        broken.start()
+        broken.queue.put(self.message("1234"))
+        time.sleep(0.2)
+        self.backend._running = False
+
+        self.assertFalse(broken.up, "failed modem was taken out of rotation")
+        self.assertEquals(broken.stats()["failed"], 1, "failure was counted")
+        self.assertEquals(self.backend.next_message().peer, "1234",
+            "message was handed back to be re-routed")
+
+if __name__ == "__main__":
+    unittest.main()
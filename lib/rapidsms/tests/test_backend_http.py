@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4 encoding=utf-8
+
+import unittest, threading, time, httplib, urllib
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from harness import MockRouter
+from rapidsms.backends.http import Backend
+from rapidsms.backends.httpclient import HttpClient, HttpError
+
+class StubGateway (BaseHTTPRequestHandler):
+    """Accepts outgoing messages (after failing the first few)"""
+    protocol_version = "HTTP/1.1"
+
+    def do_GET (self):
+        self.server.requests.append(self.path)
+        if self.server.failures > 0:
+            self.server.failures -= 1
+            status = 503
+        else:
+            status = self.path.startswith("/send") and 200 or 404
+        self.send_response(status)
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+        self.wfile.write("OK")
+
+    def log_message (self, *args):
+        pass
+
+class TestBackendHttp(unittest.TestCase):
+    def setUp (self):
+        self.gateway = HTTPServer(("127.0.0.1", 0), StubGateway)
+        self.gateway.requests = []
+        self.gateway.failures = 0
+        thread = threading.Thread(target=self.gateway.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+        self.gateway_url = "http://127.0.0.1:%d" % self.gateway.server_address[1]
+
+        self.router = MockRouter()
+        self.backend = Backend(self.router)
+        self.backend._configure(host="127.0.0.1", port=0, handler="GatewayHandler",
+            outgoing_url=self.gateway_url + "/send", backoff=0.01, threads=2)
+        self.router.add_backend(self.backend)
+        self.thread = threading.Thread(target=self.backend.start)
+        self.thread.start()
+
+    def tearDown (self):
+        self.backend.stop()
+        self.thread.join()
+        self.gateway.socket.close()
+
+    def test_incoming (self):
+        # two requests over one (kept-alive) connection
+        conn = httplib.HTTPConnection(*self.backend.server.server_address)
+        conn.request("GET", "/?from=123&text=caf%C3%A9+au+lait&sent=0")
+        response = conn.getresponse()
+        response.read()
+        self.assertEquals(response.status, 200)
+        conn.request("POST", "/", urllib.urlencode({"from": "456", "text": "a&b=c"}),
+            {"Content-Type": "application/x-www-form-urlencoded"})
+        response = conn.getresponse()
+        response.read()
+        self.assertEquals(response.status, 200)
+        conn.request("GET", "/?from=123")
+        self.assertEquals(conn.getresponse().status, 400, "text is required")
+        conn.close()
+
+        msg = self.router.next_message(1.0)
+        self.assertEquals((msg.peer, msg.text), ("123", u"caf\xe9 au lait"),
+            "query string is url-decoded (as utf-8)")
+        msg = self.router.next_message(1.0)
+        self.assertEquals((msg.peer, msg.text), ("456", u"a&b=c"), "form is decoded")
+
+    def test_outgoing (self):
+        # the first attempt fails, and is retried
+        self.gateway.failures = 1
+        self.backend.send(self.backend.message("123", u"caf\xe9"))
+        for n in range(100):
+            if self.backend.sent: break
+            time.sleep(0.05)
+        self.assertEquals(self.backend.sent, 1)
+        self.assertEquals(self.gateway.requests[-1], "/send?to=123&text=caf%C3%A9")
+        self.assertEquals(self.backend.client.stats()["retried"], 1)
+
+    def test_no_outgoing_url (self):
+        self.backend.outgoing_url = None
+        self.backend.send(self.backend.message("123", u"hello"))
+        for n in range(100):
+            if self.backend.failed: break
+            time.sleep(0.05)
+        self.assertEquals((self.backend.sent, self.backend.failed), (0, 1),
+            "counted as failed, not sent")
+        self.assertEquals(self.gateway.requests, [])
+
+    def test_client (self):
+        client = HttpClient(retries=1, backoff=0.01)
+        for n in range(3):
+            self.assertEquals(client.request("GET", self.gateway_url + "/send"), (200, "OK"))
+        self.assertEquals(client.stats()["connections"], 1, "connection is reused")
+        self.assertRaises(HttpError, client.request, "GET", self.gateway_url + "/missing")
+        self.assertEquals(client.stats()["retried"], 0, "4xx errors aren't retried")
+        client.close()
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4
+
+import unittest, time
+from harness import MockRouter, EchoApp
+from rapidsms.backends.loadgen import Backend, percentile
+
+class TestBackendLoadgen(unittest.TestCase):
+    def setUp (self):
+        self.router = MockRouter()
+        self.router.add_app(EchoApp(self.router))
+        self.backend = Backend(self.router)
+        self.backend._configure(identities=3, mix="echo:1,silent:0",
+            echo="hello %(n)d", silent="nothing", timeout=1, seed=1)
+        self.router.add_backend(self.backend)
+
+    def test_configure (self):
+        self.assertRaises(Exception, self.backend._configure, mix="unknown:1")
+        self.assertRaises(Exception, self.backend._configure, bogus="x")
+
+    def test_percentile (self):
+        values = range(1, 101)
+        self.assertEquals(percentile(values, 50), 51)
+        self.assertEquals(percentile(values, 99), 99)
+        self.assertEquals(percentile([], 50), None)
+
+    def test_finished (self):
+        # the loadtest command waits for this, even if the traffic fails
+        def fail (n): raise IOError("can't send")
+        self.backend.generate = fail
+        self.backend._configure(identities=3, mix="echo:1", echo="hello",
+            delay=0, duration=5)
+        self.assertRaises(IOError, self.backend.start)
+        self.assertTrue(self.backend.finished.isSet())
+
+    def test_latency (self):
+        # three phones, so the fourth message can't be sent
+        # until one of the first three has been answered
+        msgs = [self.backend.generate(n) for n in range(4)]
+        self.assertEquals(msgs[3], None)
+        self.assertEquals(self.backend.skipped, 1)
+        self.assertEquals(self.backend.message_waiting, 0)
+
+        # the echo app responds to each message, which
+        # the backend matches to the phone's pending message
+        for n in range(3):
+            self.router.incoming(self.router.next_message())
+        stats = self.backend.stats()["kinds"]
+        self.assertEquals(stats["echo"]["sent"], 3)
+        self.assertEquals(stats["echo"]["answered"], 3)
+        self.assertTrue(stats["echo"]["p99"] < 1.0)
+        self.assertEquals(stats["all"]["answered"], 3)
+
+        # a phone's messages which aren't answered are given up on
+        msg = self.backend.generate(5)
+        self.backend.expire(time.time() + 1)
+        self.assertEquals(self.backend.stats()["kinds"]["echo"]["unanswered"], 1)
+        self.assertEquals(len(self.backend.idle), 3)
+
+        # and anything else sent to the phones is just counted
+        self.backend.send(self.backend.message(msg.peer, "blast"))
+        self.assertEquals(self.backend.received, 1)
+        self.assertTrue("echo" in self.backend.report())
+
+    def test_blast_to_pending_phone (self):
+        # a blast or a forward reaching a phone with a message
+        # pending isn't its answer, even if it arrives first
+        first, second = [self.backend.generate(n) for n in range(2)]
+        self.backend.send(self.backend.message(first.peer, "blast"))
+        second.forward(first.peer, "forwarded")
+        self.backend.send(second.responses.popleft())
+        self.assertEquals(self.backend.stats()["kinds"]["echo"]["answered"], 0)
+        self.assertEquals(self.backend.received, 2)
+
+        # but their responses are
+        for msg in (first, second):
+            msg.respond("echo")
+            self.backend.send(msg.responses.popleft())
+        stats = self.backend.stats()
+        self.assertEquals(stats["kinds"]["echo"]["answered"], 2)
+        self.assertEquals(stats["received"], 2)
+        self.assertEquals(len(self.backend.idle), 3)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4
+
+import unittest, threading, socket, time
+from datetime import datetime
+from harness import MockRouter
+from rapidsms.connection import Connection
+from utilities.dbmessagelog.httplog import notify
+from utilities.dbmessagelog.httplog.models import IncomingMessage, OutgoingMessage
+from rapidsms.backends.polling import Backend, QueuedMessage
+try:
+    from django.test import TestCase
+except:
+    from unittest import TestCase
+
+class TestNotify(unittest.TestCase):
+    def setUp (self):
+        self.listener = notify.Listener("127.0.0.1", 0)
+        self.host, self.port = self.listener.address
+
+    def tearDown (self):
+        self.listener.close()
+
+    def test_parse (self):
+        self.assertEquals(notify.parse("new 12"), ("new", 12))
+        self.assertEquals(notify.parse("wake"), (None, None))
+        self.assertEquals(notify.parse("new twelve"), (None, None))
+
+    def test_wait_for (self):
+        # the backend's end answers the first message it's told about
+        received = []
+        def backend ():
+            self.listener.wait(5.0)
+            for id, address in self.listener.receive():
+                received.append(id)
+                self.listener.done(id, address)
+        thread = threading.Thread(target=backend)
+        thread.start()
+        self.assertTrue(notify.wait_for(42, 5.0, self.host, self.port), "view was told")
+        thread.join()
+        self.assertEquals(received, [42], "backend was told")
+
+    def test_wait_for_timeout (self):
+        start = time.time()
+        self.assertFalse(notify.wait_for(42, 0.2, self.host, self.port), "nobody answered")
+        self.assertTrue(time.time() - start < 2.0, "gave up in time")
+        self.assertEquals([id for id, address in self.listener.receive()], [42])
+
+    def test_wake (self):
+        start = time.time()
+        self.listener.wake()
+        self.listener.wait(5.0)
+        self.assertTrue(time.time() - start < 2.0, "woken right away")
+        self.assertEquals(self.listener.receive(), [], "wakeups are dropped")
+
+    def test_port_in_use (self):
+        other = notify.Listener(self.host, self.port)
+        try:
+            self.assertFalse(other.bound, "port was taken")
+            self.assertNotEquals(other.address[1], self.port)
+        finally:
+            other.close()
+
+class TestBackendPolling(TestCase):
+    def setUp (self):
+        self.router = MockRouter()
+        self.backend = Backend(self.router)
+        self.backend._configure(timeout=10, batch=2, in_flight=3)
+        self.backend.listener = notify.Listener("127.0.0.1", 0)
+        self.router.add_backend(self.backend)
+
+    def tearDown (self):
+        self.backend.listener.close()
+
+    def queue (self, *texts):
+        return [IncomingMessage.objects.create(phone="1234", text=text,
+            time=datetime.now(), status="R").id for text in texts]
+
+    def statuses (self, ids):
+        return [IncomingMessage.objects.get(id=id).status for id in ids]
+
+    def test_claim (self):
+        ids = self.queue("one", "two", "three", "four")
+        self.assertTrue(self.backend.claim(), "claimed a whole batch")
+        self.assertEquals(self.statuses(ids), ["H", "H", "R", "R"])
+        routed = [self.router.next_message() for n in range(2)]
+        self.assertEquals([(m.text, m.row_id) for m in routed], [("one", ids[0]), ("two", ids[1])])
+
+        # only one more fits in flight
+        self.assertTrue(self.backend.claim())
+        self.assertEquals(self.statuses(ids), ["H", "H", "H", "R"])
+        self.assertTrue(self.backend.claim(), "no room, so try again later")
+        self.assertEquals(self.backend.stats()["in_flight"], 3)
+
+    def test_finish (self):
+        id, = self.queue("hello")
+        self.backend.claim()
+
+        # finished once it's processed, and its response has been sent
+        self.backend.expect(id)
+        self.backend.processed(id)
+        self.assertEquals(self.backend.finish(), 0, "response not sent yet")
+        self.backend.send(QueuedMessage(Connection(self.backend, "1234"), "hi", row_id=id))
+        self.backend.delivered(id)
+
+        # and the view waiting for it is told
+        view = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        view.bind(("127.0.0.1", 0))
+        view.settimeout(5.0)
+        self.backend.waiters.put(id, view.getsockname())
+        self.assertEquals(self.backend.finish(), 1)
+        self.assertEquals(view.recv(notify.MAX_DATAGRAM), "done %d" % id)
+        view.close()
+
+        row = IncomingMessage.objects.get(id=id)
+        self.assertEquals(row.status, "P")
+        self.assertEquals([r.text for r in row.responses.all()], ["hi"])
+        self.assertEquals(self.backend.stats()["in_flight"], 0)
+
+    def test_expire (self):
+        ids = self.queue("one", "two")
+        self.backend.claim()
+        now = time.time()
+        self.assertEquals(self.backend.expire(now), 0, "not timed out yet")
+        self.assertEquals(self.backend.expire(now + 10), 2)
+        self.assertEquals(self.statuses(ids), ["T", "T"])
+
+        # and anything which happens to them later is ignored
+        self.backend.processed(ids[0])
+        self.assertEquals(self.backend.finish(), 0)
+        self.assertEquals(self.backend.stats()["timed_out"], 2)
+
+    def test_send (self):
+        # messages which don't answer one in flight are saved right away
+        id, = self.queue("hello")
+        self.backend.claim()
+        self.backend.send_many([
+            self.backend.message("1234", "reply"),
+            self.backend.message("5678", "blast"),
+            self.backend.message("9999", "blast")])
+        self.assertEquals(sorted(OutgoingMessage.objects.values_list("phone", flat=True)),
+            ["5678", "9999"])
+        self.backend.processed(id)
+        self.backend.finish()
+        self.assertEquals([r.text for r in IncomingMessage.objects.get(id=id).responses.all()],
+            ["reply"])
+
+if __name__ == "__main__":
+    unittest.main()
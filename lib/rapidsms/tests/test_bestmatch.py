@@ -236,6 +236,43 @@ class TestBestMatch(unittest.TestCase):
         print "solution is '%s'" % res[0]
         self.assertTrue(len(res)==1 and res[0]=='spaceyname')
 
+    def test09RemoveTargetWithAliases(self):
+        print
+        print "Add 'boston' with aliases, then remove it"
+        self.cityM.add_target(['boston', 'the hub', 'beantown'])
+        self.assertTrue(self.cityM.remove_target('boston'))
+        self.assertTrue(len(self.cityM.match('beantown'))==0)
+        self.assertTrue(len(self.cityM.match('bos'))==0)
+        self.assertFalse(self.cityM.remove_target('boston'))
+
+        print "Re-add 'boston' with different aliases"
+        self.cityM.add_target(['boston', 'the hub'])
+        self.cityM.add_target(['boston', 'beantown'])
+        self.assertTrue(len(self.cityM.match('the hub'))==0)
+        res = self.cityM.match('bean')
+        self.assertTrue(len(res)==1 and res[0]=='boston')
+
+    def test10IncrementalPrefixes(self):
+        print
+        print "Prefixes apply to targets added before and after them"
+        matcher = BestMatch(['Keur Massar', 'Ndiaye'], ignore_prefixes=['keur'])
+        matcher.add_target('keur  Moussa')
+        res = matcher.match('mas')
+        self.assertTrue(len(res)==1 and res[0]=='Keur Massar')
+        res = matcher.match('MOUSSA')
+        self.assertTrue(len(res)==1 and res[0]=='keur  Moussa')
+
+        print "Sources with a prefix only match the whole name"
+        res = matcher.match('keur')
+        self.assertTrue(set(res)==set(['Keur Massar', 'keur  Moussa']))
+
+        print "Add prefix 'n'"
+        matcher.add_ignore_prefix('n')
+        res = matcher.match('dia')
+        self.assertTrue(len(res)==1 and res[0]=='Ndiaye')
+        matcher.remove_target('Keur Massar')
+        self.assertTrue(len(matcher.match('mas'))==0)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4
+
+import unittest, time
+from rapidsms.cache import LRUCache
+
+class TestLRUCache(unittest.TestCase):
+    def test_lru (self):
+        evicted = []
+        cache = LRUCache(size=3, on_evict=lambda k, v: evicted.append(k))
+        for n in range(3):
+            cache.put(n, str(n))
+        self.assertEquals(cache.keys(), [2, 1, 0])
+
+        # reading an item makes it the most recently used,
+        # so the next put evicts the least recently used
+        self.assertEquals(cache.get(0), "0")
+        cache.put(3, "3")
+        self.assertEquals(cache.keys(), [3, 0, 2])
+        self.assertEquals(cache.get(1), None)
+        self.assertEquals(evicted, [1])
+        self.assertEquals(cache.stats(),
+            { "size": 3, "hits": 1, "misses": 1, "evictions": 1 })
+
+        # replacing doesn't evict anything
+        cache.put(2, "two")
+        self.assertEquals(cache.keys(), [2, 3, 0])
+        self.assertEquals(cache.get(2), "two")
+
+        self.assertEquals(cache.pop(3), "3")
+        self.assertEquals(cache.pop(3, "gone"), "gone")
+        self.assertEquals(len(cache), 2)
+        self.assertTrue(2 in cache)
+        self.assertFalse(3 in cache)
+
+        cache.clear()
+        self.assertEquals(evicted, [1])
+        self.assertEquals(len(cache), 0)
+        self.assertEquals(cache.keys(), [])
+
+    def test_max_age (self):
+        cache = LRUCache(size=10, max_age=0.1)
+        cache.put("a", 1)
+        self.assertEquals(cache.get("a"), 1)
+        time.sleep(0.2)
+        self.assertEquals(cache.get("a"), None)
+        self.assertEquals(len(cache), 0)
+
+if __name__ == "__main__":
+    unittest.main()
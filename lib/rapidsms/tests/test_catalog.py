@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4 encoding=utf-8
+
+import unittest, gettext
+import pickle, cPickle
+from rapidsms.catalog import Catalog, Template, gsm_length, is_gsm
+
+class DictTranslations (gettext.NullTranslations):
+    def __init__(self, messages):
+        gettext.NullTranslations.__init__(self)
+        self.messages = messages
+
+    def ugettext(self, message):
+        return self.messages.get(message, unicode(message))
+
+class TestCatalog(unittest.TestCase):
+    def test_gsm_length (self):
+        self.assertEquals(gsm_length(u"hello"), 5)
+        self.assertEquals(gsm_length(u""), 0)
+        self.assertEquals(gsm_length(42), 2)
+        # characters from the extension table take two septets
+        self.assertEquals(gsm_length(u"{x}"), 5)
+        self.assertEquals(gsm_length(u"ش"), None)
+        self.assertFalse(is_gsm(u"ش"))
+
+    def test_template (self):
+        t = Template(u"%(text)s - %(sender)s %%")
+        self.assertEquals(t.names, ["text", "sender"])
+        self.assertEquals(t.static_length, 5)
+        self.assertTrue(t.countable)
+
+        r = t.render({ "text": u"hi", "sender": u"bob" })
+        self.assertEquals(r, u"hi - bob %")
+        self.assertEquals((r.encoding, r.length), ("gsm", 10))
+        self.assertTrue(r.fits())
+        self.assertFalse(r.fits(max_gsm=9))
+
+        # one non-gsm value makes the whole message UCS-2
+        r = t.render({ "text": u"ش^", "sender": u"bob" })
+        self.assertEquals((r.encoding, r.length), ("ucs2", 10))
+
+        # formatted values are counted in the rendered text
+        t = Template(u"%d left ^")
+        self.assertFalse(t.countable)
+        r = t.render(12)
+        self.assertEquals((r, r.encoding, r.length), (u"12 left ^", "gsm", 10))
+        self.assertRaises(TypeError, t.render, ("a", "b"))
+
+    def test_pickle (self):
+        # rendered replies are pickled when a queue spills to disk
+        r = Template(u"%(text)s ^").render({ "text": u"hé" })
+        for module in (pickle, cPickle):
+            for protocol in range(3):
+                copy = module.loads(module.dumps(r, protocol))
+                self.assertEquals((copy, copy.encoding, copy.length),
+                    (u"hé ^", "gsm", 5))
+
+    def test_catalog (self):
+        catalog = Catalog({
+            "fr": DictTranslations({ "hello %(name)s": u"bonjour %(name)s" }),
+            "en": DictTranslations({}) }, "fr")
+
+        self.assertEquals(catalog.render("fr", "hello %(name)s", { "name": "bob" }), u"bonjour bob")
+        self.assertEquals(catalog.render("en", "hello %(name)s", { "name": "bob" }), u"hello bob")
+        # unknown locales fall back to the default
+        self.assertEquals(catalog.translate("xx", "hello %(name)s"), u"bonjour %(name)s")
+        self.assertEquals(catalog.render("fr", "hello %(name)s"), u"bonjour %(name)s")
+
+        stats = catalog.stats()
+        self.assertEquals((stats["templates"], stats["hits"], stats["misses"]), (2, 2, 2))
+        self.assertEquals(stats["renders"], 3)
+
+        catalog.reset()
+        self.assertEquals(catalog.stats()["templates"], 0)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4
+
+import unittest, re
+from rapidsms.parsers.dispatcher import Dispatcher, literal_prefix
+from rapidsms.parsers.keyworder import Keyworder
+
+class TestDispatcher(unittest.TestCase):
+    def test_literal_prefix (self):
+        self.assertEquals(literal_prefix(r"^report\s+(.+)$"), "report")
+        self.assertEquals(literal_prefix(r"^REP(ort)?$"), "rep")
+        self.assertEquals(literal_prefix(r"^reports?$"), "report")
+        self.assertEquals(literal_prefix(r"^ab+c$"), "ab")
+        self.assertEquals(literal_prefix(r"^a{2}b$"), "")
+        self.assertEquals(literal_prefix(r"^(\d+)$"), "")
+        self.assertEquals(literal_prefix(r"^join|leave$"), "")
+        self.assertEquals(literal_prefix(r"^x(join|leave)$"), "x")
+        self.assertEquals(literal_prefix(r"^x[|]$"), "x")
+        self.assertEquals(literal_prefix(r"^report", re.VERBOSE), "")
+
+    def test_match (self):
+        d = Dispatcher()
+        d.add(r"^report\s+(\d+)$", "number")
+        d.add(r"^report\s+(.+)$", "other")
+        d.add(r"^rep(ly)?$", "reply")
+        d.add(r"^(\w+)\s+help$", "help")
+        d.add(r"^(.+)$", "anything")
+
+        self.assertEquals(d.match("report 12"), ("number", ["12"]))
+        self.assertEquals(d.match("REPORT lots "), ("other", ["lots"]))
+        self.assertEquals(d.match("rep"), ("reply", [None]))
+        self.assertEquals(d.match("Reply"), ("reply", ["ly"]))
+        self.assertEquals(d.match("report help"), ("other", ["help"]))
+        self.assertEquals(d.match("join help"), ("help", ["join"]))
+        self.assertEquals(d.match("xyz"), ("anything", ["xyz"]))
+        self.assertEquals(Dispatcher().match("xyz"), None)
+
+        # only the patterns which could match are tried
+        self.assertEquals([r.handler for r in d.candidates("join")],
+            ["help", "anything"])
+
+    def test_keywords (self):
+        d = Dispatcher()
+        d.add_keyword([u"join", u"boole"], "join", {"lang": "en"})
+        d.add_keyword(u"jo", "jo")
+        d.add_keyword(u"leave", "leave")
+
+        self.assertEquals(d.match_keyword(u" JOIN "), [(u"join", "join", {"lang": "en"})])
+        self.assertEquals(d.match_keyword(u"boo"), [(u"join", "join", {"lang": "en"})])
+        self.assertEquals(d.match_keyword(u"jo"), [(u"jo", "jo", None)])
+        self.assertEquals(sorted(d.match_keyword(u"j")),
+            [(u"jo", "jo", None), (u"join", "join", {"lang": "en"})])
+        self.assertEquals(d.match_keyword(u"x"), [])
+        self.assertEquals(d.match_keyword(u""), [])
+
+    def test_keyworder (self):
+        kw = Keyworder()
+        def report(): pass
+        def fallback(): pass
+        kw("report (numbers)")(report)
+        kw.prefix = ["a", "b"]
+        kw.invalid()(fallback)
+        self.assertEquals(kw.match(None, "report 5"), (report, ["5"]))
+        self.assertEquals(kw.match(None, "b huh"), (fallback, ["huh"]))
+
+        # regexen appended directly are matched too
+        def direct(): pass
+        kw.regexen.append((re.compile(r"^direct$", re.I), direct))
+        self.assertEquals(kw.match(None, "Direct"), (direct, []))
+        self.assertEquals(kw.match(None, "nothing"), None)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -23,7 +23,7 @@ class TestMessage(unittest.TestCase):
         msg = Message(None, "this is a test", self.person)
         self.assertEquals(msg.connection, self.connection, "connection is right (person)")
         self.assertEquals(msg.text, "this is a test", "text is right")
-        self.assertEquals(msg.responses, [], "responses is empty")
+        self.assertEquals(list(msg.responses), [], "responses is empty")
         self.assertRaises(Exception, Message)
 
     def test__unicode__ (self):
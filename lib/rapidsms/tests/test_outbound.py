@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4
+
+import unittest, threading
+from rapidsms.outbound import DeliveryStatus
+from rapidsms.backends.backend import Backend
+from rapidsms.app import App
+from harness import MockRouter
+
+class CancellingApp (App):
+    def outgoing (self, message):
+        return message.text != "cancel me"
+
+class BatchingBackend (Backend):
+    def __init__ (self, router):
+        Backend.__init__(self, router)
+        self.batches = []
+
+    def send_many (self, messages):
+        self.batches.append([m.text for m in messages])
+        Backend.send_many(self, messages)
+
+class TestOutboundDispatcher(unittest.TestCase):
+    def setUp (self):
+        self.router = MockRouter()
+        self.backend = Backend(self.router)
+        self.router.add_backend(self.backend)
+        self.router.apps.append(CancellingApp(self.router))
+
+    def test_without_dispatcher (self):
+        msg = self.backend.message("0000", "hello")
+        self.router.queue_outgoing(msg)
+        self.assertEquals(msg.delivery_status, DeliveryStatus.SENT, "sent right away")
+        self.assertEquals(self.backend.next_message(), msg, "backend got the message")
+
+    def test_flush_responses (self):
+        self.router.configure(outbound_threads=2, outbound_batch=5)
+        self.router.outbound.start()
+
+        done = []
+        finished = threading.Event()
+        def callback (response):
+            done.append(response)
+            if len(done) == 4: finished.set()
+
+        msg = self.backend.message("0000", "hello")
+        for text in ["one", "two", "cancel me", "three"]:
+            msg.respond(text)
+        msg.flush_responses(callback)
+        self.assertEquals(len(msg.responses), 0, "responses were queued")
+
+        finished.wait(5.0)
+        self.router.outbound.stop()
+        self.assertEquals([r.text for r in done], ["one", "two", "cancel me", "three"],
+            "callbacks were called in order")
+        self.assertEquals([r.delivery_status for r in done],
+            [DeliveryStatus.SENT, DeliveryStatus.SENT, DeliveryStatus.CANCELLED, DeliveryStatus.SENT],
+            "delivery status was recorded")
+        sent = [self.backend.next_message().text for n in range(3)]
+        self.assertEquals(sent, ["one", "two", "three"], "backend got the messages")
+
+    def test_batches_reach_send_many (self):
+        backend = BatchingBackend(self.router)
+        self.router.add_backend(backend)
+        self.router.configure(outbound_threads=1, outbound_batch=3)
+
+        # queued before the sender starts, so they're taken in batches
+        done = []
+        finished = threading.Event()
+        def callback (response):
+            done.append(response)
+            if len(done) == 5: finished.set()
+        for text in ["one", "cancel me", "two", "three", "four"]:
+            self.router.queue_outgoing(backend.message("0000", text), callback)
+        self.router.outbound.start()
+
+        finished.wait(5.0)
+        self.router.outbound.stop()
+        self.assertEquals(backend.batches, [["one", "two"], ["three", "four"]],
+            "each batch was sent with one send_many")
+        self.assertEquals([(r.text, r.delivery_status) for r in done],
+            [("one", DeliveryStatus.SENT), ("cancel me", DeliveryStatus.CANCELLED),
+             ("two", DeliveryStatus.SENT), ("three", DeliveryStatus.SENT),
+             ("four", DeliveryStatus.SENT)], "callbacks were called in order")
+        self.assertEquals(self.router.outbound.stats()[0]["batches"], 2)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4
+
+import unittest, os, tempfile
+from rapidsms.queues import MessageQueue
+from rapidsms.message import Message
+from rapidsms.component import Receiver
+from rapidsms.backends.backend import Backend
+from harness import MockRouter
+
+class NumberedMessage (Message):
+    journal_attributes = ("number",)
+
+class TestMessageQueue(unittest.TestCase):
+    def setUp (self):
+        self.router = MockRouter()
+        self.backend = Backend(self.router)
+        self.router.add_backend(self.backend)
+
+    def messages (self, count):
+        return [self.backend.message("0000", str(n)) for n in range(count)]
+
+    def drain (self, queue):
+        texts = []
+        while queue.qsize():
+            texts.append(queue.get(False).text)
+        return texts
+
+    def test_invalid (self):
+        self.assertRaises(ValueError, MessageQueue, self.router, 5, "explode")
+        self.assertRaises(ValueError, MessageQueue, self.router, 5, "spill")
+
+    def test_shed (self):
+        queue = MessageQueue(self.router, 3, "shed")
+        for msg in self.messages(5):
+            queue.put(msg)
+        self.assertEquals(queue.dropped, 2, "two messages were shed")
+        self.assertEquals(self.drain(queue), ["2", "3", "4"], "oldest were shed")
+
+    def test_spill (self):
+        fd, journal = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            queue = MessageQueue(self.router, 2, "spill", journal)
+            for msg in self.messages(5):
+                queue.put(msg)
+            self.assertEquals(queue.spilled, 3, "three messages were spilled")
+            self.assertEquals(queue.qsize(), 5, "spilled messages are counted")
+            self.assertEquals(self.drain(queue), ["0", "1", "2", "3", "4"],
+                "spilled messages come back in order")
+            self.assertEquals(os.path.getsize(journal), 0, "journal was truncated")
+        finally:
+            os.remove(journal)
+
+    def test_spill_keeps_class (self):
+        fd, journal = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            queue = MessageQueue(self.router, 1, "spill", journal)
+            for n in range(2):
+                msg = NumberedMessage(self.backend.message("0000", str(n)).connection, str(n))
+                msg.number = n
+                queue.put(msg)
+            queue.get(False)
+            msg = queue.get(False)
+            self.assertEquals((type(msg), msg.number), (NumberedMessage, 1),
+                "class and journal_attributes survive the journal")
+        finally:
+            os.remove(journal)
+
+    def test_spill_thaw_fails (self):
+        fd, journal = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            queue = MessageQueue(self.router, 1, "spill", journal)
+            first, last = self.messages(2)
+            queue.put(first)
+            # two spilled messages for a backend which has gone away
+            for n in range(2):
+                queue.journal.append(("gone", "0000", "lost", None, None, Message, {}))
+                queue.unfinished_tasks += 1
+            queue.put(last)
+            self.assertEquals(self.drain(queue), ["0", "1"], "unrestorable messages are skipped")
+            self.assertEquals(len(queue.journal), 0)
+
+            # so new messages aren't stuck behind an empty queue
+            queue.put(self.messages(1)[0])
+            self.assertEquals(queue.get(True, 1.0).text, "0")
+
+            # nor behind a record which can't be read
+            queue.journal.append("record")
+            open(journal, "wb").write("garbage")
+            self.assertRaises(Exception, queue.journal.pop)
+            self.assertEquals(len(queue.journal), 0)
+        finally:
+            os.remove(journal)
+
+    def test_watermarks (self):
+        events = []
+        queue = MessageQueue(self.router, 10, "shed", high=4, low=1)
+        queue.watch(lambda q: events.append("high"), lambda q: events.append("low"))
+        for msg in self.messages(6):
+            queue.put(msg)
+        self.assertEquals(events, ["high"], "high watermark fired once")
+        self.drain(queue)
+        self.assertEquals(events, ["high", "low"], "low watermark fired once")
+
+    def test_receiver (self):
+        r = Receiver()
+        self.assertFalse(r.watch_queue(), "unbounded queues have no watermarks")
+        r._configure(queue_size="3", queue_overflow="shed")
+        self.assertTrue(r.watch_queue(), "bounded queues have watermarks")
+        for msg in self.messages(4):
+            r.send(msg)
+        self.assertEquals(r.message_waiting, 3, "receiver queue is bounded")
+
+if __name__ == "__main__":
+    unittest.main()
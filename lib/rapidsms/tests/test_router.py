@@ -6,6 +6,7 @@ from rapidsms.router import Router
 from rapidsms.connection import Connection
 from rapidsms.message import Message
 from rapidsms.backends.backend import Backend
+from rapidsms.app import App
 from rapidsms.tests.harness import MockApp, MockLogger
 
 class TestRouter(unittest.TestCase):
@@ -63,6 +64,8 @@ class TestRouter(unittest.TestCase):
         r = Router()
         r.logger = MockLogger()
         threading.Thread(target=r.start).start()
+        # give the router thread a moment to get going
+        time.sleep(0.1)
         self.assertTrue(r.running)
         r.stop()
         self.assertTrue(not r.running) 
@@ -112,11 +115,59 @@ class TestRouter(unittest.TestCase):
         self.assertEquals(stash["arg1"], 2, "int works")
         r.stop()
 
+    def test_rebuild_dispatch(self):
+        class ParseOnlyApp (App):
+            def parse (self, message):
+                pass
+        r = Router()
+        r.logger = MockLogger()
+        parser = ParseOnlyApp(r)
+        mock = MockApp(r)
+        mock.PRIORITY = 1
+        r.apps.extend([parser, mock])
+        r.rebuild_dispatch()
+        self.assertEquals([m for s, m in r._dispatch["parse"]],
+            [mock.parse, parser.parse], "parse phase is sorted by priority")
+        self.assertEquals([m for s, m in r._dispatch["handle"]],
+            [mock.handle], "apps without a handle method are skipped")
+        self.assertEquals([m for s, m in r._dispatch["outgoing"]],
+            [mock.outgoing], "apps without an outgoing method are skipped")
+
     def test_incoming(self):
         pass
    
     def test_outgoing(self):
         pass
 
+    def test_outgoing_many(self):
+        class CensorApp(MockApp):
+            def outgoing (self, message):
+                MockApp.outgoing(self, message)
+                if "bad" in message.text:
+                    return False
+        class BatchBackend(Backend):
+            def send_many (self, messages):
+                self.batches.append(list(messages))
+        r = Router()
+        r.logger = MockLogger()
+        censor = CensorApp(r)
+        censor._configure()
+        mock = MockApp(r)
+        mock._configure()
+        mock.PRIORITY = 1
+        r.apps.extend([censor, mock])
+        backend = BatchBackend(r)
+        backend.batches = []
+        msgs = [Message(Connection(backend, str(n)), text)
+            for n, text in enumerate(["good", "bad", "good"])]
+
+        sent = r.outgoing_many(msgs)
+        self.assertEquals(sent, [msgs[0], msgs[2]], "cancelled message isn't sent")
+        self.assertEquals(backend.batches, [sent], "backend gets one batch")
+        self.assertEquals([m.delivery_status for m in msgs], ["Sent", "Cancelled", "Sent"])
+        self.assertEquals(len(censor.calls), 3, "censor sees every message")
+        self.assertEquals(len(mock.calls), 2, "later apps skip cancelled messages")
+        self.assertEquals(r.outgoing_many([]), [])
+
 if __name__ == "__main__":
     unittest.main()
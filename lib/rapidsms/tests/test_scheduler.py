@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4
+
+import unittest, os, time, datetime, tempfile, threading
+from rapidsms.router import Router
+from rapidsms.scheduler import Scheduler, to_timestamp
+from harness import MockLogger
+
+# scheduled calls can only be saved to a journal if the
+# callback can be found again by name, so use a global
+fired = []
+def remember (value):
+    fired.append(value)
+
+class TestScheduler(unittest.TestCase):
+    def setUp (self):
+        self.router = Router()
+        self.router.logger = MockLogger()
+        del fired[:]
+
+    def test_to_timestamp (self):
+        now = time.time()
+        self.assertTrue(abs(to_timestamp(5) - (now + 5)) < 0.1, "seconds from now")
+        self.assertTrue(abs(to_timestamp(datetime.timedelta(seconds=5)) - (now + 5)) < 0.1,
+            "timedelta from now")
+        self.assertEquals(to_timestamp("tomorrow"), None, "junk is rejected")
+
+    def test_cancel (self):
+        self.router.call_at(0, remember, "a")
+        call = self.router.call_at(0, remember, "b")
+        call.cancel()
+        self.router.call_scheduled()
+        self.assertEquals(fired, ["a"], "cancelled call did not fire")
+        self.assertEquals(self.router.scheduler.pending, 0, "nothing left to do")
+
+    def test_fires_on_time (self):
+        scheduler = self.router.scheduler
+        scheduler.start()
+        self.router.call_at(0.2, remember, "late?")
+        time.sleep(0.5)
+        scheduler.stop()
+        self.assertEquals(fired, ["late?"], "call fired in the scheduler thread")
+        stats = scheduler.stats()
+        self.assertEquals(stats["fired"], 1)
+        self.assertTrue(stats["max_latency"] < 0.2, "call fired close to on time")
+
+    def test_journal (self):
+        fd, journal = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            self.router.scheduler.journal = journal
+            self.router.call_at(0, remember, "saved")
+            self.router.call_at(0, lambda: remember("not saved"))
+            self.router.scheduler.save()
+
+            # a new scheduler, as if the router had been restarted
+            scheduler = Scheduler(self.router, journal)
+            scheduler.restore()
+            self.assertEquals(scheduler.pending, 1, "only named callbacks are saved")
+            scheduler.run_due()
+            self.assertEquals(fired, ["saved"], "restored call fired")
+        finally:
+            os.remove(journal)
+
+    def test_restart (self):
+        fd, journal = tempfile.mkstemp()
+        os.close(fd)
+        os.remove(journal)
+        try:
+            # each "boot" restores the journal, then schedules the same
+            # recurring call again (as an app's start() would)
+            for boot in range(3):
+                scheduler = Scheduler(self.router, journal)
+                scheduler.restore()
+                scheduler.schedule(to_timestamp(60), remember, ("recurring",))
+                scheduler.schedule(to_timestamp(60), remember, ("other",))
+                scheduler.save()
+                self.assertEquals(scheduler.pending, 2, "restored calls are replaced")
+        finally:
+            os.remove(journal)
+
+    def test_concurrent_saves (self):
+        fd, journal = tempfile.mkstemp()
+        os.close(fd)
+        scheduler = self.router.scheduler
+        scheduler.journal = journal
+        errors = []
+        def schedule_many ():
+            try:
+                for n in range(50):
+                    scheduler.schedule(to_timestamp(60), remember, (n,))
+                    scheduler.save()
+            except Exception, e:
+                errors.append(e)
+        try:
+            threads = [threading.Thread(target=schedule_many) for n in range(4)]
+            for t in threads: t.start()
+            for t in threads: t.join()
+            self.assertEquals(errors, [])
+            restored = Scheduler(self.router, journal)
+            restored.restore()
+            self.assertEquals(restored.pending, 200, "every call was saved")
+        finally:
+            os.remove(journal)
+
+if __name__ == "__main__":
+    unittest.main()
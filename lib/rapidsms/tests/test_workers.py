@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4
+
+import unittest, time
+from rapidsms.workers import WorkerPool
+from rapidsms.backends.backend import Backend
+from harness import MockRouter, MockApp
+
+class TestWorkerPool(unittest.TestCase):
+    def setUp (self):
+        self.router = MockRouter()
+        self.backend = Backend(self.router)
+        self.router.add_backend(self.backend)
+        self.app = MockApp(self.router)
+        self.router.add_app(self.app)
+
+    def test_configure (self):
+        self.router.configure(workers="3")
+        self.assertEquals(len(self.router.pool), 3, "router builds a pool")
+        self.router.configure(workers=0)
+        self.assertEquals(self.router.pool, None, "zero workers disables the pool")
+        self.assertRaises(Exception, self.router.configure, workers=2, worker_type="process")
+        self.assertRaises(ValueError, WorkerPool, self.router, 0)
+
+    def test_worker_for (self):
+        pool = WorkerPool(self.router, 4)
+        a = self.backend.message("1111", "first")
+        b = self.backend.message("1111", "second")
+        self.assertTrue(pool.worker_for(a) is pool.worker_for(b),
+            "messages from one identity go to the same worker")
+
+    def test_dispatch (self):
+        self.router.configure(workers=2)
+        pool = self.router.pool
+        pool.start()
+        for n in range(10):
+            self.router.send(self.backend.message("%04d" % (n % 3), str(n)))
+            self.router.run()
+        pool.stop()
+
+        handled = [c[1] for c in self.app.calls if c[0] == "handle"]
+        self.assertEquals(len(handled), 10, "every message was handled")
+        for identity in ["0000", "0001", "0002"]:
+            texts = [int(m.text) for m in handled if m.peer == identity]
+            self.assertEquals(texts, sorted(texts), "per-connection order is kept")
+
+        stats = self.router.worker_stats()
+        self.assertEquals(stats["queued"], 0, "router queue is empty")
+        self.assertEquals(sum([w["processed"] for w in stats["workers"]]), 10,
+            "workers report how many messages they processed")
+
+if __name__ == "__main__":
+    unittest.main()
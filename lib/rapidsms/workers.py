@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4
+
+import time
+import threading
+
+import component
+
+
+class Worker (component.Receiver):
+    """A single message-processing thread, owned by a WorkerPool. Each
+       worker has its own queue, and runs the router's incoming phases
+       for every message routed to it, one at a time."""
+
+    def __init__(self, pool, number):
+        component.Receiver.__init__(self)
+        self._router = pool.router
+        self._title = "worker-%d" % number
+        self.pool = pool
+        self.number = number
+        self.thread = None
+
+        # counters used to report utilisation, so
+        # the pool can be sized for the real traffic
+        self.processed = 0
+        self.busy_time = 0.0
+        self.started = None
+
+    def start(self):
+        self.started = time.time()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def run(self):
+        # keep going until the pool is stopped AND our queue has been
+        # drained, so no message accepted by the router is dropped
+        while self.pool.running or self.message_waiting:
+            msg = self.next_message(timeout=0.5)
+            if msg is None:
+                continue
+
+            began = time.time()
+            try:
+                self.router.incoming(msg)
+            except Exception:
+                self.log_last_exception("Worker %d failed to process message" % self.number)
+            self.busy_time += time.time() - began
+            self.processed += 1
+
+    @property
+    def utilisation(self):
+        """Returns the fraction (0.0 to 1.0) of time since this worker
+           was started that it has spent processing messages."""
+        if self.started is None:
+            return 0.0
+        elapsed = time.time() - self.started
+        if elapsed <= 0:
+            return 0.0
+        return min(1.0, self.busy_time / elapsed)
+
+    def stats(self):
+        return {
+            "worker":      self.number,
+            "queued":      self.message_waiting,
+            "processed":   self.processed,
+            "busy_time":   self.busy_time,
+            "utilisation": self.utilisation }
+
+
+class WorkerPool (object):
+    """Spreads incoming messages over a fixed number of Worker threads.
+       Messages are assigned to workers by hashing the identity of their
+       connection, so all of the messages from a single phone number are
+       always handled by the same worker, in the order they arrived."""
+
+    def __init__(self, router, size):
+        if size < 1:
+            raise ValueError("A WorkerPool needs at least one worker (got %d)" % size)
+        self.router = router
+        self.running = False
+        self.workers = [Worker(self, n) for n in range(size)]
+
+    def __len__(self):
+        return len(self.workers)
+
+    def worker_for(self, message):
+        """Returns the Worker which is responsible for the connection
+           that _message_ arrived on."""
+        key = (message.connection.backend.slug, message.connection.identity)
+        return self.workers[hash(key) % len(self.workers)]
+
+    def dispatch(self, message):
+        self.worker_for(message).send(message)
+
+    def start(self):
+        self.running = True
+        for worker in self.workers:
+            worker.start()
+
+    def stop(self, timeout=5.0):
+        """Stops accepting new work, and waits up to _timeout_ seconds
+           for each worker to drain its queue and terminate."""
+        self.running = False
+        for worker in self.workers:
+            if worker.thread is not None:
+                worker.thread.join(timeout)
+                if worker.thread.isAlive():
+                    self.router.warning("Worker %d did not terminate", worker.number)
+
+    @property
+    def queued(self):
+        return sum([w.message_waiting for w in self.workers])
+
+    def stats(self):
+        return [w.stats() for w in self.workers]
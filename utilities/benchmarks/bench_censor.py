@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4
+
+"""Measures the cost of checking blast-sized outbound traffic against a
+   large censor list, comparing the censor app's WordMatcher with the
+   old approach of searching for each word with its own regex."""
+
+import sys, re, time, random, string
+from apps.censor.matcher import WordMatcher
+
+WORDS = 10000
+MESSAGES = 2000
+
+
+def random_word(min=5, max=10):
+    return "".join([random.choice(string.ascii_lowercase)
+        for n in range(random.randint(min, max))])
+
+
+def build_messages(words):
+    messages = []
+    for n in range(MESSAGES):
+        text = " ".join([random_word(2, 8) for i in range(25)])[:160]
+        # one in a hundred messages is censored
+        if n % 100 == 0:
+            text = text[:140] + " " + random.choice(words).upper()
+        messages.append(text)
+    return messages
+
+
+def run(label, func, messages):
+    start = time.time()
+    found = 0
+    for text in messages:
+        if func(text):
+            found += 1
+    elapsed = time.time() - start
+    print "%-18s %10.2f us/msg (%d censored)" % (
+        label, (elapsed / len(messages)) * 1e6, found)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        WORDS = int(sys.argv[1])
+
+    random.seed(0)
+    words = [random_word() for n in range(WORDS)]
+    messages = build_messages(words)
+
+    start = time.time()
+    regexen = [re.compile(w, re.I) for w in words]
+    print "compiled %d regexes in %.2fs" % (len(regexen), time.time() - start)
+    start = time.time()
+    matcher = WordMatcher(words)
+    print "built the matcher in %.2fs" % (time.time() - start)
+
+    print "%d words, %d messages" % (WORDS, MESSAGES)
+    def regex_search(text):
+        for regex in regexen:
+            if regex.search(text):
+                return True
+        return False
+    # (the regexes are too slow to run through every message)
+    run("regex per word", regex_search, messages[:MESSAGES / 20])
+    run("word matcher", matcher.search, messages)
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4
+
+"""Measures the per-message overhead of dispatching incoming messages
+   to a large number of apps, most of which only implement one phase,
+   comparing the router's compiled dispatch table with the old approach
+   of re-sorting the apps for every phase of every message."""
+
+import sys, time
+from rapidsms.router import Router
+from rapidsms.backends.backend import Backend
+from rapidsms.app import App
+from rapidsms.tests.harness import MockLogger
+
+APPS = 32
+MESSAGES = 20000
+
+
+class NullLogger (MockLogger):
+    def write (self, *args):
+        pass
+
+class ParseApp (App):
+    def parse (self, message):
+        message.parsed = True
+
+class HandleApp (App):
+    def handle (self, message):
+        return False
+
+class OutgoingApp (App):
+    def outgoing (self, message):
+        return True
+
+
+def build_router():
+    router = Router()
+    router.logger = NullLogger()
+    kinds = [ParseApp, HandleApp, OutgoingApp, App]
+    for n in range(APPS):
+        router.apps.append(kinds[n % len(kinds)](router))
+    backend = Backend(router)
+    router.backends.append(backend)
+    return router, backend
+
+
+def sorted_dispatch(router, message):
+    """The dispatch loop as it was before the table was compiled."""
+    for phase in router.incoming_phases:
+        for app in sorted(router.apps, key=lambda a: a.priority()):
+            router.debug('IN' + ' ' + phase + ' ' + app.slug)
+            handled = getattr(app, phase)(message)
+            if phase == 'handle' and handled is True:
+                break
+
+
+def run(label, func):
+    start = time.time()
+    for n in xrange(MESSAGES):
+        func()
+    elapsed = time.time() - start
+    print "%-18s %8.2f us/msg" % (label, (elapsed / MESSAGES) * 1e6)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        MESSAGES = int(sys.argv[1])
+
+    router, backend = build_router()
+    msg = backend.message("0000", "benchmark")
+    print "%d apps, %d messages" % (APPS, MESSAGES)
+    run("sorted per phase", lambda: sorted_dispatch(router, msg))
+    run("dispatch table", lambda: router.incoming(msg))
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4
+
+"""Measures the reports/sec accepted by the form app, with 50 forms (5
+   domains, of 10 forms, of 6 tokens each), comparing the compiled
+   FormGrammar with the old approach of matching every code's regex in
+   turn, and looking up (and saving) each part of the report with its
+   own query. This needs a configured project (it reads rapidsms.ini),
+   and builds the forms in a new test database."""
+
+import os, sys, re, time, random
+from datetime import datetime
+
+os.environ.setdefault("RAPIDSMS_INI", "rapidsms.ini")
+os.environ["DJANGO_SETTINGS_MODULE"] = "rapidsms.webui.settings"
+from rapidsms.webui import settings
+from django.core.management import setup_environ
+setup_environ(settings)
+
+from django.db import connection, transaction, reset_queries
+from rapidsms.tests.harness import MockRouter
+from apps.patterns.models import Pattern
+from apps.form.models import *
+from apps.form.app import App as FormApp
+
+DOMAINS = 5
+FORMS = 10
+TOKENS = 6
+REPORTS = 2000
+
+
+class Report(object):
+    def __init__(self, code, type, data):
+        self.code = code
+        self.type = type
+        self.data = data
+        self.date = datetime.now()
+        self.responses = []
+
+    def respond(self, text, status=None):
+        self.responses.append(text)
+
+
+def token(abbreviation, regex):
+    pattern = Pattern.objects.create(name=abbreviation, regex=regex)
+    token = Token.objects.create(name=abbreviation, abbreviation=abbreviation)
+    token.patterns.add(pattern)
+    return token
+
+
+@transaction.commit_on_success
+def build_forms():
+    app = App.objects.create(name="bench")
+    fields = [token("t%d" % n, "(\d+)") for n in range(TOKENS)]
+    form_tokens = [FormToken.objects.create(token=t, sequence=n)
+        for n, t in enumerate(fields)]
+
+    for d in range(DOMAINS):
+        code = "d%d" % d
+        domain = Domain.objects.create(name=code, code=token(code, "(%ss?)" % code))
+        for f in range(FORMS):
+            code = "d%df%d" % (d, f)
+            form = Form.objects.create(name=code, code=token(code, "(%s)" % code))
+            for ft in form_tokens:
+                form.form_tokens.add(ft)
+            form.apps.add(app)
+            domain.domain_forms.add(DomainForm.objects.create(form=form, sequence=f))
+
+
+def build_reports():
+    reports = []
+    for n in range(REPORTS):
+        d = random.randrange(DOMAINS)
+        f = random.randrange(FORMS)
+        data = [str(random.randint(0, 999)) for t in range(TOKENS)]
+        reports.append(Report("D%d" % d, "D%dF%d" % (d, f), data))
+    return reports
+
+
+def walk_form(app, message, code, type, *data):
+    """form.App.form, as it was before the FormGrammar (without the
+       validators, apps or responses, which haven't changed)"""
+    for domain in domains_forms_tokens:
+        domain_matched = _get_code(code, domain)
+        if domain_matched:
+            for form in domain[domain_matched]:
+                form_matched = _get_code(type, form)
+                if form_matched:
+                    this_domain = Domain.objects.get(code__abbreviation__iexact=domain_matched[0])
+                    this_form = Form.objects.get(code__abbreviation__iexact=form_matched[0])
+                    form_entry = FormEntry.objects.create(domain=this_domain,
+                        form=this_form, date=message.date)
+                    for t, d in zip(form[form_matched], data):
+                        this_token = Token.objects.get(abbreviation=t[0])
+                        TokenEntry.objects.create(form_entry=form_entry,
+                            token=this_token, data=d or "")
+                    this_form.get_validation_errors(form_entry)
+                    list(this_form.apps.all())
+                    list(this_form.apps.all())
+                    break
+
+def _get_code(code, dict):
+    for tuple in dict.keys():
+        if re.match(tuple[1], code, re.IGNORECASE):
+            return tuple
+    return False
+
+def build_domains_forms_tokens():
+    domains = []
+    for d in Domain.objects.all():
+        forms = []
+        for f in d.domain_forms.all().order_by("sequence"):
+            tokens = [(ft.token.abbreviation, ft.token.regex)
+                for ft in f.form.form_tokens.order_by("sequence")]
+            forms.append({(f.form.code.abbreviation.upper(), f.form.code.regex): tokens})
+        domains.append({(d.code.abbreviation.upper(), d.code.regex): forms})
+    return domains
+
+
+def run(label, func, reports):
+    reset_queries()
+    start = time.time()
+    for report in reports:
+        func(None, report, report.code, report.type, *report.data)
+    elapsed = time.time() - start
+    print "%-20s %8.0f reports/s %8.1f queries/report" % (
+        label, len(reports) / elapsed, len(connection.queries) / float(len(reports)))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        REPORTS = int(sys.argv[1])
+
+    database = settings.DATABASE_NAME
+    connection.creation.create_test_db(verbosity=0)
+    # (count the queries)
+    settings.DEBUG = True
+    try:
+        build_forms()
+        random.seed(0)
+        reports = build_reports()
+        print "%d forms, %d reports" % (DOMAINS * FORMS, len(reports))
+
+        domains_forms_tokens = build_domains_forms_tokens()
+        run("walked", walk_form, reports)
+
+        app = FormApp(MockRouter())
+        run("compiled", app.form, reports)
+        print "  %r" % app.grammar.stats()
+    finally:
+        connection.creation.destroy_test_db(database, verbosity=0)
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4 encoding=utf-8
+
+"""Measures the cost of encoding and decoding GSM PDUs: packing and
+   unpacking 7-bit septets (compared with the old implementation, which
+   went via strings of '0' and '1' characters), building the PDUs for
+   gsm, ucs2 and concatenated messages, and building the PDUs for a
+   blast to many recipients one by one, or with get_outbound_pdus_many."""
+
+import sys, time
+from pygsm import gsmpdu
+
+ITERATIONS = 2000
+RECIPIENTS = 500
+
+SHORT = u"hello from rapidsms! " * 7
+LONG = u"hello from rapidsms! " * 30
+UCS2 = u"山川 " * 20
+PDU = "07912180958729F6440B814151733717F500009070207095828AA00500030E0201986FF719C47EBBCF20F6DB7D06B1DFEE3388FD769F41ECB7FB0C62BFDD6710FBED3E83D8ECB7"
+
+
+def _to_binary(n):
+    s = ""
+    for i in range(8):
+        s = ("%1d" % (n & 1)) + s
+        n >>= 1
+    return s
+
+def old_unpack_septets(seq, padding=0):
+    """The septet decoder as it was before being rewritten."""
+    msgbytes = [int(seq[i:i+2], 16) for i in range(0, len(seq) / 2 * 2, 2)]
+    msgbytes.reverse()
+    asbinary = ''.join(map(_to_binary, msgbytes))
+    if padding != 0:
+        asbinary = asbinary[:-padding]
+    chars = []
+    while len(asbinary) >= 7:
+        chars.append(int(asbinary[-7:], 2))
+        asbinary = asbinary[:-7]
+    return "".join(map(chr, chars))
+
+def old_pack_septets(str, padding=0):
+    """The septet encoder as it was before being rewritten."""
+    bytes = [ord(c) for c in str]
+    bytes.reverse()
+    asbinary = ''.join([_to_binary(b)[1:] for b in bytes])
+    asbinary += '0' * padding
+    extra = len(asbinary) % 8
+    if extra > 0:
+        asbinary = ('0' * (8 - extra)) + asbinary
+    bytes = [int(asbinary[i:i+8], 2) for i in range(0, len(asbinary), 8)]
+    bytes.reverse()
+    return ''.join([chr(b) for b in bytes])
+
+
+def run(label, func, count=ITERATIONS, unit="op"):
+    start = time.time()
+    for n in xrange(count):
+        func()
+    elapsed = time.time() - start
+    print "%-38s %10.2f us/%s" % (label, (elapsed / count) * 1e6, unit)
+
+
+def blast_one_by_one(text, recipients):
+    return dict([(r, gsmpdu.get_outbound_pdus(text, r)) for r in recipients])
+
+def build_strings(pdus):
+    for parts in pdus.values():
+        for p in parts:
+            p.pdu_string
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        ITERATIONS = int(sys.argv[1])
+
+    septets = SHORT.encode("gsm")
+    packed = gsmpdu._pack_septets(septets).encode("hex")
+    print "septets (%d chars):" % len(septets)
+    run("  old pack", lambda: old_pack_septets(septets))
+    run("  new pack", lambda: gsmpdu._pack_septets(septets))
+    run("  old unpack", lambda: old_unpack_septets(packed))
+    run("  new unpack", lambda: gsmpdu._unpack_septets(packed))
+
+    print "pdus:"
+    run("  decode csm part", lambda: gsmpdu.ReceivedGsmPdu(PDU))
+    for label, text in (("gsm", SHORT), ("ucs2", UCS2), ("concatenated", LONG)):
+        run("  encode %s" % label,
+            lambda: [p.pdu_string for p in gsmpdu.get_outbound_pdus(text, "+221770000000")])
+
+    recipients = ["+22177%07d" % n for n in range(RECIPIENTS)]
+    print "blast to %d recipients:" % RECIPIENTS
+    count = max(1, ITERATIONS / 100)
+    for label, text in (("gsm", SHORT), ("concatenated", LONG)):
+        run("  %s, one by one" % label,
+            lambda: build_strings(blast_one_by_one(text, recipients)), count, "blast")
+        run("  %s, get_outbound_pdus_many" % label,
+            lambda: build_strings(gsmpdu.get_outbound_pdus_many(text, recipients)), count, "blast")
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4
+
+"""Measures the cost of sending outgoing messages to an HTTP gateway (a
+   stub, on localhost), comparing the old approach of opening a new
+   connection for each message (via urllib2) with the pooled, keep-alive
+   HttpClient used by the http backend's GatewayHandler."""
+
+import sys, time, threading, urllib, urllib2
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+from rapidsms.backends.httpclient import HttpClient
+
+MESSAGES = 2000
+THREADS = 4
+
+
+class StubGateway(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    wbufsize = -1
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+        self.wfile.write("OK")
+
+    def log_message(self, *args):
+        pass
+
+
+class ThreadedServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+def run(label, send, url, threads):
+    # each thread sends its share of the messages
+    def sender(count):
+        for n in range(count):
+            send("%s?%s" % (url, urllib.urlencode(
+                {"to": "221770000%03d" % (n % 1000), "text": "hello world"})))
+
+    workers = [threading.Thread(target=sender, args=(MESSAGES / threads,))
+        for n in range(threads)]
+    start = time.time()
+    for worker in workers: worker.start()
+    for worker in workers: worker.join()
+    elapsed = time.time() - start
+    print "%-26s %8.0f msg/s %8.2f ms/msg" % (
+        label, MESSAGES / elapsed, (elapsed / MESSAGES) * 1e3 * threads)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        MESSAGES = int(sys.argv[1])
+
+    server = ThreadedServer(("127.0.0.1", 0), StubGateway)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.setDaemon(True)
+    thread.start()
+    url = "http://127.0.0.1:%d/send" % server.server_address[1]
+
+    print "%d messages to %s" % (MESSAGES, url)
+    for threads in (1, THREADS):
+        run("urllib2 (%d thread%s)" % (threads, threads > 1 and "s" or ""),
+            lambda url: urllib2.urlopen(url).read(), url, threads)
+        client = HttpClient(size=threads)
+        run("HttpClient (%d thread%s)" % (threads, threads > 1 and "s" or ""),
+            lambda url: client.request("GET", url), url, threads)
+        print "  %(connections)d connections for %(requests)d requests" % client.stats()
+        client.close()
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4
+
+"""Measures the cost of matching a message against a large number of
+   keyword patterns (as registered with a Keyworder), comparing the
+   Dispatcher's prefix index with trying every pattern in turn."""
+
+import sys, time, random
+from rapidsms.parsers.keyworder import Keyworder
+from rapidsms.parsers.dispatcher import Dispatcher
+
+KEYWORDS = 1000
+MESSAGES = 20000
+
+
+def build_patterns():
+    kw = Keyworder()
+    handlers = []
+    for n in range(KEYWORDS):
+        def handler(): pass
+        handlers.append(handler)
+        # most keywords take some arguments, and some are variations
+        # of each other, like "cmd12", "cmd12 (numbers)", etc
+        kw("cmd%d" % n, "cmd%d (numbers)" % n, "cmd%d (letters) (whatever)" % n)(handler)
+    kw.invalid()(lambda: None)
+    return kw.regexen
+
+
+def build_messages():
+    messages = []
+    for n in range(MESSAGES):
+        i = random.randrange(KEYWORDS)
+        messages.append(random.choice([
+            "cmd%d" % i, "cmd%d 42" % i, "CMD%d abc def ghi" % i, "nonsense %d" % i]))
+    return messages
+
+
+def linear_match(regexen, text):
+    """The Keyworder's matching, as it was before it was indexed."""
+    for pat, func in regexen:
+        match = pat.match(text)
+        if match:
+            return (func, [x and x.strip() or x for x in match.groups()])
+
+
+def run(label, func, messages):
+    start = time.time()
+    for text in messages:
+        func(text)
+    elapsed = time.time() - start
+    print "%-18s %8.2f us/msg" % (label, (elapsed / len(messages)) * 1e6)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        KEYWORDS = int(sys.argv[1])
+
+    regexen = build_patterns()
+    messages = build_messages()
+    dispatcher = Dispatcher()
+    for pat, func in regexen:
+        dispatcher.add(pat, func)
+
+    # both must find the same handlers
+    for text in messages[:1000]:
+        assert linear_match(regexen, text) == dispatcher.match(text)
+
+    print "%d keywords (%d patterns), %d messages" % (KEYWORDS, len(regexen), MESSAGES)
+    run("linear scan", lambda text: linear_match(regexen, text), messages[:MESSAGES / 10])
+    run("dispatcher", dispatcher.match, messages)
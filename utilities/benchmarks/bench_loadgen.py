@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4
+
+"""Runs a router (with a few do-nothing apps, and one which answers
+   every message) under traffic from the loadgen backend, and prints
+   its throughput and latency percentiles. This measures the router
+   itself; to measure a real app stack, add a loadgen backend to its
+   rapidsms.ini and run "rapidsms loadtest" instead."""
+
+import sys, threading
+from rapidsms.router import Router
+from rapidsms.app import App
+from rapidsms.backends.loadgen import Backend
+from rapidsms.tests.harness import MockLogger
+
+APPS = 16
+RATE = 500 # messages per second
+DURATION = 10 # seconds
+
+
+class NullLogger (MockLogger):
+    def write (self, *args):
+        pass
+
+class ParseApp (App):
+    def parse (self, message):
+        message.parsed = True
+
+class AnswerApp (App):
+    def handle (self, message):
+        message.respond("ok: " + message.text)
+        return True
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        RATE = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        DURATION = int(sys.argv[2])
+
+    router = Router()
+    router.logger = NullLogger()
+    for n in range(APPS - 1):
+        router.apps.append(ParseApp(router))
+    router.apps.append(AnswerApp(router))
+
+    backend = Backend(router)
+    backend._configure(rate=RATE, duration=DURATION, identities=2000,
+        mix="answered:1", answered="hello %(n)d", delay=0.5, timeout=5)
+    router.backends.append(backend)
+
+    thread = threading.Thread(target=router.start)
+    thread.start()
+    try:
+        while not backend.finished.isSet():
+            backend.finished.wait(1.0)
+    finally:
+        router.stop()
+        thread.join()
+    print backend.report()
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4
+
+"""Measures flattening NodeSets and finding the ancestors of Nodes in
+   a graph of 50,000 contacts (5 regions, of 10 villages, of 1000
+   contacts each), comparing the closure table with the old approach
+   of walking the graph with a query per node. This needs a configured
+   project (it reads rapidsms.ini), and builds the graph in a new test
+   database, which takes a while."""
+
+import os, sys, time
+
+os.environ.setdefault("RAPIDSMS_INI", "rapidsms.ini")
+os.environ["DJANGO_SETTINGS_MODULE"] = "rapidsms.webui.settings"
+from rapidsms.webui import settings
+from django.core.management import setup_environ
+setup_environ(settings)
+
+from django.db import connection, transaction, reset_queries
+from apps.nodegraph.models import Node, NodeSet
+
+REGIONS = 5
+VILLAGES = 10
+CONTACTS = 1000
+REPEAT = 5
+
+
+def walk_flatten(root):
+    """NodeSet.flatten, as it was before the closure table."""
+    seen = set()
+    leaves = set()
+    def _recurse(node):
+        ns = node.as_set
+        if ns in seen:
+            return
+        if ns is not None:
+            seen.add(ns)
+            for n in ns.children:
+                _recurse(n)
+        else:
+            leaves.add(node)
+    _recurse(root)
+    return list(leaves)
+
+def walk_ancestors(node):
+    """Node.get_ancestors, as it was before the closure table."""
+    seen = set()
+    def _recurse(node):
+        if node in seen:
+            return
+        seen.add(node)
+        for a in node.get_parents():
+            _recurse(a)
+    _recurse(node)
+    seen.remove(node)
+    return list(seen)
+
+
+@transaction.commit_on_success
+def build_graph():
+    regions = []
+    for r in range(REGIONS):
+        region = NodeSet(debug_id="region-%d" % r)
+        region.save()
+        for v in range(VILLAGES):
+            village = NodeSet(debug_id="village-%d-%d" % (r, v))
+            village.save()
+            region.add_children(village)
+            contacts = []
+            for c in range(CONTACTS):
+                contact = Node(debug_id="contact-%d-%d-%d" % (r, v, c))
+                contact.save()
+                contacts.append(contact)
+            village.add_children(*contacts)
+        regions.append(region)
+    return regions
+
+
+def run(label, func):
+    reset_queries()
+    start = time.time()
+    for n in range(REPEAT):
+        result = func()
+    elapsed = time.time() - start
+    print "%-34s %10.2f ms/call %8d queries/call (%d results)" % (
+        label, (elapsed / REPEAT) * 1e3, len(connection.queries) / REPEAT, len(result))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        CONTACTS = int(sys.argv[1]) / (REGIONS * VILLAGES)
+
+    database = settings.DATABASE_NAME
+    connection.creation.create_test_db(verbosity=0)
+    try:
+        start = time.time()
+        regions = build_graph()
+        print "built a graph of %d contacts in %.1fs" % (
+            REGIONS * VILLAGES * CONTACTS, time.time() - start)
+
+        village = regions[0].children[0].as_set
+        contact = village.children[0]
+        run("village, walked", lambda: walk_flatten(village))
+        run("village, closure", lambda: village.flatten())
+        run("region, walked", lambda: walk_flatten(regions[0]))
+        run("region, closure", lambda: regions[0].flatten())
+        run("contact ancestors, walked", lambda: walk_ancestors(contact))
+        run("contact ancestors, closure", lambda: contact.get_ancestors())
+    finally:
+        connection.creation.destroy_test_db(database, verbosity=0)
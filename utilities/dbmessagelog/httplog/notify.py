@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4
+
+"""
+The notification channel between the http front end (views.api), which
+queues incoming messages in the database, and the polling backend,
+which routes them. Both ends send UDP datagrams over localhost, so
+neither has to poll the database to find out what the other has done:
+
+  * once the view has saved an IncomingMessage, it sends "new <id>" to
+    the backend, and waits for a reply on the same socket
+  * the backend claims the message right away (rather than on its next
+    sweep of the database), and replies "done <id>" as soon as it has
+    been processed and its responses have been saved
+
+Datagrams can be lost, and the router might not be running at all, so
+neither end relies on them: the backend still sweeps the database every
+few seconds, and the view checks the message once more before it gives
+up waiting for it.
+
+"""
+
+import time
+import select
+import socket
+
+HOST = "127.0.0.1"
+PORT = 8101
+MAX_DATAGRAM = 512
+
+
+def parse(data):
+    """Returns the (verb, message id) of a datagram,
+       or (None, None) if it isn't one of ours"""
+    try:
+        verb, id = data.split()
+        return verb, int(id)
+    except ValueError:
+        return None, None
+
+
+class Listener(object):
+    """The backend's end of the channel"""
+
+    def __init__(self, host=HOST, port=PORT):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            self.sock.bind((host, port))
+        except socket.error:
+            # (another router is listening here.) the backend still
+            # needs a socket to be woken by, but the view won't find it
+            self.sock.bind((host, 0))
+            self.bound = False
+        else:
+            self.bound = True
+        self.sock.setblocking(0)
+        self.address = self.sock.getsockname()
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def wait(self, timeout):
+        """Waits up to _timeout_ seconds for a datagram to arrive"""
+        try:
+            select.select([self.sock], [], [], max(timeout, 0))
+        except select.error:
+            # interrupted by a signal
+            pass
+
+    def receive(self):
+        """Returns the (id, reply address) of each message announced
+           since the last call. (wakeups are read, and dropped)"""
+        new = []
+        while True:
+            try:
+                data, address = self.sock.recvfrom(MAX_DATAGRAM)
+            except socket.error:
+                return new
+            verb, id = parse(data)
+            if verb == "new":
+                new.append((id, address))
+
+    def done(self, id, address):
+        """Tells the view waiting at _address_ that message _id_
+           has been processed (or has timed out)"""
+        try:
+            self.sock.sendto("done %d" % id, address)
+        except socket.error:
+            # the view will see it in the database
+            pass
+
+    def wake(self):
+        """Interrupts wait(). This is safe to call from any thread"""
+        try:
+            self.sock.sendto("wake", self.address)
+        except socket.error:
+            pass
+
+    def close(self):
+        self.sock.close()
+
+
+def wait_for(id, timeout, host=HOST, port=PORT):
+    """Announces the (saved) IncomingMessage _id_ to the backend,
+       and waits up to _timeout_ seconds for the backend to say that
+       it's done. Returns False if it didn't, in which case the
+       message might be processed anyway, so check the database."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        try:
+            sock.sendto("new %d" % id, (host, port))
+        except socket.error:
+            return False
+
+        deadline = time.time() + timeout
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            try:
+                ready = select.select([sock], [], [], remaining)[0]
+            except select.error:
+                continue
+            if not ready:
+                continue
+            try:
+                data = sock.recv(MAX_DATAGRAM)
+            except socket.error:
+                # (e.g. "connection refused", when nothing is listening)
+                return False
+            if parse(data) == ("done", id):
+                return True
+    finally:
+        sock.close()
@@ -1,15 +1,19 @@
 #!/usr/bin/env python
 # vim: ai ts=4 sts=4 et sw=4
 
+from django.conf import settings
 from django.http import HttpResponse
-import time
 import logging
 import urllib, urllib2
 from datetime import datetime
 
 from models import *
+import notify
 
-def api(request, url, timeout=30, interval=.5):
+# where the router's polling backend is listening
+NOTIFY_ADDRESS = getattr(settings, "HTTPLOG_NOTIFY_ADDRESS", (notify.HOST, notify.PORT))
+
+def api(request, url, timeout=30):
     # support parameters from either posts or gets
     if request.method == 'POST':
         dict = request.POST
@@ -40,21 +44,12 @@ def api(request, url, timeout=30, interval=.5):
         # save the message to the incoming db queue
         msg = IncomingMessage.objects.create(phone=phone, text=text, time=date, status="R")
         
-        # wait for a while for the message to be processed by rapid sms
-        handled = False
-        countdown = timeout
-        while not handled and countdown > 0:
-            msg = IncomingMessage.objects.get(id = msg.id)
-            if msg.processed:
-                # aha!  rapidsms has set this flag and finished processing
-                handled = True
-                break
-            else:
-                # wait a short time before checking
-                # again, to avoid pegging the cpu
-                countdown -= interval
-                #print "sleeping... %s" % countdown
-                time.sleep(interval)
+        # tell the router about the message, and wait for it
+        # to be processed. (if we don't hear back, it might
+        # be processed anyway, so check the database too)
+        notify.wait_for(msg.id, timeout, *NOTIFY_ADDRESS)
+        msg = IncomingMessage.objects.get(id=msg.id)
+        handled = msg.processed
         
         # it was successfully handled by rapid sms
         # gather any responses and put them in the response body
@@ -68,10 +63,6 @@ def api(request, url, timeout=30, interval=.5):
             else: 
                 response_text = "Thanks for your message!"
             
-            # mark the message as processed
-            msg.status = "P"
-            msg.save()
-            
             # send the response messages in the body of the
             # http response 
             return HttpResponse(response_text)
@@ -79,9 +70,9 @@ def api(request, url, timeout=30, interval=.5):
             logging.warn("Router timed out while processing incoming message")
             
             # set the status to timeout, in case we 
-            # want to differentiate these later 
-            msg.status = "T"
-            msg.save()
+            # want to differentiate these later. (unless
+            # it was processed while we were looking)
+            IncomingMessage.objects.filter(id=msg.id, status__in=("R", "H")).update(status="T")
             # respond with a generic partial error message
             return HttpResponse("Thanks for your message.  We are having technical difficulties preventing us from responding properly, but we got it.")
     else:
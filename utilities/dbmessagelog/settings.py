@@ -17,6 +17,10 @@ DATABASE_PASSWORD = ''         # Not used with sqlite3.
 DATABASE_HOST = ''             # Set to empty string for localhost. Not used with sqlite3.
 DATABASE_PORT = ''             # Set to empty string for default. Not used with sqlite3.
 
+# where the router's polling backend listens for new messages. this
+# should match the notify_host and notify_port of that backend
+HTTPLOG_NOTIFY_ADDRESS = ('127.0.0.1', 8101)
+
 # Local time zone for this installation. Choices can be found here:
 # http://en.wikipedia.org/wiki/List_of_tz_zones_by_name
 # although not all choices may be available on all operating systems.